@@ -0,0 +1,212 @@
+"""Mergeable accumulators for inversion climatologies.
+
+A climatology can be built in one pass over the archive with memory that
+does not grow with the number of launches. Feed each chunk of a station's
+layer table to accumulate_layers as it is produced, in date order and with
+whole launches, and combine the accumulators of different chunks or
+workers with merge. merge is associative. Where two accumulators share a
+key, the second must cover later launches than the first.
+calculate_inversions does this as the layers are found: with heights
+(--climatology), each station accumulates its layers a month at a time
+and run_stations merges the stations' accumulators as workers finish.
+accumulate_store does it for the stations already in the inversion store,
+a year at a time.
+
+Statistics are kept per key (station, group), with group the calendar
+month (0-11), season or hour from frequency.calendar_groups.
+"""
+import copy
+import os
+import numpy as np
+import pandas as pd
+from .frequency import calendar_groups, inversion_indicator
+from .store import read_station
+
+default_bins = {'depth': np.arange(0, 3001, 50.),
+                'strength': np.arange(0, 30.1, 0.5),
+                'height_base': np.arange(0, 5001, 100.)}
+
+
+def pair_moments(previous, current):
+    """(n, means, sums of squared deviations and sum of products of
+    deviations) of the pairs of rows previous[i], current[i]."""
+    n = len(previous)
+    if n == 0:
+        zero = np.zeros(previous.shape[1])
+        return 0, zero, zero, zero, zero, zero
+    previous_mean = previous.mean(axis=0)
+    current_mean = current.mean(axis=0)
+    previous = previous - previous_mean
+    current = current - current_mean
+    return (n, previous_mean, current_mean, (previous ** 2).sum(axis=0),
+            (current ** 2).sum(axis=0), (previous * current).sum(axis=0))
+
+
+def combine_moments(a, b):
+    """Pair moments of the union of two sets of pairs (Chan et al. 1979)."""
+    na, nb = a[0], b[0]
+    if na == 0:
+        return b
+    if nb == 0:
+        return a
+    n = na + nb
+    d_previous = b[1] - a[1]
+    d_current = b[2] - a[2]
+    weight = na * nb / n
+    return (n, a[1] + d_previous * nb / n, a[2] + d_current * nb / n,
+            a[3] + b[3] + d_previous ** 2 * weight, a[4] + b[4] + d_current ** 2 * weight,
+            a[5] + b[5] + d_previous * d_current * weight)
+
+
+class HeightStatistics:
+    """Count, mean and lag-1 autocorrelation of each column of a series of
+    rows, such as the indicator matrix, for each key. Pairs are consecutive
+    rows with the same key, as in frequency.lag1_autocorrelation."""
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, key, values):
+        """Adds rows of values (n_rows x n_heights, in time order) to key."""
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        chunk = {'n': len(values), 'mean': values.mean(axis=0), 'first': values[0],
+                 'last': values[-1], 'pairs': pair_moments(values[:-1], values[1:])}
+        self.stats[key] = self.combine(self.stats[key], chunk) if key in self.stats else chunk
+
+    def update(self, station, groups, values):
+        """Adds each row of values to the key (station, group of that row)."""
+        for group in np.unique(groups):
+            self.add((station, int(group)), values[groups == group])
+
+    @staticmethod
+    def combine(a, b):
+        """Statistics of the rows of a followed by the rows of b."""
+        n = a['n'] + b['n']
+        boundary = pair_moments(a['last'][np.newaxis], b['first'][np.newaxis])
+        return {'n': n, 'mean': (a['n'] * a['mean'] + b['n'] * b['mean']) / n,
+                'first': a['first'], 'last': b['last'],
+                'pairs': combine_moments(combine_moments(a['pairs'], boundary), b['pairs'])}
+
+    def merge(self, other):
+        """Returns the statistics of self followed by other."""
+        result = copy.deepcopy(self)
+        for key, stats in other.stats.items():
+            result.stats[key] = (self.combine(result.stats[key], stats) if key in result.stats
+                                 else copy.deepcopy(stats))
+        return result
+
+    def autocorrelation(self, key):
+        """Lag-1 autocorrelation of each column for key, NaN if constant."""
+        n, previous_mean, current_mean, previous_m2, current_m2, comoment = self.stats[key]['pairs']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return comoment / np.sqrt(previous_m2 * current_m2)
+
+    def to_frame(self):
+        """Tidy table with one row per key and column (level), giving the
+        number of rows n, the mean and the autocorrelation phi."""
+        frames = []
+        for key in sorted(self.stats):
+            stats = self.stats[key]
+            levels = np.arange(len(stats['mean']))
+            frames.append(pd.DataFrame({'station': key[0], 'group': key[1], 'level': levels,
+                                        'n': stats['n'], 'mean': stats['mean'],
+                                        'phi': self.autocorrelation(key)}))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['n', 'mean', 'phi'])
+        return pd.concat(frames, ignore_index=True).set_index(['station', 'group', 'level'])
+
+
+class LayerHistograms:
+    """Histograms of layer properties for each key. bins maps each property
+    to its bin edges; values outside the edges are not counted."""
+
+    def __init__(self, bins=default_bins):
+        self.bins = bins
+        self.counts = {}
+
+    def update(self, station, groups, properties):
+        """Counts the layers with the given groups, and the property values
+        in the dictionary properties, under the keys (station, group)."""
+        for name, edges in self.bins.items():
+            if name not in properties:
+                continue
+            values = np.asarray(properties[name], dtype=float)
+            index = np.searchsorted(edges, values, side='right') - 1
+            index[values == edges[-1]] = len(edges) - 2  # last bin includes its right edge
+            inside = (index >= 0) & (index < len(edges) - 1)
+            for group in np.unique(groups):
+                selected = inside & (groups == group)
+                counts = np.bincount(index[selected], minlength=len(edges) - 1)
+                key = (station, int(group))
+                self.counts.setdefault(key, {})
+                self.counts[key][name] = self.counts[key].get(name, 0) + counts
+
+    def merge(self, other):
+        """Returns the sum of the histograms of self and other."""
+        result = copy.deepcopy(self)
+        for key, histograms in other.counts.items():
+            result.counts.setdefault(key, {})
+            for name, counts in histograms.items():
+                result.counts[key][name] = result.counts[key].get(name, 0) + counts
+        return result
+
+    def to_frame(self):
+        """Tidy table of the counts with one row per key, property and bin."""
+        frames = []
+        for key in sorted(self.counts):
+            for name, counts in self.counts[key].items():
+                edges = self.bins[name]
+                frames.append(pd.DataFrame({'station': key[0], 'group': key[1], 'property': name,
+                                            'bin_left': edges[:-1], 'bin_right': edges[1:],
+                                            'count': counts}))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['station', 'group', 'property', 'bin_left', 'bin_right',
+                                         'count'])
+        return pd.concat(frames, ignore_index=True)
+
+
+def accumulate_layers(layer_df, station, zgrid, by='month', heights=None, histograms=None):
+    """Adds a chunk of a station's layer table (whole launches, later than
+    any added before) to the height statistics of the inversion indicator on
+    zgrid and to the layer property histograms, creating them if None.
+    Returns (heights, histograms)."""
+    heights = HeightStatistics() if heights is None else heights
+    histograms = LayerHistograms() if histograms is None else histograms
+
+    dates, indicator = inversion_indicator(layer_df, zgrid)
+    heights.update(station, calendar_groups(dates, by)[0], indicator)
+
+    layers = layer_df.loc[layer_df['height_base'].notnull()]
+    properties = {'height_base': layers['height_base'].values,
+                  'depth': layers['height_top'].values - layers['height_base'].values}
+    if 'temperature_base' in layers.columns:
+        properties['strength'] = layers['temperature_top'].values - layers['temperature_base'].values
+    histograms.update(station, calendar_groups(layers['date'].values, by)[0], properties)
+    return heights, histograms
+
+
+def accumulate_store(root, stations, elevations, heights, by='month', start=None, end=None):
+    """Height statistics and layer histograms (see accumulate_layers) of the
+    stations of the inversion store under root, for the launches with start
+    <= date <= end, reading one year of one station at a time. heights is
+    the grid above ground and elevations the elevation of each station.
+    Returns (heights, histograms)."""
+    statistics, histograms = HeightStatistics(), LayerHistograms()
+    heights = np.asarray(heights, dtype=float)
+    start = pd.Timestamp.min if start is None else pd.Timestamp(start)
+    end = pd.Timestamp.max if end is None else pd.Timestamp(end)
+    for station, elevation in zip(stations, elevations):
+        path = os.path.join(root, 'station=' + station)
+        names = os.listdir(path) if os.path.isdir(path) else []
+        years = sorted(int(name.split('=', 1)[1]) for name in names if name.startswith('year='))
+        for year in [year for year in years if start.year <= year <= end.year]:
+            year_start = pd.Timestamp(year, 1, 1)
+            year_end = pd.Timestamp(year + 1, 1, 1) - pd.Timedelta(1, 's')
+            layer_df = read_station(root, station, start=max(start, year_start),
+                                    end=min(end, year_end))
+            if len(layer_df):
+                accumulate_layers(layer_df, station, elevation + heights, by, statistics,
+                                  histograms)
+    return statistics, histograms
@@ -0,0 +1,117 @@
+"""Memory-mapped archive of soundings stored end to end.
+
+Each station is a folder of .npy files,
+
+    root/<station_id>/date.npy        launch times, sorted
+    root/<station_id>/offsets.npy     launch i is in offsets[i]:offsets[i+1]
+    root/<station_id>/<variable>.npy  one flat array per variable
+    root/<station_id>/launches.npy    launch index, see invclim.launches
+    root/<station_id>/meta.json       variable names and units
+
+opened with numpy memory mapping, so a launch or a date range can be read
+as views into the files without loading the rest of the station.
+"""
+import json
+import os
+import shutil
+import numpy as np
+from .core import Sounding, launch_offsets, sounding_units
+from .launches import launch_index
+
+
+def write_archive(df, root, station, variables=None, dtype='float32'):
+    """Writes the long-format sounding table df (a 'date' column and one row
+    per level, levels of each launch from the surface up) to the archive for
+    station under root, replacing any existing archive for that station.
+    variables defaults to every column other than 'date'."""
+    if variables is None:
+        variables = [cc for cc in df.columns if cc != 'date']
+    dates = df['date'].values
+    order = np.argsort(dates, kind='stable')
+    dates = dates[order]
+    offsets = launch_offsets(dates)
+
+    final = os.path.join(root, station)
+    tmp = os.path.join(root, '.' + station + '.tmp')
+    old = os.path.join(root, '.' + station + '.old')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'date.npy'), dates[offsets[:-1]].astype('datetime64[s]'))
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets.astype(np.int64))
+    np.save(os.path.join(tmp, 'launches.npy'), launch_index(
+        {cc: df[cc].values[order] for cc in ['date', 'height', 'relative_humidity'] if cc in df}))
+    for cc in variables:
+        np.save(os.path.join(tmp, cc + '.npy'), df[cc].to_numpy(dtype=dtype)[order])
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'variables': list(variables),
+                   'units': {cc: sounding_units[cc] for cc in variables if cc in sounding_units}},
+                  f, indent=1)
+
+    if os.path.exists(final):
+        os.replace(final, old)
+    os.replace(tmp, final)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class SoundingArchive:
+    """Read access to the archive of one station. Nothing is read when the
+    archive is opened; the arrays are memory-mapped and every method returns
+    views into them.
+
+    archive = SoundingArchive('../Data/Archive/', 'USM00070026')
+    archive.sounding('2010-01-01 00:00')  # one launch, as a core.Sounding
+    archive.select('2010-01-01', '2010-12-31 23:00')  # input for the batch finders
+    archive.launches  # launch index (see invclim.launches), None if archived without one
+    """
+
+    def __init__(self, root, station):
+        self.path = os.path.join(root, station)
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.units = meta['units']
+        self.dates = np.load(os.path.join(self.path, 'date.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+        launches = os.path.join(self.path, 'launches.npy')
+        self.launches = np.load(launches, mmap_mode='r') if os.path.exists(launches) else None
+        self.variables = {cc: np.load(os.path.join(self.path, cc + '.npy'), mmap_mode='r')
+                          for cc in meta['variables']}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def launch(self, i):
+        """Returns launch number i as a Sounding."""
+        start = self.offsets[i]
+        stop = self.offsets[i + 1]
+        return Sounding(self.dates[i], {cc: self.variables[cc][start:stop] for cc in self.variables},
+                        self.units)
+
+    def sounding(self, date):
+        """Returns the launch at date as a Sounding. Raises KeyError if there
+        was no launch at that time."""
+        date = np.datetime64(date, 's')
+        i = np.searchsorted(self.dates, date)
+        if i == len(self.dates) or self.dates[i] != date:
+            raise KeyError(str(date))
+        return self.launch(i)
+
+    def date_range(self, start=None, end=None):
+        """Returns the numbers of the first and one past the last launch with
+        start <= date <= end."""
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 's'))
+        last = len(self.dates) if end is None else np.searchsorted(
+            self.dates, np.datetime64(end, 's'), side='right')
+        return first, last
+
+    def select(self, start=None, end=None):
+        """Returns the launches with start <= date <= end as (offsets,
+        columns, dates), the same layout as core.setup_batch, for use with
+        invfinder.find_inversions_ragged. The variable arrays are views into
+        the archive; only the level 'index' array is built."""
+        first, last = self.date_range(start, end)
+        offsets = np.asarray(self.offsets[first:last + 1])
+        columns = {'index': np.arange(offsets[-1] - offsets[0]) -
+                   np.repeat(offsets[:-1] - offsets[0], np.diff(offsets))}
+        for cc in self.variables:
+            columns[cc] = self.variables[cc][offsets[0]:offsets[-1]]
+        return offsets - offsets[0], columns, np.asarray(self.dates[first:last])
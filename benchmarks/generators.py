@@ -0,0 +1,66 @@
+"""Synthetic soundings for the benchmarks, shaped like IGRA2 significant-level
+profiles below 500 hPa: a varying number of levels per launch, surface-based
+inversions in most launches, and up to three elevated inversions of varying
+depth and strength. Everything is drawn from a seeded generator, so the same
+arguments always give the same soundings.
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import invclim.thermo as ict
+import numpy as np
+import pandas as pd
+
+
+def synthetic_soundings(n_soundings, seed=0, start='2000-01-01', elevation=10.,
+                        mean_levels=25, surface_inversion_fraction=0.6, max_height=5500.):
+    """Long-format table of n_soundings launches 12 hours apart with the
+    columns of the sounding store: date, pressure, height, temperature,
+    relative_humidity, adjusted_relative_humidity and vapor_pressure."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=n_soundings, freq='12h').values
+    n_levels = np.clip(rng.poisson(mean_levels, n_soundings), 4, 120)
+    offsets = np.concatenate([[0], np.cumsum(n_levels)])
+    launch = np.repeat(np.arange(n_soundings), n_levels)
+    level = np.arange(offsets[-1]) - offsets[launch]
+
+    # Heights: the surface, then sorted random levels up to max_height
+    height = rng.uniform(0, max_height, offsets[-1])
+    height[level == 0] = 0
+    height = np.sort(height + launch * 1e5) - launch * 1e5 + elevation
+
+    # Lapse rate profile, colder in winter, plus surface and elevated inversions
+    day = (dates - dates.astype('datetime64[Y]')).astype('timedelta64[D]').astype(int)
+    surface_temperature = 258 + 12 * -np.cos(2 * np.pi * day / 365) + rng.normal(0, 4, n_soundings)
+    z = height - elevation
+    temperature = surface_temperature[launch] - 0.0065 * z + rng.normal(0, 0.3, len(z))
+
+    surface = rng.uniform(size=n_soundings) < surface_inversion_fraction
+    depth = rng.uniform(100, 1200, n_soundings)
+    strength = np.where(surface, rng.uniform(1, 15, n_soundings), 0)
+    temperature += strength[launch] * np.clip(z / depth[launch], 0, 1) + 0.0065 * np.minimum(
+        z, depth[launch]) * surface[launch]
+    for ii in range(3):
+        present = rng.uniform(size=n_soundings) < 0.6 / (ii + 1)
+        base = rng.uniform(200, 4000, n_soundings)
+        depth = rng.uniform(50, 800, n_soundings)
+        strength = np.where(present, rng.uniform(0.5, 6, n_soundings), 0)
+        temperature += strength[launch] * np.clip((z - base[launch]) / depth[launch], 0, 1)
+
+    # Relative humidity: a random walk up each sounding from a random surface value
+    steps = rng.normal(0, 6, len(z))
+    steps[offsets[:-1]] = rng.uniform(50, 95, n_soundings)
+    walk = np.cumsum(steps)
+    relative_humidity = np.clip(walk - (walk - steps)[offsets[launch]], 5, 100)
+    vapor_pressure = relative_humidity / 100 * ict.saturation_vapor_pressure_liquid(temperature)
+
+    return pd.DataFrame({
+        'date': np.repeat(dates, n_levels),
+        'pressure': np.round(1013 * np.exp(-z / 8000), 1),
+        'height': np.round(height, 1),
+        'temperature': np.round(temperature, 1),
+        'relative_humidity': np.round(relative_humidity, 1),
+        'adjusted_relative_humidity': np.round(
+            ict.adjusted_relative_humidity(temperature, vapor_pressure), 1),
+        'vapor_pressure': np.round(vapor_pressure, 3)})
+
@@ -0,0 +1,66 @@
+"""Cold-start import time of the invclim modules.
+
+Each module is imported in a new Python process, as in a fresh worker
+process, with python -X importtime. Reports the best of several runs of the
+time to import the module (the cumulative time of its line in the
+importtime output), the wall time of the whole process, interpreter start
+included, and the heavy dependencies the import loaded.
+
+Run from the benchmarks folder:
+    python import_time.py
+    python import_time.py --repeat 10 invclim.invfinder invclim.calculate_inversions
+    python import_time.py --max-seconds 0.5 invclim.invfinder  # exit 1 if slower
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+heavy = ['pandas', 'xarray', 'metpy', 'pint', 'scipy', 'pyarrow', 'matplotlib', 'dask']
+default_modules = ['invclim.core', 'invclim.invfinder', 'invclim.cloudfinder',
+                   'invclim.calculate_inversions']
+
+
+def import_time(module):
+    """Seconds to import module in a new interpreter, wall time of that
+    process in seconds, and the packages of heavy it loaded."""
+    code = 'import sys, {}; print(" ".join(sys.modules))'.format(module)
+    path = os.pathsep.join([root] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True,
+                            text=True, check=True, env=dict(os.environ, PYTHONPATH=path))
+    wall = time.perf_counter() - start
+    # Lines are "import time: self [us] | cumulative | name"
+    cumulative = [int(line.split('|')[1]) for line in result.stderr.splitlines()
+                  if line.startswith('import time:') and line.split('|')[2].strip() == module]
+    loaded = {name.split('.')[0] for name in result.stdout.split()}
+    return cumulative[-1] / 1e6, wall, [name for name in heavy if name in loaded]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('modules', nargs='*', default=default_modules)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float,
+                        help='exit 1 if a module takes longer than this to import')
+    args = parser.parse_args(argv)
+
+    slow = []
+    for module in args.modules:
+        runs = [import_time(module) for ii in range(args.repeat)]
+        seconds = min(run[0] for run in runs)
+        wall = min(run[1] for run in runs)
+        print('{:32s} {:8.3f} s import {:8.3f} s process   loads: {}'.format(
+            module, seconds, wall, ', '.join(runs[0][2]) or '-'), flush=True)
+        if args.max_seconds is not None and seconds > args.max_seconds:
+            slow.append(module)
+    for module in slow:
+        print('SLOW', module)
+    if slow:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Benchmark suite for the ingest, detection and frequency stages, on
+synthetic IGRA2-like soundings from generators.py.
+
+For each stage, reports soundings per second (best of several runs), the
+peak memory allocated during one run, and the number of allocations still
+held when it returns (the result and anything cached), both from tracemalloc.
+Per-sounding stages run on fewer soundings than the batch stages, but the
+rates are comparable.
+
+Results can be saved as a baseline and later runs compared with it. A
+stage is flagged as a regression when its rate drops, or its peak memory
+grows, by more than the tolerance. Baselines are only comparable on the
+same machine; baseline.json was recorded on the machine in its header.
+
+Run from the benchmarks folder:
+    python run.py                            # print the results
+    python run.py --save baseline.json       # record a baseline
+    python run.py --compare baseline.json    # flag regressions, exit 1 if any
+    python run.py --only batch --soundings 500
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import invclim.calculate_inversions as ici
+import invclim.cloudfinder as icl
+import invclim.core as icc
+import invclim.frequency as icf
+import invclim.igra as igra
+import invclim.invfinder as iif
+import invclim.legacy as ilg
+import invclim.regrid as icr
+import numpy as np
+import pandas as pd
+from generators import synthetic_soundings
+
+# Stages are registered in order with the fraction of the soundings they run on
+stages = {}
+
+
+def stage(name, fraction=1.):
+    """Registers a function that takes the soundings table and returns the
+    callable to time, so that setup is not timed."""
+    def register(setup):
+        stages[name] = (setup, fraction)
+        return setup
+    return register
+
+
+def launches(df):
+    """The soundings in df as a list of single-launch tables indexed by level."""
+    return [group.drop(columns='vapor_pressure').reset_index(drop=True).rename_axis('index')
+            for date, group in df.groupby('date', sort=False)]
+
+
+@stage('ingest: read_derived + thermo')
+def ingest(df):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'USM00070026-drvd.txt.zip')
+    igra.write_derived(path, df)
+    return lambda: igra.import_soundings(path)
+
+
+@stage('legacy build_layer_df/merge', 0.02)
+def legacy(df):
+    datasets = [icc.setup_dataset(sounding) for sounding in launches(df)]
+    return lambda: [ilg.merge_loop(ds, 100) for ds in datasets]
+
+
+@stage('invfinder (Dataset)', 0.02)
+def invfinder_dataset(df):
+    datasets = [icc.setup_dataset(sounding) for sounding in launches(df)]
+    return lambda: [iif.invfinder(ds) for ds in datasets]
+
+
+@stage('invfinder (Sounding)', 0.2)
+def invfinder_sounding(df):
+    soundings = [icc.setup_sounding(sounding) for sounding in launches(df)]
+    return lambda: [iif.invfinder(sounding) for sounding in soundings]
+
+
+@stage('cloud_finder (Sounding)', 0.2)
+def cloud_finder_sounding(df):
+    soundings = [icc.setup_sounding(sounding) for sounding in launches(df)]
+    return lambda: [icl.cloud_finder(sounding) for sounding in soundings]
+
+
+@stage('batch: find_inversions_batch')
+def inversions_batch(df):
+    return lambda: iif.find_inversions_batch(df)
+
+
+@stage('batch: find_inversions + merge')
+def inversions_merged(df):
+    return lambda: ici.find_inversions(df)
+
+
+@stage('batch: find_inversion_records')
+def inversion_records(df):
+    batch = icc.setup_batch(df, ['pressure', 'height', 'temperature', 'relative_humidity'])
+    return lambda: iif.find_inversion_records(*batch)
+
+
+@stage('batch: find_clouds_batch')
+def clouds_batch(df):
+    return lambda: icl.find_clouds_batch(df)
+
+
+@stage('batch: sweep, 12 parameter sets')
+def sweep(df):
+    grid = ici.parameter_grid(min_dt=[0, 1, 2.5], min_dp=[0, 20], max_embed_depth=[50, 100])
+    return lambda: ici.sweep_inversions(df, grid)
+
+
+@stage('regrid: regrid_ragged, 60 heights')
+def regrid(df):
+    batch = icc.setup_batch(df, ['height', 'temperature', 'relative_humidity'])
+    heights = np.arange(0, 3000, 50.)
+    return lambda: icr.regrid_ragged(batch[0], batch[1], heights,
+                                     ['temperature', 'relative_humidity'])
+
+
+@stage('frequency: inversion_indicator')
+def indicator(df):
+    layer_df = ici.find_inversions(df)
+    zgrid = 15 + np.arange(25, 3000, 50)
+    return lambda: icf.inversion_indicator(layer_df, zgrid)
+
+
+def measure(func, repeat):
+    """Best wall time of repeat calls of func, and the peak traced memory
+    and number of traced blocks held after one more call."""
+    func()  # warm up imports and caches
+    seconds = np.inf
+    for ii in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    blocks = len(tracemalloc.take_snapshot().traces)
+    tracemalloc.stop()
+    del result
+    return seconds, peak, blocks
+
+
+def run(n_soundings, repeat=3, only=None):
+    """Runs the stages whose name contains only (all if None) on
+    n_soundings synthetic soundings. Returns a dictionary of results by stage."""
+    df = synthetic_soundings(n_soundings)
+    dates = df['date'].unique()
+    results = {}
+    for name, (setup, fraction) in stages.items():
+        if only is not None and only not in name:
+            continue
+        n = max(1, int(round(n_soundings * fraction)))
+        seconds, peak, blocks = measure(setup(df.loc[df['date'].isin(dates[:n])]), repeat)
+        results[name] = {'soundings': n, 'seconds': seconds, 'soundings_per_second': n / seconds,
+                         'peak_kib': peak / 1024, 'blocks': blocks}
+        print('{:34s} {:6d} soundings {:11.1f} soundings/s {:10.1f} KiB peak {:8d} blocks'.format(
+            name, n, n / seconds, peak / 1024, blocks), flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the messages for the stages that are slower, or use more
+    peak memory, than in baseline by more than the fraction tolerance."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        rate = result['soundings_per_second'] / baseline[name]['soundings_per_second']
+        memory = result['peak_kib'] / baseline[name]['peak_kib']
+        if rate < 1 - tolerance:
+            regressions.append('{}: {:.0%} of the baseline rate'.format(name, rate))
+        if memory > 1 + tolerance:
+            regressions.append('{}: {:.0%} of the baseline peak memory'.format(name, memory))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--soundings', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='run only the stages whose name contains this')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative change flagged as a regression (default 0.25)')
+    args = parser.parse_args(argv)
+
+    results = run(args.soundings, args.repeat, args.only)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'machine': platform.platform(), 'processor': platform.processor(),
+                       'python': platform.python_version(), 'numpy': np.__version__,
+                       'pandas': pd.__version__, 'soundings': args.soundings,
+                       'stages': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['soundings'] != args.soundings:
+            print('Baseline was recorded with', baseline['soundings'], 'soundings')
+        regressions = compare(results, baseline['stages'], args.tolerance)
+        for message in regressions:
+            print('REGRESSION', message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
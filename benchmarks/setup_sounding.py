@@ -0,0 +1,55 @@
+"""Compares the cost per sounding of core.setup_dataset (xarray + metpy
+quantify) with core.setup_sounding on the invfinder detection path.
+Reports the wall time and the peak memory allocated while building the
+container and running invfinder on it.
+
+Run from the benchmarks folder: python setup_sounding.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import invclim.core as icc
+import invclim.invfinder as iif
+import numpy as np
+import pandas as pd
+
+n_repeat = 200
+
+
+def make_sounding(n_levels=30, seed=0):
+    """Random significant-level sounding with a surface-based inversion."""
+    rng = np.random.default_rng(seed)
+    height = np.sort(rng.uniform(0, 5000, n_levels))
+    temperature = 255 + np.cumsum(rng.normal(0, 2, n_levels))
+    temperature[1] = temperature[0] + 3
+    return pd.DataFrame({'date': pd.Timestamp('2000-01-01'),
+                         'pressure': 1013 * np.exp(-height / 8000),
+                         'height': height,
+                         'temperature': temperature,
+                         'relative_humidity': rng.uniform(30, 100, n_levels)})
+
+
+def peak_allocation(func):
+    """Peak memory allocated by one call to func, in bytes."""
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+df = make_sounding()
+stages = {
+    'setup_dataset': lambda: icc.setup_dataset(df),
+    'setup_sounding': lambda: icc.setup_sounding(df),
+    'setup_dataset + invfinder': lambda: iif.invfinder(icc.setup_dataset(df)),
+    'setup_sounding + invfinder': lambda: iif.invfinder(icc.setup_sounding(df)),
+}
+
+for stage in stages:
+    stages[stage]()  # warm up imports and caches
+    seconds = timeit.timeit(stages[stage], number=n_repeat) / n_repeat
+    print('{:28s} {:9.1f} us/sounding {:9.1f} KiB peak'.format(
+        stage, seconds * 1e6, peak_allocation(stages[stage]) / 1024))
@@ -0,0 +1,110 @@
+"""Content-addressed cache of per-station results, one entry per month.
+
+Each month of a station's input is hashed together with the parameters
+and the algorithm version. The result for that month is stored under the
+hash, and manifest.json in the station's cache folder records which hash
+each month currently uses. On the next run a month is recomputed only if:
+
+* its input rows changed, e.g. new or corrected soundings,
+* the parameters or the algorithm version changed (this changes every key),
+* its cached result file is missing.
+
+Months that are no longer in the input are dropped from the manifest and
+their files deleted. The function applied must work launch by launch and
+return rows sorted by date, so that joining the months in order gives the
+same table as running it on the whole station at once.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def month_chunks(df):
+    """Splits df, sorted by date, into months. Returns a dictionary from
+    'YYYY-MM' labels to the (start, stop) rows of each month."""
+    months = df['date'].values.astype('datetime64[M]')
+    start, = np.nonzero(months[1:] != months[:-1])
+    start = np.concatenate([[0], start + 1]) if len(months) else start
+    stop = np.append(start[1:], len(months))
+    return {str(months[ii]): (ii, jj) for ii, jj in zip(start, stop)}
+
+
+def chunk_key(chunk, params, version):
+    """sha256 of the rows in chunk, the parameters and the algorithm version."""
+    key = hashlib.sha256()
+    key.update(str(version).encode())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    for cc in chunk.columns:
+        key.update(cc.encode())
+        key.update(np.ascontiguousarray(chunk[cc].to_numpy()).tobytes())
+    return key.hexdigest()
+
+
+def read_manifest(cache_dir):
+    """Returns the manifest of a station cache folder, or an empty one."""
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'chunks': {}}
+
+
+def write_manifest(cache_dir, manifest):
+    """Writes the manifest under a temporary name and moves it into place."""
+    path = os.path.join(cache_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def plan(df, params, version, cache_dir):
+    """Works out what a cached run would do, without computing anything.
+    Returns a dictionary from month label to (start, stop, key, up_to_date)
+    and the list of months in the manifest that are no longer in df."""
+    manifest = read_manifest(cache_dir)['chunks']
+    chunks = {}
+    for label, (start, stop) in month_chunks(df).items():
+        key = chunk_key(df.iloc[start:stop], params, version)
+        up_to_date = (label in manifest and manifest[label] == key and
+                      os.path.exists(os.path.join(cache_dir, key + '.parquet')))
+        chunks[label] = (start, stop, key, up_to_date)
+    return chunks, [label for label in manifest if label not in chunks]
+
+
+def run_cached(df, func, params, version, cache_dir, on_chunk=None):
+    """Applies func(chunk, params) to each month of df that isn't up to date
+    in cache_dir, stores the new results, and returns the results for all
+    months joined in date order. df must be sorted by date. on_chunk, if
+    given, is called with the result of each month in date order, whether
+    computed or read from the cache."""
+    os.makedirs(cache_dir, exist_ok=True)
+    chunks = plan(df, params, version, cache_dir)[0]
+
+    results = []
+    for label, (start, stop, key, up_to_date) in chunks.items():
+        path = os.path.join(cache_dir, key + '.parquet')
+        if up_to_date:
+            results.append(pq.read_table(path).to_pandas())
+        else:
+            result = func(df.iloc[start:stop], params)
+            pq.write_table(pa.Table.from_pandas(result, preserve_index=False), path + '.tmp')
+            os.replace(path + '.tmp', path)
+            results.append(result)
+        if on_chunk is not None:
+            on_chunk(results[-1])
+
+    manifest = read_manifest(cache_dir)['chunks']
+    keep = {chunks[label][2] for label in chunks}
+    for key in set(manifest.values()) - keep:
+        path = os.path.join(cache_dir, key + '.parquet')
+        if os.path.exists(path):
+            os.remove(path)
+    write_manifest(cache_dir, {'version': str(version), 'params': params,
+                               'chunks': {label: chunks[label][2] for label in chunks}})
+    if len(results) == 0:
+        return func(df, params)
+    return pd.concat(results, ignore_index=True)
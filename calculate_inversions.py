@@ -0,0 +1,321 @@
+"""Apply the inversion detection algorithm to the sounding files of each station.
+
+Soundings are read from, and inversions written to, the Parquet stores in
+invclim.store. Stations are spread over a pool of worker processes, one
+task per station; a station's launches are not split between workers. Each
+worker writes its station's inversions on its own, so the output does not depend on the
+number of workers. Failures are reported per station with the traceback.
+
+Results are cached by month in invclim.cache, keyed on the soundings, the
+parameters and algorithm_version, so a rerun only recomputes the months
+whose inputs changed. --dry-run lists those months without computing.
+
+--climatology DIR also feeds the layers of each month, as they are found
+or read from the cache, to the mergeable accumulators of
+invclim.accumulators, combines the stations' accumulators with merge and
+writes the height statistics and layer histograms to DIR.
+
+--profile DIR records the time and counters of each stage for each station
+(see invclim.instrument) in DIR/summary.json and DIR/summary.csv, and with
+--cprofile also dumps the cProfile statistics of each station to
+DIR/<station>.prof.
+
+Usage:
+    python -m invclim.calculate_inversions --workers 8
+    python -m invclim.calculate_inversions --dry-run
+    python -m invclim.calculate_inversions --climatology ../Data/Climatology/
+    python -m invclim.calculate_inversions --profile ../Data/Profile/ --cprofile
+"""
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from . import instrument
+from .accumulators import HeightStatistics, LayerHistograms, accumulate_layers
+from .cache import month_chunks, plan, run_cached
+from .core import merge_interstitial_layers
+from .invfinder import find_inversions_batch, find_inversions_sweep
+from .store import list_stations, read_station, write_station
+
+# Bump when a change to the detection or merge code changes the inversions found,
+# so that cached results are recomputed.
+algorithm_version = 2
+
+params = {'max_embed_depth': 100,
+          'min_dz': 0, # units('m'),
+          'min_dp': 0, # units('hPa'),
+          'min_dt': 0, # units('K'),
+          'min_drh': 0, # units('percent'),
+          'rh_or_dt': False}
+
+# Heights above the lowest level for --climatology, as in the frequency cubes
+climatology_heights = 5 + np.arange(25, 3000, 50)
+
+@instrument.timed()
+def find_inversions(df, params=params):
+    """Runs the batch inversion finder on every sounding in df at once.
+    invfinder still has a merge layers issue, i.e., it doesn't catch when the
+    negative lapse rate should get skipped! merge_interstitial_layers applies
+    the final merge step to all soundings."""
+    inv = find_inversions_batch(
+        df.loc[:, ['date', 'pressure', 'height', 'temperature', 'relative_humidity']], params)
+    return merge_interstitial_layers(inv, params['max_embed_depth'])
+
+
+def parameter_grid(base=params, **choices):
+    """Returns a list of parameter sets: base with each combination of the
+    values given for some of its keys, e.g.
+    parameter_grid(min_dt=[0, 1, 2.5], max_embed_depth=[50, 100])."""
+    names = list(choices)
+    return [dict(base, **dict(zip(names, values)))
+            for values in itertools.product(*[choices[name] for name in names])]
+
+
+def sweep_inversions(df, param_grid):
+    """find_inversions for each parameter set in param_grid, sharing the
+    detection work between parameter sets (see
+    invfinder.find_inversions_sweep). Returns one table with a 'param_set'
+    column giving the position of the parameter set in param_grid."""
+    inv = find_inversions_sweep(
+        df.loc[:, ['date', 'pressure', 'height', 'temperature', 'relative_humidity']], param_grid)
+    max_embed_depth = np.array([params['max_embed_depth'] for params in param_grid])
+    return merge_interstitial_layers(inv, max_embed_depth[inv['param_set'].values],
+                                     launch_columns=['param_set', 'date'])
+
+
+def load_soundings(dataloc, site):
+    """Reads the soundings of one station, up to 5 km above the lowest level."""
+    df = read_station(dataloc, site,
+                      columns=['date', 'pressure', 'height', 'temperature', 'relative_humidity'])
+    if len(df) == 0:
+        raise FileNotFoundError('No soundings stored for ' + site + ' in ' + dataloc)
+    elev = max(0, df.height.min())
+    return df.loc[df.height < elev + 5000].reset_index(drop=True)
+
+
+def calculate_station(site, dataloc, saveloc, params=params, cache_dir=None, heights=None,
+                      by='month'):
+    """Finds the inversions for one station in the sounding store dataloc and
+    writes them to the inversion store saveloc. write_station moves the new
+    files into place at the end, so a failed run never leaves a partial
+    station. With a cache_dir, only the months that changed are recomputed,
+    and nothing is written if the station is up to date. Returns the number
+    of rows written, or None if the station was up to date.
+
+    With heights, a grid above the lowest level, the layers of each month
+    are also added to new accumulators as they are found or read from the
+    cache (see accumulators.accumulate_layers, with groups by), and
+    (rows, statistics, histograms) is returned."""
+    with instrument.timer('calculate_inversions.load'):
+        df = load_soundings(dataloc, site)
+    add = None
+    if heights is not None:
+        statistics, histograms = HeightStatistics(), LayerHistograms()
+        zgrid = max(0, df.height.min()) + np.asarray(heights, dtype=float)
+
+        def add(chunk):
+            with instrument.timer('calculate_inversions.accumulate', rows=len(chunk)):
+                accumulate_layers(chunk, site, zgrid, by, statistics, histograms)
+
+    up_to_date = False
+    if cache_dir is None:
+        inv = find_inversions(df, params)
+        if add is not None:
+            for start, stop in month_chunks(inv).values():
+                add(inv.iloc[start:stop])
+    else:
+        station_cache = os.path.join(cache_dir, site)
+        with instrument.timer('calculate_inversions.plan'):
+            chunks, removed = plan(df, params, algorithm_version, station_cache)
+        up_to_date = (site in list_stations(saveloc) and len(removed) == 0 and
+                      all(chunks[label][3] for label in chunks))
+        if up_to_date and add is None:
+            return None
+        with instrument.timer('calculate_inversions.run_cached'):
+            inv = run_cached(df, find_inversions, params, algorithm_version, station_cache, add)
+
+    rows = None
+    if not up_to_date:
+        with instrument.timer('calculate_inversions.write', rows=len(inv)):
+            write_station(inv, saveloc, site)
+        rows = len(inv)
+    return rows if add is None else (rows, statistics, histograms)
+
+
+def _calculate_station(site, dataloc, saveloc, params, cache_dir, profile_dir=None,
+                       cprofile=False, heights=None, by='month'):
+    """Wrapper for the worker processes: returns (site, rows, traceback,
+    stats, accumulated) so that one failed station doesn't stop the others.
+    With a profile_dir, stats is the instrument snapshot for the station, and
+    with cprofile the cProfile statistics are dumped to
+    profile_dir/<site>.prof. With heights, accumulated is the station's
+    (statistics, histograms) from calculate_station."""
+    def calculate():
+        result = calculate_station(site, dataloc, saveloc, params, cache_dir, heights, by)
+        return (result, None) if heights is None else (result[0], result[1:])
+
+    if profile_dir is None:
+        try:
+            rows, accumulated = calculate()
+            return site, rows, None, None, accumulated
+        except Exception:
+            return site, None, traceback.format_exc(), None, None
+
+    # isolated leaves the caller's registry alone when this runs in the main process
+    with instrument.isolated():
+        try:
+            with instrument.profile(os.path.join(profile_dir, site + '.prof') if cprofile else None):
+                rows, accumulated = calculate()
+            return site, rows, None, instrument.snapshot(), accumulated
+        except Exception:
+            return site, None, traceback.format_exc(), instrument.snapshot(), None
+
+
+def stations_to_calculate(sites, saveloc, recalculate=False):
+    """Find out which stations have already had inversions calculated."""
+    if recalculate:
+        return list(sites)
+    calculated = list_stations(saveloc)
+
+    calculate = []
+    for site in sites:
+        if site in calculated:
+            print('Already calculated', site)
+        else:
+            calculate.append(site)
+    return calculate
+
+
+def dry_run(sites, dataloc, cache_dir, params=params, recalculate=False):
+    """Prints the months that a cached run would recompute for each site,
+    without computing or writing anything. With recalculate, as for a run
+    that clears the cache first, every month is recomputed."""
+    for site in sites:
+        try:
+            chunks, removed = plan(load_soundings(dataloc, site), params, algorithm_version,
+                                   os.path.join(cache_dir, site))
+        except FileNotFoundError as error:
+            print(site, error)
+            continue
+        stale = [label for label in chunks if recalculate or not chunks[label][3]]
+        print(site, len(stale), 'of', len(chunks), 'months to recompute',
+              ' '.join(stale), '| removed: ' + ' '.join(removed) if removed else '')
+
+
+def run_stations(sites, dataloc, saveloc, params=params, workers=1, cache_dir=None,
+                 profile_dir=None, cprofile=False, heights=None, by='month'):
+    """Calculates the inversions for each site, using a pool of worker
+    processes if workers > 1. Results are reported as each station finishes.
+    With a profile_dir, the stage timings of each station and of all of them
+    ('all') are written there by instrument.write_summary, and with cprofile
+    the cProfile statistics of each station too.
+    Returns a dictionary with the traceback of each failed station.
+
+    With heights, each station also accumulates the statistics of its layers
+    month by month (see calculate_station), the accumulators of the stations
+    are combined with merge as they finish, and (failed, statistics,
+    histograms) is returned."""
+    failed = {}
+    by_station = {}
+    statistics, histograms = HeightStatistics(), LayerHistograms()
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def report(site, n_rows, error, stats, accumulated):
+        nonlocal statistics, histograms
+        if error is None:
+            print(site, 'up to date' if n_rows is None else str(n_rows) + ' rows')
+        else:
+            print(site + ' find inversions failed\n' + error, file=sys.stderr)
+            failed[site] = error
+        if stats is not None:
+            by_station[site] = stats
+        if accumulated is not None:
+            statistics = statistics.merge(accumulated[0])
+            histograms = histograms.merge(accumulated[1])
+
+    if workers <= 1:
+        for site in sites:
+            report(*_calculate_station(site, dataloc, saveloc, params, cache_dir, profile_dir,
+                                       cprofile, heights, by))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_calculate_station, site, dataloc, saveloc, params, cache_dir,
+                                   profile_dir, cprofile, heights, by)
+                       for site in sites]
+            for future in as_completed(futures):
+                report(*future.result())
+
+    if profile_dir is not None:
+        total = {}
+        for stats in by_station.values():
+            instrument.merge(stats, total)
+        instrument.write_summary(profile_dir, dict(by_station, all=total))
+    return failed if heights is None else (failed, statistics, histograms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--stations', default='../Data/arctic_stations_long.csv',
+                        help='station list with a station_id column')
+    parser.add_argument('--dataloc', default='../Data/Soundings/',
+                        help='sounding store (see invclim.store)')
+    parser.add_argument('--saveloc', default='../Data/Inversions/',
+                        help='inversion store (see invclim.store)')
+    parser.add_argument('--cache', default='../Data/Cache/Inversions/',
+                        help='folder for the per-month result cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='skip stations that already have inversions instead of using the cache')
+    parser.add_argument('--recalculate', action='store_true',
+                        help='recalculate all stations, clearing their cache')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the months that would be recomputed and exit')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write the time and counters of each stage per station to DIR')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='with --profile, also dump cProfile statistics for each station')
+    parser.add_argument('--climatology', metavar='DIR',
+                        help='accumulate the height statistics and layer histograms of the '
+                             'stations calculated, by calendar month, and write them to DIR')
+    args = parser.parse_args(argv)
+
+    sites = pd.read_csv(args.stations).station_id.values
+    if args.no_cache:
+        cache_dir = None
+        calculate = stations_to_calculate(sites, args.saveloc, args.recalculate)
+    else:
+        cache_dir = args.cache
+        calculate = list(sites)
+        if args.recalculate and not args.dry_run:
+            for site in calculate:
+                shutil.rmtree(os.path.join(cache_dir, site), ignore_errors=True)
+
+    if args.dry_run:
+        dry_run(calculate, args.dataloc, args.cache, params, args.recalculate)
+        return 0
+    if args.climatology is None:
+        failed = run_stations(calculate, args.dataloc, args.saveloc, params, args.workers,
+                              cache_dir, args.profile, args.cprofile)
+    else:
+        failed, statistics, histograms = run_stations(
+            calculate, args.dataloc, args.saveloc, params, args.workers, cache_dir, args.profile,
+            args.cprofile, climatology_heights)
+        os.makedirs(args.climatology, exist_ok=True)
+        statistics.to_frame().to_csv(os.path.join(args.climatology, 'height_statistics.csv'))
+        histograms.to_frame().to_csv(os.path.join(args.climatology, 'layer_histograms.csv'),
+                                     index=False)
+    if failed:
+        print('Failed stations:', ', '.join(sorted(failed)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
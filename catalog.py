@@ -0,0 +1,165 @@
+"""Station catalog: sounding statistics of each station for setup_station_list.
+
+The statistics only need the launch dates and the number of levels of each
+launch, which are read from the launch index of the archive (launches.npy,
+see invclim.launches, or date.npy and offsets.npy for archives without one)
+or from the date column of the sounding store (see invclim.store). Launches are counted by
+station and month for all stations at once, and the statistics are
+computed from those counts:
+
+* n_levels: mean over months of the monthly mean number of levels per launch
+* n00Z, n12Z: launches at 23-01Z and at 11-13Z
+* n_missing_months: months without launches, from the first to the last
+  month with launches at any of the stations
+* n_missing_months_post_<year>: the same, from the date post on
+
+The monthly counts of each station are cached in a JSON file together with
+a fingerprint of the station's files (names, sizes and modification times)
+and the period, so a rebuild only reads the stations that changed.
+"""
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from .archive import SoundingArchive
+from .core import launch_offsets
+from .store import read_station
+
+
+def station_files(root, station):
+    """The files the launches of station are read from: the archive's
+    launches.npy, or date.npy and offsets.npy, or the Parquet files of the
+    sounding store. Empty if the station isn't stored under root."""
+    archive = os.path.join(root, station)
+    if os.path.isfile(os.path.join(archive, 'launches.npy')):
+        return [os.path.join(archive, 'launches.npy')]
+    if os.path.isfile(os.path.join(archive, 'offsets.npy')):
+        return [os.path.join(archive, 'date.npy'), os.path.join(archive, 'offsets.npy')]
+    return sorted(glob.glob(os.path.join(root, 'station=' + station, '*', '*.parquet')))
+
+
+def fingerprint(root, paths, *extra):
+    """sha256 of the names (relative to root), sizes and modification times
+    of paths, and of the items of extra."""
+    key = hashlib.sha256()
+    for item in extra:
+        key.update(str(item).encode())
+    for path in paths:
+        stat = os.stat(path)
+        key.update('{} {} {}'.format(os.path.relpath(path, root), stat.st_size,
+                                     stat.st_mtime_ns).encode())
+    return key.hexdigest()
+
+
+def read_launches(root, station, start=None, end=None):
+    """Dates and number of levels of the launches of station with start <=
+    date <= end, from the archive or the sounding store under root."""
+    if os.path.isfile(os.path.join(root, station, 'offsets.npy')):
+        archive = SoundingArchive(root, station)
+        first, last = archive.date_range(start, end)
+        if archive.launches is not None:
+            launches = archive.launches[first:last]
+            return np.asarray(launches['date']), np.asarray(launches['n_levels'])
+        return np.asarray(archive.dates[first:last]), np.diff(archive.offsets[first:last + 1])
+    dates = read_station(root, station, columns=['date'], start=start, end=end)['date'].values
+    offsets = launch_offsets(dates)
+    return dates[offsets[:-1]], np.diff(offsets)
+
+
+def monthly_counts(station, dates, n_levels, n_stations, months):
+    """Counts for the launches with the given station number, date and
+    number of levels: launches and levels (n_stations x months) in each of
+    the datetime64[M] months, and launches near 00Z and 12Z per station."""
+    month = (dates.astype('datetime64[M]') - months[0]).astype(int)
+    key = station * len(months) + month
+    size = n_stations * len(months)
+    launches = np.bincount(key, minlength=size).reshape(n_stations, len(months))
+    levels = np.bincount(key, weights=n_levels, minlength=size).reshape(n_stations, len(months))
+    hour = dates.astype('datetime64[h]').astype(int) % 24
+    n00 = np.bincount(station, weights=(hour == 23) | (hour < 2), minlength=n_stations)
+    n12 = np.bincount(station, weights=(hour > 10) & (hour < 14), minlength=n_stations)
+    return launches, levels, n00.astype(int), n12.astype(int)
+
+
+def summarize(launches, levels, months, post):
+    """The catalog statistics from the monthly counts of monthly_counts."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        monthly_levels = levels / launches
+    observed = launches > 0
+    n_levels = np.where(observed.any(axis=1),
+                        np.nansum(np.where(observed, monthly_levels, 0), axis=1) /
+                        np.maximum(observed.sum(axis=1), 1), 0)
+
+    # Months from the first to the last with launches at any station
+    any_launch = np.flatnonzero(observed.any(axis=0))
+    span = slice(any_launch[0], any_launch[-1] + 1) if len(any_launch) else slice(0, 0)
+    missing = ~observed[:, span]
+    after = months[span] >= np.datetime64(post, 'M')
+    return {'n_levels': np.round(n_levels).astype(int),
+            'n_missing_months': missing.sum(axis=1),
+            'n_missing_months_post_' + str(pd.Timestamp(post).year): missing[:, after].sum(axis=1)}
+
+
+def read_cache(path):
+    """The cached counts by station, or an empty dictionary."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_cache(path, cache):
+    """Writes the cache under a temporary name and moves it into place."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+
+def build_catalog(root, stations, start='2000-01-01 00:00', end='2019-12-31 23:00',
+                  post='2005-01-01', cache_path=None):
+    """Catalog of the stations stored under root (archive or sounding store)
+    for the launches with start <= date <= end. Returns a DataFrame indexed
+    by station_id with the columns described in the module docstring;
+    stations that aren't stored are left out. With a cache_path, the counts
+    of stations whose files haven't changed are taken from the cache there."""
+    months = np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1)
+    cache = {} if cache_path is None else read_cache(cache_path)
+
+    stored, keys, stale = [], {}, []
+    for station in stations:
+        files = station_files(root, station)
+        if len(files) == 0:
+            continue
+        stored.append(station)
+        keys[station] = fingerprint(root, files, start, end)
+        if cache.get(station, {}).get('fingerprint') != keys[station]:
+            stale.append(station)
+
+    if stale:
+        launches = [read_launches(root, station, start, end) for station in stale]
+        number = np.repeat(np.arange(len(stale)), [len(dates) for dates, n_levels in launches])
+        counts = monthly_counts(number, np.concatenate([dates for dates, n_levels in launches]),
+                                np.concatenate([n_levels for dates, n_levels in launches]),
+                                len(stale), months)
+        for ii, station in enumerate(stale):
+            cache[station] = {'fingerprint': keys[station], 'launches': counts[0][ii].tolist(),
+                              'levels': counts[1][ii].tolist(), 'n00Z': int(counts[2][ii]),
+                              'n12Z': int(counts[3][ii])}
+        if cache_path is not None:
+            write_cache(cache_path, cache)
+
+    catalog = pd.DataFrame(index=pd.Index(stored, name='station_id'))
+    launches = np.array([cache[station]['launches'] for station in stored]).reshape(
+        len(stored), len(months))
+    levels = np.array([cache[station]['levels'] for station in stored]).reshape(
+        len(stored), len(months))
+    for name, values in summarize(launches, levels, months, post).items():
+        catalog[name] = values
+    catalog['n00Z'] = [cache[station]['n00Z'] for station in stored]
+    catalog['n12Z'] = [cache[station]['n12Z'] for station in stored]
+    return catalog.loc[:, ['n_levels', 'n00Z', 'n12Z'] +
+                       [cc for cc in catalog.columns if cc.startswith('n_missing')]]
@@ -5,36 +5,126 @@ data to back up a choice for height threshold. I set it at 75, but that partiall
 Nice but not necessary: integrate metpy units throughout.
 """
 import numpy as np
-from scipy.interpoalte import interp1d
-import core
-
-def cloud_finder(data):
-    """Implementation of cloud detection algorithm from Zhang et al. 2013)."""
-    
-    def min_rh(z):
-        """minimum relative humidity threshold for radiosonde cloud detection
-        based on Zhang et al 2013."""
-        xp = np.array([0,2,6,12])*1000 # height in meters
-        fp = np.array([92,90,88,75])
-        return interp1d(xp, fp, bounds_error=False, fill_value=75)(z)
-
-    def max_rh(z):
-        """maximum within-layer relative humidity threshold to classify layer as 
-        cloud based on Zhang et al 2013."""
-        xp = np.array([0,2,6,12])*1000 # height in meters
-        fp = np.array([95,93,90,80])
-        return interp1d(xp, fp, bounds_error=False, fill_value=75)(z)
-
-    def int_rh(z):
-        """minimum relative humidity threshold for merged interstitial layers 
-        based on Zhang et al 2013. Discontinuity at 2 km in paper removed."""
-        xp = np.array([0,2,6,12])*1000 # height in meters
-        fp = np.array([84,81,78,70])
-        return interp1d(xp, fp, bounds_error=False, fill_value=70)(z)
-
-    def init_sign_vector_cloud(rh, z, height_thresh=0):
-        """Flags potential cloud layers. rh is relative humidity and
-        z is height in meters."""
-        return (rh >  min_rh(z)) & (z >= z.min() + height_thresh)
-
-    return init_sign_vector_cloud(data['adjusted_relative_humidity'], data['z'], height_thresh=75)
\ No newline at end of file
+from .core import reduce_ranges, select_layers, select_layers_batch, setup_batch, sounding_columns
+from .instrument import count, timed
+from .layers import LayerRecords
+
+# Relative humidity thresholds from Zhang et al. 2013, as a function of height in meters.
+# Values outside the table use the fill value, as the interp1d version did.
+threshold_height = np.array([0, 2, 6, 12]) * 1000
+min_rh_table = np.array([92, 90, 88, 75])
+max_rh_table = np.array([95, 93, 90, 80])
+int_rh_table = np.array([84, 81, 78, 70])
+
+default_params = {'height_thresh': 75,    # m above the lowest level
+                  'max_gap': 300,         # m
+                  'min_thickness': 30.5}  # m
+
+def min_rh(z):
+    """minimum relative humidity threshold for radiosonde cloud detection
+    based on Zhang et al 2013."""
+    return np.interp(z, threshold_height, min_rh_table, left=75, right=75)
+
+def max_rh(z):
+    """maximum within-layer relative humidity threshold to classify layer as
+    cloud based on Zhang et al 2013."""
+    return np.interp(z, threshold_height, max_rh_table, left=75, right=75)
+
+def int_rh(z):
+    """minimum relative humidity threshold for merged interstitial layers
+    based on Zhang et al 2013. Discontinuity at 2 km in paper removed."""
+    return np.interp(z, threshold_height, int_rh_table, left=70, right=70)
+
+def init_sign_vector_cloud(rh, z, height_thresh=0):
+    """Flags potential cloud layers. rh is relative humidity and
+    z is height in meters."""
+    return (rh > min_rh(z)) & (z >= np.nanmin(z) + height_thresh)
+
+
+@timed(soundings=1)
+def cloud_finder(data, params=default_params):
+    """Implementation of cloud detection algorithm from Zhang et al. 2013).
+    data can be a Dataset from core.setup_dataset or a Sounding from
+    core.setup_sounding. Returns the cloud layers in the same format as
+    invfinder, numbered by cloud_number."""
+    columns, date = sounding_columns(data)
+    sounding, idxb, idxt = find_cloud_levels_ragged(
+        [0, len(columns['height'])], columns['adjusted_relative_humidity'], columns['height'],
+        params)
+    return select_layers(idxb, idxt, columns, date, index_name='cloud_number')
+
+
+def find_cloud_levels_ragged(offsets, rh, z, params=default_params):
+    """Array engine behind cloud_finder, for many soundings stored end to end
+    in flat arrays, with sounding i in offsets[i]:offsets[i+1]. rh is the
+    adjusted relative humidity and z is height in meters.
+
+    1. Levels with rh above min_rh and at least height_thresh above the lowest
+       level of the sounding are moist. Each run of moist levels is a moist
+       layer with base at the first and top at the last level of the run.
+    2. A moist layer is a cloud layer if its maximum rh is above max_rh at its base.
+    3. Neighboring cloud layers are merged if they are less than max_gap apart,
+       or if the minimum rh between them is above the largest int_rh there.
+    4. Cloud layers thinner than min_thickness are dropped.
+
+    Returns the sounding number of each cloud layer and the flat base and top
+    level indices."""
+
+    offsets = np.asarray(offsets)
+    n_levels = np.diff(offsets)
+    sounding = np.repeat(np.arange(len(n_levels)), n_levels)
+    first = offsets[:-1][n_levels > 0]
+    z_sfc = reduce_ranges(np.fmin, z, first, offsets[1:][n_levels > 0])
+
+    z_min = np.repeat(z_sfc, n_levels[n_levels > 0]) + params['height_thresh']
+    moist = (rh > min_rh(z)) & (z >= z_min)
+    start = moist.copy()
+    start[1:] &= ~moist[:-1] | (sounding[1:] != sounding[:-1])
+    stop = moist.copy()
+    stop[:-1] &= ~moist[1:] | (sounding[1:] != sounding[:-1])
+    idxb, = np.nonzero(start)
+    idxt, = np.nonzero(stop)
+
+    cloud = reduce_ranges(np.maximum, rh, idxb, idxt + 1) > max_rh(z[idxb])
+    idxb = idxb[cloud]
+    idxt = idxt[cloud]
+
+    # gaps between consecutive cloud layers of the same sounding
+    same = sounding[idxb[1:]] == sounding[idxt[:-1]]
+    gap_start = idxt[:-1][same] + 1
+    gap_stop = idxb[1:][same]
+    merge = np.zeros(len(idxb), dtype=bool)
+    merge[1:][same] = (z[gap_stop] - z[gap_start - 1] < params['max_gap']) | (
+        reduce_ranges(np.fmin, rh, gap_start, gap_stop) >
+        reduce_ranges(np.fmax, int_rh(z), gap_start, gap_stop))
+    last = np.ones(len(idxb), dtype=bool)
+    last[:-1] = ~merge[1:]
+    idxb = idxb[~merge]
+    idxt = idxt[last]
+
+    thick = z[idxt] - z[idxb] >= params['min_thickness']
+    return sounding[idxb[thick]], idxb[thick], idxt[thick]
+
+
+@timed()
+def find_clouds_batch(df, params=default_params,
+                      variables=['pressure', 'height', 'temperature', 'relative_humidity',
+                                 'adjusted_relative_humidity']):
+    """Runs cloud_finder on every sounding in a long-format dataframe with a
+    'date' column and one row per level, without a groupby. Returns one flat
+    dataframe with a row per (date, cloud_number), laid out like
+    invfinder.find_inversions_batch."""
+
+    offsets, columns, dates = setup_batch(df, variables)
+    count('cloudfinder.find_clouds_batch', soundings=len(dates))
+    sounding, idxb, idxt = find_cloud_levels_ragged(
+        offsets, columns['adjusted_relative_humidity'], columns['height'], params)
+    return select_layers_batch(sounding, idxb, idxt, columns, dates, index_name='cloud_number')
+
+
+def find_cloud_records(offsets, columns, dates, params=default_params):
+    """find_clouds_batch for soundings already in the layout of
+    core.setup_batch, returning layers.LayerRecords numbered by cloud_number."""
+    sounding, idxb, idxt = find_cloud_levels_ragged(
+        offsets, columns['adjusted_relative_humidity'], columns['height'], params)
+    return LayerRecords.from_levels(sounding, idxb, idxt, columns, dates, index_name='cloud_number')
@@ -1,9 +1,22 @@
-"""Utilities used by the main functions in the module."""
+"""Utilities used by the main functions in the module.
+
+Only numpy is imported with the module. pandas, xarray and metpy are imported
+by the functions that build or take DataFrames and Datasets, so the array
+code paths, e.g. in worker processes, don't pay for importing them."""
 import numpy
-import pandas
+from .instrument import count, timed
+
+sounding_units = {'height': 'm',
+                  'temperature': 'K',
+                  'pressure': 'hPa',
+                  'relative_humidity': 'percent',
+                  'adjusted_relative_humidity': 'percent'}
 
+@timed(soundings=1)
 def setup_dataset(df):
     """Converts pandas dataframe into xarray dataset."""
+    import metpy.xarray  # registers the .metpy accessor
+
     ds = df.to_xarray()
     ds['height'].attrs['units'] = 'm'
     ds['temperature'].attrs['units'] = 'K'
@@ -13,12 +26,109 @@ def setup_dataset(df):
     ds = ds.metpy.quantify()
     return ds
 
+@timed(soundings=1)
+def setup_sounding(df, units=sounding_units):
+    """Converts pandas dataframe into a Sounding. Cheaper than setup_dataset
+    since nothing is copied into xarray or wrapped in pint, so this is the one
+    to use on the detection path."""
+    variables = {cc: numpy.ascontiguousarray(df[cc].values, dtype=float)
+                 for cc in df.columns if (cc != 'date')}
+    return Sounding(df['date'].values[0], variables,
+                    {cc: units[cc] for cc in units if cc in variables})
+
+
+@timed()
+def setup_batch(df, variables):
+    """Converts a long-format dataframe with a 'date' column and one row per
+    level into flat numpy arrays for the batch finders. Levels of each launch
+    should be ordered from the surface up; launches are sorted by date if
+    needed. Returns the launch offsets (see launch_offsets), a dictionary with
+    the level index within each launch and one array per variable, and the
+    date of each launch."""
+    dates = df['date'].values
+    if numpy.any(dates[1:] < dates[:-1]):
+        order = numpy.argsort(dates, kind='stable')
+        df = df.iloc[order]
+        dates = dates[order]
+    offsets = launch_offsets(dates)
+    n_levels = numpy.diff(offsets)
+    count('core.setup_batch', soundings=len(n_levels))
+
+    columns = {'index': numpy.arange(len(dates)) - numpy.repeat(offsets[:-1], n_levels)}
+    for cc in variables:
+        columns[cc] = df[cc].to_numpy(dtype=float)
+    return offsets, columns, dates[offsets[:-1]]
+
+
+class Sounding:
+    """Lightweight container for a single sounding: the launch date, one
+    contiguous float array per variable ordered from the surface up, and a
+    record of the units of each variable. Variables can be accessed as
+    items or attributes. invfinder and cloud_finder accept it in place of
+    the Dataset from setup_dataset."""
+    __slots__ = ('date', 'variables', 'units')
+
+    def __init__(self, date, variables, units):
+        self.date = date
+        self.variables = variables
+        self.units = units
+
+    def __getattr__(self, name):
+        if name in Sounding.__slots__:
+            raise AttributeError(name)
+        try:
+            return self.variables[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def __len__(self):
+        return len(next(iter(self.variables.values()))) if self.variables else 0
+
+    def to_dataframe(self):
+        """Returns the sounding as a pandas dataframe with a 'date' column."""
+        import pandas
+
+        df = pandas.DataFrame(self.variables)
+        df.insert(0, 'date', self.date)
+        return df
+
+    def to_dataset(self):
+        """Returns the sounding as a metpy-quantified xarray dataset, with
+        the units from the units record."""
+        import metpy.xarray  # registers the .metpy accessor
+
+        ds = self.to_dataframe().to_xarray()
+        for cc in self.units:
+            ds[cc].attrs['units'] = self.units[cc]
+        return ds.metpy.quantify()
+
+def numpy_values(var):
+    """Returns the magnitude of a (possibly quantified) xarray variable as a numpy array."""
+    return numpy.asarray(getattr(var.data, 'magnitude', var.data))
+
+def sounding_columns(data):
+    """Returns a dictionary with a numpy array for the level index and for
+    each variable in data, plus the launch date. data can be a Sounding or a
+    Dataset from setup_dataset."""
+    if isinstance(data, Sounding):
+        columns = {'index': numpy.arange(len(data))}
+        columns.update(data.variables)
+        return columns, data.date
+
+    variables = [cc for cc in data.variables if (cc != 'date')]
+    columns = {cc: numpy_values(data.variables[cc]) for cc in variables}
+    return columns, data.date.values[0]
+
 def build_layer_df(index_vector, data):
     """Selects the data at the top and bottom of layers of constant sign
     based on the sign vector and differences the variables in data across
     the layer. index_vector should be a list, and data should be an xarray
     dataset. Returns a pandas DataFrame."""
-    
+    import pandas
+
     idxb = numpy.array(index_vector[:-1])
     idxt = numpy.array(index_vector[1:])
     layer_dict = {}
@@ -55,3 +165,215 @@ def merge_layers(index_list, layer_df, check_var, threshold, upper=True):
         
     for idx in range(len(remove_list)):
         index_list.remove(remove_list[idx])
+
+
+def launch_offsets(dates):
+    """Returns the offsets of each launch in an array of dates in which the
+    levels of each launch are contiguous, so that launch i is stored in
+    offsets[i]:offsets[i+1]."""
+
+    dates = numpy.asarray(dates)
+    if len(dates) == 0:
+        return numpy.zeros(1, dtype=int)
+    start, = numpy.nonzero(dates[1:] != dates[:-1])
+    return numpy.concatenate([[0], start + 1, [len(dates)]])
+
+
+def sign_change_index(temperature, offsets):
+    """Array version of the index list used by invfinder, for many soundings
+    stored end to end in temperature with launch offsets as in launch_offsets.
+    For each sounding, returns the first level, every level where the sign of
+    the temperature difference to the next level changes, and the last level.
+    As in the original list, the last level appears twice when the top layer
+    has a nonnegative lapse rate. Returns the flat level indices and the
+    sounding number of each entry."""
+
+    offsets = numpy.asarray(offsets)
+    n_levels = numpy.diff(offsets)
+    first = offsets[:-1][n_levels > 0]
+    last = offsets[1:][n_levels > 0] - 1
+
+    nonnegative = numpy.zeros(len(temperature), dtype=bool)
+    nonnegative[:-1] = numpy.diff(temperature) >= 0
+    nonnegative[last] = False
+    change = numpy.zeros(len(temperature), dtype=bool)
+    change[1:] = nonnegative[1:] != nonnegative[:-1]
+    change[first] = False
+
+    index = numpy.sort(numpy.concatenate([first, numpy.nonzero(change)[0], last]))
+    sounding = numpy.repeat(numpy.arange(len(n_levels)), n_levels)
+    return index, sounding[index]
+
+
+@timed()
+def merge_embedded_layers(index, sounding, temperature, height, max_embed_depth):
+    """Array version of the build_layer_df/merge_layers loop in invfinder.
+    Negative lapse rate layers thinner than max_embed_depth are removed from
+    the index array until none are left. The first and last negative lapse rate
+    layers of each sounding are never removed. index and sounding are the output
+    of sign_change_index, and temperature and height should be numpy arrays."""
+
+    iterations = 0
+    while True:
+        iterations += 1
+        idxb = index[:-1]
+        idxt = index[1:]
+        layer = sounding[:-1] == sounding[1:]
+        negative, = numpy.nonzero(layer & (temperature[idxt] - temperature[idxb] < 0))
+
+        new_sounding = numpy.ones(len(negative) + 1, dtype=bool)
+        new_sounding[1:-1] = sounding[negative[1:]] != sounding[negative[:-1]]
+        embedded = negative[~new_sounding[:-1] & ~new_sounding[1:]]
+        embedded = embedded[height[idxt[embedded]] - height[idxb[embedded]] < max_embed_depth]
+        if len(embedded) == 0:
+            count('core.merge_embedded_layers', iterations=iterations)
+            return index, sounding
+
+        # list.remove drops the first occurrence, so the same is done here
+        remove_list = numpy.unique(numpy.concatenate([idxb[embedded], idxt[embedded]]))
+        keep = numpy.ones(len(index), dtype=bool)
+        keep[numpy.searchsorted(index, remove_list)] = False
+        index = index[keep]
+        sounding = sounding[keep]
+
+
+@timed()
+def interstitial_merges(same_launch, base, top, max_embed_depth):
+    """Boolean array, True for the layers that merge_interstitial_layers
+    merges into the layer below, from the base and top height of each layer,
+    with the layers of each launch in order, and same_launch, True for the
+    layers in the same launch as the layer before. max_embed_depth can be a
+    number or an array with a value for each layer."""
+    max_embed_depth = numpy.asarray(max_embed_depth)
+    if max_embed_depth.ndim > 0:
+        max_embed_depth = max_embed_depth[1:]
+    gap = base[1:] - top[:-1]
+    merge = numpy.array(same_launch, dtype=bool)
+    if len(merge):
+        merge[0] = False
+    launch = numpy.cumsum(~merge) - 1
+    # The iterative merge merged the lowest gap up to max_embed_depth while any
+    # thinner gap was left, so a gap equal to it is merged if a thinner one
+    # follows in the same launch
+    thinner = numpy.flatnonzero(merge[1:] & (gap < max_embed_depth)) + 1
+    last_thinner = numpy.full(launch[-1] + 1 if len(launch) else 0, -1)
+    numpy.maximum.at(last_thinner, launch[thinner], thinner)
+    position = numpy.arange(1, len(merge))
+    merge[1:] &= ((gap < max_embed_depth) |
+                  ((gap == max_embed_depth) & (position < last_thinner[launch[1:]])))
+    return merge
+
+
+def merge_interstitial_layers(layer_df, max_embed_depth, index_name='inv_number',
+                              launch_columns=['date']):
+    """Merges neighboring layers of the same launch that are separated by an
+    interstitial layer thinner than max_embed_depth, the final merge step that
+    invfinder doesn't do itself. The merged layer keeps the _base columns of
+    the lowest layer and the _top columns of the highest, and layers are
+    renumbered from 1. layer_df can be the output of invfinder (one launch,
+    indexed by index_name) or a flat table from find_inversions_batch, with
+    the layers of each launch in order. All merges are done in one pass,
+    with the result of merging one interstitial layer at a time until none
+    is thinner than max_embed_depth: a layer exactly max_embed_depth thick
+    is merged too if a thinner one lies above it in the same launch.
+    Rows belong to the same launch if they match in all launch_columns.
+    max_embed_depth can also be an array with a value for each row."""
+
+    single = layer_df.index.name == index_name
+    if single:
+        layer_df = layer_df.reset_index()
+
+    def new_launch(df):
+        new = numpy.ones(len(df), dtype=bool)
+        new[1:] = False
+        for cc in launch_columns:
+            values = df[cc].values
+            new[1:] |= values[1:] != values[:-1]
+        return new
+
+    merge = interstitial_merges(~new_launch(layer_df), layer_df['height_base'].values,
+                                layer_df['height_top'].values, max_embed_depth)
+    count('core.merge_interstitial_layers', layers=len(layer_df), merges=numpy.count_nonzero(merge))
+
+    if numpy.any(merge):
+        first, = numpy.nonzero(~merge)
+        last = numpy.append(first[1:], len(layer_df)) - 1
+        merged = layer_df.iloc[first].reset_index(drop=True)
+        for cc in [cc for cc in layer_df.columns if cc.endswith('_top')]:
+            merged[cc] = layer_df[cc].values[last]
+
+        rank = numpy.arange(len(merged))
+        rank -= numpy.maximum.accumulate(numpy.where(new_launch(merged), rank, 0))
+        merged[index_name] = numpy.where(merged[index_name].values == 0, 0, rank + 1)
+        layer_df = merged
+
+    if single:
+        layer_df = layer_df.set_index(index_name)
+    return layer_df
+
+
+def reduce_ranges(ufunc, values, start, stop):
+    """Applies ufunc.reduce to values[start[i]:stop[i]] for every i at once.
+    Every range must contain at least one element."""
+    if len(start) == 0:
+        return values[:0]
+    index = numpy.empty(2 * len(start), dtype=int)
+    index[0::2] = start
+    index[1::2] = stop
+    # reduceat needs every index to be in range, so pad values by one
+    return ufunc.reduceat(numpy.append(values, values[-1:]), index)[0::2]
+
+
+def select_layers(idxb, idxt, columns, date, index_name='inv_number'):
+    """Builds the layer DataFrame returned by invfinder from arrays of base and
+    top level indices. columns should be a dictionary of numpy arrays, one per
+    variable, and date is the launch time. If there are no layers, a single row
+    of NaN is returned so that the launch is still counted."""
+    import pandas
+
+    if len(idxb) == 0:
+        layer_dict = {}
+        for cc in columns:
+            layer_dict[cc + '_base'] = [numpy.nan]
+            layer_dict[cc + '_top'] = [numpy.nan]
+        layer_dict['date'] = numpy.array([date])
+        return pandas.DataFrame(layer_dict, index=pandas.Index([0], name=index_name))
+
+    layer_dict = {}
+    for cc in columns:
+        layer_dict[cc + '_base'] = columns[cc][idxb]
+        layer_dict[cc + '_top'] = columns[cc][idxt]
+    layer_dict['date'] = numpy.full(len(idxb), date)
+    return pandas.DataFrame(layer_dict,
+                            index=pandas.Index(numpy.arange(1, len(idxb) + 1), name=index_name))
+
+
+@timed()
+def select_layers_batch(sounding, idxb, idxt, columns, dates, index_name='inv_number'):
+    """Builds one flat layer DataFrame for many soundings from the flat base and
+    top level indices of each layer and the sounding each belongs to. columns
+    should be a dictionary of flat numpy arrays and dates the launch time of
+    each sounding. As in select_layers, soundings
+    without layers get a single row of NaN with index_name 0."""
+    import pandas
+
+    n_layers = numpy.bincount(sounding, minlength=len(dates))
+    n_rows = numpy.maximum(n_layers, 1)
+    row_start = numpy.cumsum(n_rows) - n_rows
+    rank = numpy.arange(len(sounding)) - (numpy.cumsum(n_layers) - n_layers)[sounding]
+    row = row_start[sounding] + rank
+    empty = numpy.any(n_layers == 0)
+
+    layer_number = numpy.zeros(n_rows.sum(), dtype=int)
+    layer_number[row] = rank + 1
+    layer_dict = {'date': numpy.repeat(numpy.asarray(dates), n_rows),
+                  index_name: layer_number}
+    for cc in columns:
+        values = columns[cc]
+        dtype = numpy.result_type(values.dtype, float) if empty else values.dtype
+        for idx, suffix in [(idxb, '_base'), (idxt, '_top')]:
+            layer_dict[cc + suffix] = numpy.full(len(layer_number), numpy.nan if empty else 0,
+                                                 dtype=dtype)
+            layer_dict[cc + suffix][row] = values[idx]
+    return pandas.DataFrame(layer_dict)
+
@@ -0,0 +1,137 @@
+"""Station x time x height cubes of inversion frequency.
+
+climatology builds an xarray Dataset for many stations of the inversion
+store, on a common grid of heights above ground (the station elevation is
+added to give the grid of each station):
+
+    indicator  (station, time, height)  int8, 1 if a layer covers the height,
+               0 if not, -1 without a launch. time is every 00Z and 12Z;
+               launches within an hour of those are put at the nearest
+               (see launches.synoptic_hour), others are left out. Of two
+               launches for one time, e.g. 23Z and 00Z the next day, the
+               one nearer the hour is kept, the earlier on a tie.
+    frequency  (station, month, height) monthly frequency, NaN in months
+               without launches, from all launches (frequency.monthly_frequency)
+    n          (station, month) number of launches in each month
+    phi        (station, calendar_month, height) lag-1 autocorrelation
+    err        (station, calendar_month, height) standard error of the mean
+               frequency adjusted with phi (frequency.standard_error_adj)
+
+With lazy=True (needs dask) each variable is a dask array with a chunk per
+station, and a station's inversions are only read when its chunk is
+computed, e.g. by write_cube or by selecting a station and loading it.
+write_cube computes with dask's synchronous scheduler, so the stations are
+read one after another and memory use is that of a few stations, whatever
+the number of stations.
+
+    cube = climatology('../Data/Inversions/', stations.index, stations.elevation,
+                       5 + np.arange(25, 3000, 50), '2000-01-01', '2019-12-31 23:00')
+    write_cube(cube, '../Data/Climatology/inversion_frequency.zarr')
+"""
+import contextlib
+import numpy as np
+import xarray as xr
+from .frequency import inversion_indicator, lag1_autocorrelation, monthly_frequency, \
+    standard_error_adj
+from .launches import synoptic_hour
+from .store import read_station
+
+variables = {'indicator': ('int8', ['time', 'height']),
+             'frequency': ('float32', ['month', 'height']),
+             'n': ('int32', ['month']),
+             'phi': ('float32', ['calendar_month', 'height']),
+             'err': ('float32', ['calendar_month', 'height'])}
+
+
+def synoptic_times(start, end):
+    """Every 00Z and 12Z from the day of start to the day of end."""
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1).astype('datetime64[h]')
+    return (days[:, np.newaxis] + np.array([0, 12], dtype='timedelta64[h]')).ravel()
+
+
+def station_cube(root, station, zgrid, times, months, start, end):
+    """Dictionary of the arrays in variables for one station: the layers of
+    the inversion store under root with start <= date <= end on the height
+    grid zgrid (above sea level), the times and months of the cube."""
+    layers = read_station(root, station, columns=['date', 'height_base', 'height_top'],
+                          start=start, end=end)
+    dates, indicator = inversion_indicator(layers, zgrid)
+    cube = {name: np.full([{'time': len(times), 'month': len(months), 'calendar_month': 12,
+                            'height': len(zgrid)}[dim] for dim in dims],
+                          -1 if name == 'indicator' else 0 if name == 'n' else np.nan, dtype=dtype)
+            for name, (dtype, dims) in variables.items()}
+    if len(dates) == 0:
+        return cube
+
+    # A launch at 23Z goes to 00Z of the next day
+    synoptic = synoptic_hour(dates)
+    day = (dates.astype('datetime64[h]') + np.timedelta64(1, 'h')).astype('datetime64[D]')
+    slot = ((day - times[0].astype('datetime64[D]')).astype(int) * 2 + (synoptic == 12))
+    keep, = np.nonzero((synoptic >= 0) & (slot >= 0) & (slot < len(times)))
+    # Of the launches in one slot keep the nearest to the hour (lexsort is stable)
+    distance = np.abs(dates[keep] - times[slot[keep]])
+    order = keep[np.lexsort((distance, slot[keep]))]
+    order = order[np.unique(slot[order], return_index=True)[1]]
+    cube['indicator'][slot[order]] = np.minimum(indicator[order], 1)
+
+    station_months, frequency, counts = monthly_frequency(dates, indicator)
+    position = (station_months - months[0]).astype(int)
+    cube['frequency'][position] = frequency
+    cube['n'][position] = counts
+    cube['phi'][:] = lag1_autocorrelation(dates, indicator)
+    cube['err'][:] = standard_error_adj(frequency, cube['phi'])
+    return cube
+
+
+def climatology(root, stations, elevations, heights, start, end, lazy=True):
+    """Dataset of the cubes described in the module docstring for the
+    stations of the inversion store under root. heights is the grid above
+    ground, elevations the elevation of each station, and start and end
+    either dates or one date per station; the time axes span them all."""
+    stations = list(stations)
+    elevations = np.asarray(elevations, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    start = np.broadcast_to(np.asarray(start, dtype='datetime64[s]'), len(stations))
+    end = np.broadcast_to(np.asarray(end, dtype='datetime64[s]'), len(stations))
+    times = synoptic_times(start.min(), end.max())
+    months = np.arange(start.min().astype('datetime64[M]'), end.max().astype('datetime64[M]') + 1)
+    sizes = {'time': len(times), 'month': len(months), 'calendar_month': 12, 'height': len(heights)}
+
+    if lazy:
+        import dask
+        import dask.array as da
+
+        cubes = [dask.delayed(station_cube)(root, station, elevation + heights, times, months,
+                                            first, last)
+                 for station, elevation, first, last in zip(stations, elevations, start, end)]
+        data = {name: da.stack([da.from_delayed(cube[name], [sizes[dim] for dim in dims], dtype)
+                                for cube in cubes])
+                for name, (dtype, dims) in variables.items()}
+    else:
+        cubes = [station_cube(root, station, elevation + heights, times, months, first, last)
+                 for station, elevation, first, last in zip(stations, elevations, start, end)]
+        data = {name: np.stack([cube[name] for cube in cubes]) for name in variables}
+
+    return xr.Dataset(
+        {name: (['station'] + dims, data[name]) for name, (dtype, dims) in variables.items()},
+        coords={'station': stations, 'elevation': ('station', elevations),
+                'time': times.astype('datetime64[ns]'),
+                'month': months.astype('datetime64[ns]'), 'calendar_month': np.arange(1, 13),
+                'height': heights},
+        attrs={'height': 'm above ground'})
+
+
+def write_cube(cube, path):
+    """Writes the dataset to Zarr if path ends in .zarr, to NetCDF otherwise.
+    Dask arrays are computed with the synchronous scheduler, a chunk at a time."""
+    if cube.chunks:
+        import dask
+
+        scheduler = dask.config.set(scheduler='synchronous')
+    else:
+        scheduler = contextlib.nullcontext()
+    with scheduler:
+        if path.endswith('.zarr'):
+            cube.to_zarr(path, mode='w')
+        else:
+            cube.to_netcdf(path)
@@ -0,0 +1,214 @@
+"""Concurrent download of IGRA2 station files.
+
+Files are fetched from a source by a pool of threads. A source has two
+methods, filename(station) and open(station, offset, validator), so tests
+can serve files from a local folder (DirectorySource) or a local HTTP server
+instead of the NCEI archive (HTTPSource). open returns the stream, the
+offset it starts at and the validator and size of the file it comes from.
+
+Each file is written to a hidden .part file in the destination folder and
+moved into place once complete. If a transfer fails it is retried with
+exponential backoff, continuing from the end of the .part file when the
+source supports it and the file hasn't changed: the validator (ETag or
+Last-Modified for HTTP) and size of the file are kept in the checkpoint
+file, dest/<station>.json, and a transfer is only continued from a file
+with the same validator and size. Otherwise it starts over. The checkpoint
+also lets an interrupted run pick up where it left off and skip stations
+already downloaded.
+"""
+import http.client
+import json
+import os
+import shutil
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+ncei_derived_url = ('https://www.ncei.noaa.gov/data/integrated-global-radiosonde-archive/'
+                    'access/derived-por/')
+
+
+class PermanentError(Exception):
+    """Raised by a source when retrying won't help, e.g. there is no file for the station."""
+
+
+class HTTPSource:
+    """Station files named <station><suffix> under base_url. Transfers are
+    resumed with HTTP range requests when the server supports them."""
+
+    def __init__(self, base_url=ncei_derived_url, suffix='-drvd.txt.zip', timeout=60):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.suffix = suffix
+        self.timeout = timeout
+
+    def filename(self, station):
+        return station + self.suffix
+
+    def open(self, station, offset=0, validator=None):
+        """Returns a binary stream of the file for station, the byte offset
+        it starts at, and the validator (ETag, or Last-Modified without one)
+        and size of the file. The transfer is continued from offset with an
+        If-Range request on validator, and the offset is 0 if the server sent
+        the whole file instead, e.g. because it changed. Without a validator
+        the whole file is requested."""
+        request = urllib.request.Request(self.base_url + self.filename(station))
+        if offset > 0 and validator is not None:
+            request.add_header('Range', 'bytes=' + str(offset) + '-')
+            request.add_header('If-Range', validator)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            if error.code == 416:
+                # The file is shorter than the part already downloaded, so it changed: start over
+                return self.open(station, 0)
+            if 400 <= error.code < 500 and error.code not in (408, 429):
+                raise PermanentError(str(error.code) + ' ' + error.reason + ': ' +
+                                     request.full_url) from error
+            raise
+        etag = response.headers.get('ETag')
+        # A weak ETag can't be used in If-Range
+        if etag is None or etag.startswith('W/'):
+            etag = response.headers.get('Last-Modified')
+
+        if response.status == 206:
+            # Content-Range: bytes <first>-<last>/<size>, size may be *
+            content_range = response.headers.get('Content-Range', '')
+            first, size = content_range.partition(' ')[2].partition('/')[::2]
+            if first.partition('-')[0] != str(offset):
+                response.close()
+                return self.open(station, 0)
+            return response, offset, etag, int(size) if size.isdigit() else None
+        size = response.headers.get('Content-Length')
+        return response, 0, etag, int(size) if size is not None and size.isdigit() else None
+
+
+class DirectorySource:
+    """Station files named <station><suffix> in a local folder."""
+
+    def __init__(self, root, suffix='-drvd.txt.zip'):
+        self.root = root
+        self.suffix = suffix
+
+    def filename(self, station):
+        return station + self.suffix
+
+    def open(self, station, offset=0, validator=None):
+        """As HTTPSource.open, the validator being the size and modification
+        time of the file."""
+        path = os.path.join(self.root, self.filename(station))
+        if not os.path.exists(path):
+            raise PermanentError('No such file: ' + path)
+        f = open(path, 'rb')
+        stat = os.fstat(f.fileno())
+        current = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+        if validator != current or offset > stat.st_size:
+            offset = 0
+        f.seek(offset)
+        return f, offset, current, stat.st_size
+
+
+def read_checkpoint(dest, station):
+    """Returns the checkpoint of station in dest, or an empty one."""
+    try:
+        with open(os.path.join(dest, station + '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_checkpoint(dest, station, checkpoint):
+    """Writes the checkpoint under a temporary name and moves it into place."""
+    path = os.path.join(dest, station + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def download_station(source, station, dest, retries=5, backoff=1.0, force=False,
+                     chunk_size=1 << 20):
+    """Downloads the file for station from source into dest and returns its
+    path. Does nothing if the checkpoint says the file is complete, unless
+    force is True. Transfer errors are retried up to retries times, waiting
+    backoff, 2 * backoff, 4 * backoff, ... seconds in between; the last
+    error, or a PermanentError from the source, is raised."""
+    os.makedirs(dest, exist_ok=True)
+    name = source.filename(station)
+    final = os.path.join(dest, name)
+    part = os.path.join(dest, '.' + name + '.part')
+    checkpoint = read_checkpoint(dest, station)
+    if not force and checkpoint.get('complete') and os.path.exists(final):
+        return final
+    if force and os.path.exists(part):
+        os.remove(part)
+
+    # The validator and size of the file the .part file was downloaded from
+    validator = checkpoint.get('validator')
+    size = checkpoint.get('size')
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            stream, start, current, current_size = source.open(station, offset, validator)
+            if start > 0 and (current != validator or current_size != size):
+                # Not the file the part came from
+                stream.close()
+                stream, start, current, current_size = source.open(station, 0)
+            validator, size = current, current_size
+            write_checkpoint(dest, station, {'file': name, 'complete': False, 'attempts': attempt,
+                                             'validator': validator, 'size': size})
+            with stream, open(part, 'ab' if start > 0 else 'wb') as f:
+                shutil.copyfileobj(stream, f, chunk_size)
+            if size is not None and os.path.getsize(part) != size:
+                if os.path.getsize(part) > size:
+                    os.remove(part)
+                raise IOError('Expected {} bytes, got {}'.format(size, os.path.getsize(part)
+                                                                if os.path.exists(part) else 0))
+            break
+        except PermanentError as error:
+            write_checkpoint(dest, station, {'file': name, 'complete': False,
+                                             'attempts': attempt, 'error': str(error)})
+            raise
+        except (OSError, http.client.HTTPException) as error:
+            write_checkpoint(dest, station, {'file': name, 'complete': False, 'attempts': attempt,
+                                             'error': repr(error), 'validator': validator,
+                                             'size': size,
+                                             'bytes': os.path.getsize(part) if os.path.exists(part) else 0})
+            if attempt > retries:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+    os.replace(part, final)
+    write_checkpoint(dest, station, {'file': name, 'complete': True, 'attempts': attempt,
+                                     'bytes': os.path.getsize(final), 'validator': validator,
+                                     'size': size, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    return final
+
+
+def _download_station(source, station, dest, retries, backoff, force):
+    """Wrapper for the worker threads: returns (station, path, error) so
+    that one failed station doesn't stop the others."""
+    try:
+        return station, download_station(source, station, dest, retries, backoff, force), None
+    except Exception as error:
+        return station, None, repr(error)
+
+
+def download_stations(source, stations, dest, workers=4, retries=5, backoff=1.0, force=False):
+    """Downloads the files for stations with at most workers transfers at a
+    time. Results are reported as each station finishes. Returns a
+    dictionary with the error of each failed station."""
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(_download_station, source, station, dest, retries, backoff, force)
+                   for station in stations]
+        for future in as_completed(futures):
+            station, path, error = future.result()
+            if error is None:
+                print(station, path)
+            else:
+                print('Download failed for site', station, error, file=sys.stderr)
+                failed[station] = error
+    return failed
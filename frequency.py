@@ -0,0 +1,156 @@
+"""Inversion frequency by height.
+
+The indicator matrix has one row per launch and one column per height of a
+grid, with the number of layers covering that height (base <= z < top),
+which is 0 or 1 unless layers overlap. It is built from the flat layer
+table written by calculate_inversions, where launches without a layer have
+a single row with NaN heights. Frequencies are means of the indicator over
+the launches of each month.
+"""
+import numpy as np
+
+seasons = ['DJF', 'MAM', 'JJA', 'SON']
+
+
+def inversion_indicator(layer_df, zgrid, packed=False):
+    """Returns the launch dates (sorted) and the indicator matrix of the
+    layers in layer_df on the increasing height grid zgrid. The matrix is
+    uint8, or with packed=True a bit per height as from np.packbits along
+    rows, which unpack_indicator reverses."""
+    dates, launch = np.unique(layer_df['date'].values, return_inverse=True)
+    return dates, indicator_matrix(launch, len(dates), layer_df['height_base'].to_numpy(dtype=float),
+                                   layer_df['height_top'].to_numpy(dtype=float), zgrid, packed)
+
+
+def indicator_matrix(launch, n_launches, base, top, zgrid, packed=False):
+    """The indicator matrix of inversion_indicator from the launch number
+    (0 to n_launches - 1), base height and top height of each layer. Layers
+    with a NaN height are skipped."""
+    zgrid = np.asarray(zgrid)
+    valid = ~(np.isnan(base) | np.isnan(top))
+
+    # Each layer covers the grid points first <= i < last. Mark +1 at first and
+    # -1 at last in each launch's row and fill the intervals with a running sum.
+    n_columns = len(zgrid) + 1
+    first = np.searchsorted(zgrid, base[valid], side='left')
+    last = np.maximum(first, np.searchsorted(zgrid, top[valid], side='left'))
+    row = launch[valid] * n_columns
+    steps = (np.bincount(row + first, minlength=n_launches * n_columns) -
+             np.bincount(row + last, minlength=n_launches * n_columns))
+    indicator = np.cumsum(steps.reshape(n_launches, n_columns)[:, :-1], axis=1).astype(np.uint8)
+    if packed:
+        return np.packbits(indicator > 0, axis=1)
+    return indicator
+
+
+def unpack_indicator(packed, n_heights):
+    """Unpacks a bit-packed indicator matrix to uint8 0/1."""
+    return np.unpackbits(packed, axis=1, count=n_heights)
+
+
+def group_sums(values, group, n_groups):
+    """Sums the rows of values in each group, for group numbers in
+    increasing order. Returns an (n_groups x n_columns) float array."""
+    sums = np.zeros((n_groups, values.shape[1]))
+    if len(group):
+        start = np.flatnonzero(np.diff(group, prepend=-1))
+        sums[group[start]] = np.add.reduceat(values, start, axis=0, dtype=float)
+    return sums
+
+
+def month_groups(dates):
+    """Returns every month from the first to the last of the sorted dates
+    (datetime64[M]) and the number of each date's month in that list."""
+    months = dates.astype('datetime64[M]')
+    if len(months) == 0:
+        return months, np.zeros(0, dtype=int)
+    all_months = np.arange(months[0], months[-1] + 1)
+    return all_months, (months - months[0]).astype(int)
+
+
+def monthly_frequency(dates, indicator):
+    """Monthly mean of the indicator matrix, as resample('1MS').mean() on
+    the indicator as a DataFrame indexed by the sorted dates. Returns the
+    months, the (n_months x n_heights) frequencies, NaN in months without
+    launches, and the number of launches in each month."""
+    months, group = month_groups(dates)
+    counts = np.bincount(group, minlength=len(months))
+    sums = group_sums(indicator, group, len(months))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frequency = sums / counts[:, np.newaxis]
+    return months, frequency, counts
+
+
+def season_number(months):
+    """Index in seasons of the season of each datetime64[M] month."""
+    return (months.astype(int) + 1) % 12 // 3
+
+
+def seasonal_frequency(months, frequency):
+    """Mean over the months in each season of the monthly frequencies, as
+    used for the seasonal profiles. Months without launches are skipped.
+    Returns a (4 x n_heights) array in the order of seasons."""
+    season = season_number(months)
+    result = np.full((len(seasons), frequency.shape[1]), np.nan)
+    for ii in range(len(seasons)):
+        selected = frequency[season == ii]
+        observed = ~np.isnan(selected)
+        n = observed.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[ii] = np.where(observed, selected, 0).sum(axis=0) / n
+    return result
+
+
+def calendar_groups(dates, by='month'):
+    """Returns the group of each date, 0-11 for calendar months if by is
+    'month', the index in seasons if by is 'season' and the hour (0-23) if
+    by is 'hour', and the number of groups."""
+    if by == 'hour':
+        return dates.astype('datetime64[h]').astype(int) % 24, 24
+    months = dates.astype('datetime64[M]')
+    if by == 'month':
+        return months.astype(int) % 12, 12
+    if by == 'season':
+        return season_number(months), len(seasons)
+    raise ValueError("by must be 'month', 'season' or 'hour', not " + repr(by))
+
+
+def lag1_autocorrelation(dates, indicator, by='month'):
+    """Pearson correlation between the indicator of each launch and of the
+    launch before it in the same calendar month (or season), across all
+    years, for each group and height. This is the phi of get_phi in
+    inversion_frequency_by_height.py. Returns an (n_groups x n_heights)
+    array, NaN where a height is always or never in an inversion."""
+    group, n_groups = calendar_groups(dates, by)
+    order = np.argsort(group, kind='stable')
+    group = group[order]
+    values = indicator[order].astype(float)
+
+    # Pairs of consecutive launches within each group
+    same = group[1:] == group[:-1]
+    pair_group = group[1:][same]
+    previous = values[:-1][same]
+    current = values[1:][same]
+
+    n = np.bincount(pair_group, minlength=n_groups)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        previous -= (group_sums(previous, pair_group, n_groups) / n)[pair_group]
+        current -= (group_sums(current, pair_group, n_groups) / n)[pair_group]
+        covariance = group_sums(previous * current, pair_group, n_groups)
+        variance = (group_sums(previous ** 2, pair_group, n_groups) *
+                    group_sums(current ** 2, pair_group, n_groups))
+        return covariance / np.sqrt(variance)
+
+
+def standard_error_adj(frequency, phi):
+    """Standard error of the mean frequency adjusted for autocorrelation,
+    sqrt(f (1 - f) / n * v) with v = (1 + phi) / (1 - phi), but at least 1.
+    frequency is (n_months x n_heights), with NaN for months without launches,
+    f is its mean over months and n the number of months. phi can be one
+    row per height or several, e.g. the monthly phi, and broadcasts against f."""
+    frequency = np.asarray(frequency)
+    n = len(frequency)
+    mean = np.nanmean(frequency, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        v = np.maximum((1 + np.asarray(phi)) / (1 - np.asarray(phi)), 1)
+    return np.sqrt(mean * (1 - mean) / n * v)
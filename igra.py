@@ -0,0 +1,283 @@
+"""Streaming reader for IGRA2 derived-format station files (<station>-drvd.txt
+or the .zip served by NCEI). Column names and units follow
+siphon.simplewebservice.igra2, so the tables can be used in place of
+IGRAUpperAir.request_data(..., derived=True).
+
+The file is read line by line. Each header is checked against the date and
+hour filters before its data lines are read, so rejected launches are
+skipped without being parsed, and accepted launches are parsed a batch at a
+time into typed arrays. Memory use depends on the batch size, not on the
+size of the file.
+
+Format: https://www.ncei.noaa.gov/data/integrated-global-radiosonde-archive/doc/igra2-derived-format.txt
+"""
+import io
+import itertools
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from . import launches, thermo
+from .core import Sounding
+from .instrument import count, timed
+
+# Missing values: -99999 in the derived format, and the -9999 (missing) and
+# -8888 (removed by quality assurance) of the IGRA2 data format with the
+# derived format's extra digit or without it
+missing = np.array([-99999, -88888, -9999, -8888])
+
+# Nominal hours kept by import_soundings: within an hour of 00Z or 12Z
+synoptic_hours = (23, 0, 1, 11, 12, 13)
+
+# (name, first column, last column, scale) for each header field, 1-based as in the format document
+header_fields = [
+    ('site_id', 2, 12, None),
+    ('year', 14, 17, 1),
+    ('month', 19, 20, 1),
+    ('day', 22, 23, 1),
+    ('hour', 25, 26, 1),
+    ('release_time', 28, 31, 1),
+    ('number_levels', 32, 36, 1),
+    ('precipitable_water', 38, 43, 100),
+    ('inv_pressure', 44, 49, 100),
+    ('inv_height', 50, 55, 1),
+    ('inv_strength', 56, 61, 10),
+    ('mixed_layer_pressure', 62, 67, 100),
+    ('mixed_layer_height', 68, 73, 1),
+    ('freezing_point_pressure', 74, 79, 100),
+    ('freezing_point_height', 80, 85, 1),
+    ('lcl_pressure', 86, 91, 100),
+    ('lcl_height', 92, 97, 1),
+    ('lfc_pressure', 98, 103, 100),
+    ('lfc_height', 104, 109, 1),
+    ('lnb_pressure', 110, 115, 100),
+    ('lnb_height', 116, 121, 1),
+    ('lifted_index', 122, 127, 10),
+    ('showalter_index', 128, 133, 10),
+    ('k_index', 134, 139, 10),
+    ('total_totals_index', 140, 145, 10),
+    ('cape', 146, 151, 1),
+    ('convective_inhibition', 152, 157, 1)]
+
+# (name, scale, units) for the data fields, which are 7 characters wide and separated by a blank
+data_fields = [
+    ('pressure', 100, 'hPa'),
+    ('reported_height', 1, 'm'),
+    ('calculated_height', 1, 'm'),
+    ('temperature', 10, 'K'),
+    ('temperature_gradient', 10, 'K/km'),
+    ('potential_temperature', 10, 'K'),
+    ('potential_temperature_gradient', 10, 'K/km'),
+    ('virtual_temperature', 10, 'K'),
+    ('virtual_potential_temperature', 10, 'K'),
+    ('vapor_pressure', 1000, 'hPa'),
+    ('saturation_vapor_pressure', 1000, 'hPa'),
+    ('reported_relative_humidity', 10, 'percent'),
+    ('calculated_relative_humidity', 10, 'percent'),
+    ('relative_humidity_gradient', 10, 'percent/km'),
+    ('u_wind', 10, 'm/s'),
+    ('u_wind_gradient', 10, '1/s'),
+    ('v_wind', 10, 'm/s'),
+    ('v_wind_gradient', 10, '1/s'),
+    ('refractive_index', 1, 'dimensionless')]
+
+data_units = {name: unit for name, factor, unit in data_fields}
+
+
+def open_derived(path):
+    """Opens a derived-format file, or the first file in a .zip, as text."""
+    if str(path).endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return io.TextIOWrapper(archive.open(archive.namelist()[0]), encoding='ascii')
+    return open(path, encoding='ascii')
+
+
+def scale(values, factor, dtype=float):
+    """Converts the integers in the file to floats in siphon's units, with NaN for missing."""
+    result = values.astype(dtype)
+    if factor != 1:
+        result /= factor
+    # Comparing with each sentinel is several times faster than np.isin
+    is_missing = values == missing[0]
+    for sentinel in missing[1:]:
+        is_missing |= values == sentinel
+    result[is_missing] = np.nan
+    return result
+
+
+def date_key(date, round_up=False):
+    """'YYYY MM DD HH' as written in columns 14-26 of a header, so that
+    launch dates can be compared without parsing them. Times between hours
+    are rounded towards the inside of the range."""
+    date = pd.Timestamp(date)
+    date = date.ceil('h') if round_up else date.floor('h')
+    return date.strftime('%Y %m %d %H')
+
+
+def parse_header(headers):
+    """Parses a list of header lines into a dictionary of arrays, with the
+    launch times in 'date'."""
+    header = {}
+    for name, first, last, factor in header_fields:
+        column = [line[first - 1:last] for line in headers]
+        header[name] = np.array(column) if factor is None else \
+            scale(np.array(column, dtype=np.int32), factor)
+    year, month, day, hour = (header[cc].astype(int) for cc in ['year', 'month', 'day', 'hour'])
+    header['date'] = ((year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1)
+                      ).astype('datetime64[D]') + (day - 1) + hour.astype('timedelta64[h]')
+    header['date'] = header['date'].astype('datetime64[s]')
+    return header
+
+
+@timed()
+def parse_batch(headers, lines, min_pressure, variables, dtype):
+    """Parses the header lines and data lines of a batch of launches into
+    (offsets, columns, dates, header) and drops the levels below
+    min_pressure, and any launch left without levels."""
+    header = parse_header(headers)
+    n_levels = header['number_levels'].astype(int)
+    body = np.fromstring(''.join(lines), dtype=np.int32, sep=' ')
+    if body.size != n_levels.sum() * len(data_fields):
+        raise ValueError('Data lines of the launches at ' + str(header['date'][0]) + ' to ' +
+                         str(header['date'][-1]) + ' do not have ' + str(len(data_fields)) +
+                         ' fields each')
+    body = body.reshape(-1, len(data_fields))
+
+    launch = np.repeat(np.arange(len(headers)), n_levels)
+    if min_pressure is not None:
+        keep = body[:, 0] >= min_pressure * 100
+        body = body[keep]
+        launch = launch[keep]
+        n_levels = np.bincount(launch, minlength=len(headers))
+        if np.any(n_levels == 0):
+            header = {cc: header[cc][n_levels > 0] for cc in header}
+            n_levels = n_levels[n_levels > 0]
+    offsets = np.concatenate([[0], np.cumsum(n_levels)])
+    count('igra.parse_batch', soundings=len(n_levels), levels=offsets[-1])
+
+    columns = {'index': np.arange(offsets[-1]) - np.repeat(offsets[:-1], n_levels)}
+    for ii, (name, factor, unit) in enumerate(data_fields):
+        if variables is None or name in variables:
+            columns[name] = scale(body[:, ii], factor, dtype)
+    return offsets, columns, header['date'], header
+
+
+def iter_batches(path, begin=None, end=None, min_pressure=None, hours=None, variables=None,
+                 batch_size=1000, dtype='float32'):
+    """Reads a derived-format file batch_size launches at a time. Yields
+    (offsets, columns, dates, header) for each batch; the first three are in
+    the layout of core.setup_batch, and header has one array per header
+    field. Only launches with begin <= date <= end and a nominal hour in
+    hours are read, and only the levels with pressure >= min_pressure (hPa).
+    variables limits the data columns returned (all by default)."""
+    begin = None if begin is None else date_key(begin, round_up=True)
+    end = None if end is None else date_key(end)
+    hours = None if hours is None else {'%02d' % hh for hh in hours}
+
+    headers, lines = [], []
+    with open_derived(path) as f:
+        for line in f:
+            n_levels = int(line[31:36])
+            key = line[13:26]
+            if (key[-2:] == '99' or (begin is not None and key < begin) or
+                    (end is not None and key > end) or (hours is not None and key[-2:] not in hours)):
+                for skipped in itertools.islice(f, n_levels):
+                    pass
+                continue
+            headers.append(line)
+            lines.extend(itertools.islice(f, n_levels))
+            if len(headers) == batch_size:
+                yield parse_batch(headers, lines, min_pressure, variables, dtype)
+                headers, lines = [], []
+    if headers:
+        yield parse_batch(headers, lines, min_pressure, variables, dtype)
+
+
+def iter_soundings(path, **kwargs):
+    """Reads a derived-format file one launch at a time as core.Sounding,
+    with the same filters as iter_batches."""
+    for offsets, columns, dates, header in iter_batches(path, **kwargs):
+        variables = [cc for cc in columns if cc != 'index']
+        units = {cc: data_units[cc] for cc in variables}
+        for ii, date in enumerate(dates):
+            yield Sounding(date, {cc: columns[cc][offsets[ii]:offsets[ii + 1]] for cc in variables},
+                           units)
+
+
+@timed()
+def read_derived(path, begin=None, end=None, min_pressure=None, hours=None, variables=None,
+                 dtype=float):
+    """Reads a derived-format file, with the filters of iter_batches, into
+    the data (one row per level) and the header (one row per launch) as
+    DataFrames with a 'date' column."""
+    data, header = [], []
+    for offsets, columns, dates, batch_header in iter_batches(
+            path, begin, end, min_pressure, hours, variables, dtype=dtype):
+        dates = dates.astype('datetime64[ns]')
+        columns = {'date': np.repeat(dates, np.diff(offsets)), **columns}
+        del columns['index']
+        data.append(pd.DataFrame(columns))
+        header.append(pd.DataFrame({**batch_header, 'date': dates}))
+    if len(data) == 0:
+        names = [name for name, factor, unit in data_fields if variables is None or name in variables]
+        return (pd.DataFrame(columns=['date'] + names),
+                pd.DataFrame(columns=[name for name, *rest in header_fields] + ['date']))
+    return pd.concat(data, ignore_index=True), pd.concat(header, ignore_index=True)
+
+
+def import_soundings(path, begin=None, end=None):
+    """Reads the launches between begin and end near 00Z and 12Z from a
+    derived-format file, keeping the levels up to 500 hPa with a relative
+    humidity and the launches with more than 5 of them, with the columns of
+    the sounding store. Adds the dewpoint, the equivalent potential
+    temperature and the relative humidity with respect to ice below 0 C
+    (see invclim.thermo)."""
+    df, header = read_derived(path, begin=begin, end=end, min_pressure=500, hours=synoptic_hours)
+    df = df.drop(['reported_height', 'reported_relative_humidity'], axis=1)
+    df.rename({'calculated_height': 'height',
+               'calculated_relative_humidity': 'relative_humidity'}, axis=1, inplace=True)
+    df['dewpoint_temperature'] = np.round(thermo.dewpoint(df.vapor_pressure.values), 1)
+    df.dropna(axis=0, how='any', subset=['relative_humidity'], inplace=True)
+    df['equivalent_potential_temperature'] = thermo.equivalent_potential_temperature(
+        df.pressure.values, df.temperature.values, df.dewpoint_temperature.values)
+
+    index = launches.launch_index(df)
+    df = df.loc[launches.level_mask(index, launches.select(index, exclude=launches.few_levels))].copy()
+    df['adjusted_relative_humidity'] = thermo.adjusted_relative_humidity(df.temperature.values,
+                                                                         df.vapor_pressure.values)
+    columns = ['pressure', 'height', 'temperature', 'dewpoint_temperature', 'potential_temperature',
+               'equivalent_potential_temperature', 'relative_humidity',
+               'adjusted_relative_humidity', 'u_wind', 'v_wind']
+    return df.loc[:, ['date'] + columns].round({cc: 2 for cc in columns})
+
+
+def write_derived(path, df, station='USM00070026'):
+    """Writes the soundings in the long-format table df (date, and any of
+    pressure, height, temperature, vapor_pressure and relative_humidity) in
+    the derived format, zipped if path ends with .zip. The other fields are
+    missing. For tests and benchmarks."""
+    renamed = {'height': 'calculated_height', 'relative_humidity': 'calculated_relative_humidity'}
+    columns = {renamed.get(cc, cc): cc for cc in df.columns}
+    values = np.full((len(df), len(data_fields)), missing[0], dtype=np.int64)
+    for ii, (name, factor, unit) in enumerate(data_fields):
+        if name in columns:
+            values[:, ii] = np.round(df[columns[name]].values * factor)
+    rows = [' '.join(row) for row in np.char.rjust(values.astype(str), 7).tolist()]
+
+    # The header fields after number_levels are all missing
+    header_values = '%6d' % missing[0] * (len(header_fields) - 7)
+    lines = []
+    first = 0
+    for date, n_levels in df.groupby('date', sort=False).size().items():
+        lines.append('#%-11s %4d %02d %02d %02d %04d%5d ' % (
+            station, date.year, date.month, date.day, date.hour, date.hour * 100, n_levels) +
+            header_values)
+        lines.extend(rows[first:first + n_levels])
+        first += n_levels
+    text = '\n'.join(lines) + '\n'
+    if str(path).endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(os.path.basename(path)[:-4], text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text)
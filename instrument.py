@@ -0,0 +1,172 @@
+"""Per-stage timers and counters for the processing pipeline.
+
+Each stage records its number of calls, its wall time and named counters,
+such as the number of soundings or of merge iterations, in the registry
+stats. Recording is off by default. A disabled timer or counter costs a
+check of the module flag, so the hooks stay in place in the library.
+Times are inclusive: a stage that calls another stage also counts that
+stage's time.
+
+    import invclim.instrument as ins
+    ins.enable()
+    with ins.profile('station.prof'):  # optional cProfile dump
+        ...
+    ins.write_summary('profile/', {'station': ins.snapshot()})
+
+Workers in other processes keep their own registry. They return a
+snapshot, which the parent adds to its registry with merge.
+"""
+import contextlib
+import copy
+import cProfile
+import csv
+import functools
+import json
+import os
+import time
+
+enabled = False
+stats = {}
+
+
+def enable(on=True):
+    """Turns recording on, or off with on=False."""
+    global enabled
+    enabled = on
+
+
+def reset():
+    """Clears the registry."""
+    stats.clear()
+
+
+def add(registry, name, seconds=0., calls=0, **counts):
+    """Adds to the time, calls and counters of stage name in registry."""
+    entry = registry.setdefault(name, {'calls': 0, 'seconds': 0.})
+    entry['calls'] += calls
+    entry['seconds'] += seconds
+    for key, value in counts.items():
+        entry[key] = entry.get(key, 0) + int(value)
+
+
+def record(name, seconds=0., calls=0, **counts):
+    """Adds to stage name in the registry, whether or not recording is enabled."""
+    add(stats, name, seconds, calls, **counts)
+
+
+def count(name, **counts):
+    """Adds to the counters of stage name, e.g. count('core.setup_batch',
+    soundings=100), if recording is enabled."""
+    if enabled:
+        record(name, **counts)
+
+
+class timer:
+    """Context manager recording its block as one call of stage name, with
+    the counters given as keyword arguments."""
+    __slots__ = ('name', 'counts', 'start')
+
+    def __init__(self, name, **counts):
+        self.name = name
+        self.counts = counts
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            record(self.name, time.perf_counter() - self.start, 1, **self.counts)
+            self.start = None
+
+
+def timed(name=None, **counts):
+    """Decorator recording each call of the function as a call of stage name,
+    module.function by default, with the counters given as keyword arguments."""
+    def decorate(func):
+        stage = name or func.__module__.rsplit('.', 1)[-1] + '.' + func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start, 1, **counts)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def profile(path):
+    """Runs the block under cProfile and dumps the statistics to path, which
+    pstats.Stats can read. Does nothing if path is None."""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+@contextlib.contextmanager
+def isolated():
+    """Records the block in an empty registry with recording on, then puts
+    the registry and the flag back as they were. Lets a station be profiled
+    on its own in the calling process, as in a worker."""
+    global enabled
+    saved, was_enabled = copy.deepcopy(stats), enabled
+    stats.clear()
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = was_enabled
+        stats.clear()
+        stats.update(saved)
+
+
+def snapshot():
+    """Copy of the registry, e.g. to return from a worker process."""
+    return copy.deepcopy(stats)
+
+
+def merge(other, registry=None):
+    """Adds a snapshot to registry, by default the module's, and returns it."""
+    registry = stats if registry is None else registry
+    for name, entry in other.items():
+        add(registry, name, **entry)
+    return registry
+
+
+def summary_rows(by_station):
+    """One row per station and stage, largest time first within each
+    station, from a dictionary of snapshots by station."""
+    rows = []
+    for station in sorted(by_station):
+        entries = sorted(by_station[station].items(), key=lambda item: -item[1]['seconds'])
+        rows.extend({'station': station, 'stage': name, **entry} for name, entry in entries)
+    return rows
+
+
+def write_summary(directory, by_station):
+    """Writes summary.json (snapshots by station) and summary.csv (one row
+    per station and stage, with a column for each counter) in directory."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'summary.json'), 'w') as f:
+        json.dump(by_station, f, indent=1, sort_keys=True)
+
+    rows = summary_rows(by_station)
+    counters = sorted({key for row in rows for key in row} - {'station', 'stage', 'calls', 'seconds'})
+    with open(os.path.join(directory, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, ['station', 'stage', 'calls', 'seconds'] + counters)
+        writer.writeheader()
+        writer.writerows(rows)
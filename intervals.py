@@ -0,0 +1,167 @@
+"""Interval index over inversion (or cloud) layers for height and time queries.
+
+LayerIndex answers questions such as "which launches had a layer covering
+500 m in DJF" or "which layers have a base between 200 and 800 m" without
+scanning the layer table:
+
+- Layers are binned by depth into classes that double in depth, and sorted
+  by base within each class. A layer of a class with maximum depth D that
+  covers height z has its base in [z - D, z], so a query is two binary
+  searches per class, for all classes at once, and a check of the
+  candidates found. A class only holds layers deeper than D / 2, so there
+  are about as many false candidates as results: O(log n + k) for k results.
+- The number of layers covering each height of a grid is the number of
+  bases at or below it minus the number of tops at or below it, two binary
+  searches per height.
+- Launches are in date order with the layers of launch i in
+  offsets[i]:offsets[i+1], as in layers.LayerRecords, so a date range is a
+  contiguous block of layers found by binary search.
+
+A query checks the layers of its date range (all by default) directly when
+the candidates are more than a sixteenth of them, since gathering and sorting
+many candidates costs more than one pass over the block. The index pays off
+for selective queries, such as heights above the surface-based layers, and
+for tables of many stations or years.
+
+Heights are those stored with the layers, normally above sea level; add the
+station elevation to query heights above ground.
+"""
+import numpy as np
+from .layers import LayerRecords
+
+min_depth = 8.  # m, maximum depth of the shallowest depth class
+key_step = 1e6  # m, larger than the range of heights plus the deepest layer
+scan_fraction = 1 / 16
+
+
+class LayerIndex:
+    """Static index over the layers of LayerRecords (or of a layer table,
+    see from_frame). Query results are layer positions in the records, in
+    increasing order; dates, launch and number give the launch date, launch
+    number and layer number (from 1) of each layer.
+
+    index = LayerIndex(find_inversion_records(*archive.select()))
+    index.dates[index.stab(elevation + 500, months=[12, 1, 2])]
+    index.base_between(elevation + 200, elevation + 800)
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.launch_dates = records.dates
+        self.offsets = records.offsets
+        self.launch = records.launch_numbers()
+        self.dates = self.launch_dates[self.launch]
+        self.number = records.layer_numbers()
+        self.base = np.asarray(records.base['height'], dtype=float)
+        self.top = np.asarray(records.top['height'], dtype=float)
+
+        valid = np.flatnonzero(~(np.isnan(self.base) | np.isnan(self.top)))
+        by_base = valid[np.argsort(self.base[valid], kind='stable')]
+        self.sorted_base = self.base[by_base]
+        self.base_order = by_base
+        self.sorted_top = np.sort(self.top[valid])
+
+        # Depth class c holds the layers with depth up to min_depth * 2**c, and
+        # key = c * key_step + base sorts by class, then base
+        depth = np.maximum(self.top[valid] - self.base[valid], 0)
+        layer_class = np.ceil(np.log2(np.maximum(depth, min_depth) / min_depth)).astype(int)
+        self.classes = np.unique(layer_class)
+        self.max_depth = min_depth * 2. ** self.classes
+        key = layer_class * key_step + self.base[valid]
+        self.order = valid[np.argsort(key, kind='stable')]
+        self.keys = np.sort(key)
+
+    @classmethod
+    def from_frame(cls, layer_df, index_name='inv_number'):
+        """Index over a layer table laid out as by find_inversions_batch or
+        read from the inversion store."""
+        return cls(LayerRecords.from_frame(layer_df, index_name))
+
+    def __len__(self):
+        return len(self.base)
+
+    def _candidates(self, low, high, side):
+        """Start and number of the runs of self.order holding the layers that
+        may overlap low <= z <= high (z < high with side='left'): in each
+        class, those with base at most high and at most the class's maximum
+        depth below low."""
+        offset = self.classes * key_step
+        first = np.searchsorted(self.keys, offset + low - self.max_depth, side='left')
+        last = np.searchsorted(self.keys, offset + high, side=side)
+        return first, np.maximum(last - first, 0)
+
+    def _launches(self, start, end):
+        """Numbers of the first and one past the last launch with start <=
+        date <= end."""
+        first = 0 if start is None else np.searchsorted(self.launch_dates,
+                                                        np.datetime64(start, 's'))
+        last = len(self.launch_dates) if end is None else np.searchsorted(
+            self.launch_dates, np.datetime64(end, 's'), side='right')
+        return first, last
+
+    def _layers(self, start, end):
+        """Range of layer positions of the launches with start <= date <= end."""
+        first, last = self._launches(start, end)
+        return self.offsets[first], self.offsets[last]
+
+    def _query(self, low, high, side, select, start, end, months):
+        """The layers among the _candidates in the date range that pass the
+        mask select, restricted to the months. If the candidates are more
+        than scan_fraction of the layers of the date range, those are checked
+        instead."""
+        first, last = self._layers(start, end)
+        run_start, run_length = self._candidates(low, high, side)
+        if run_length.sum() >= scan_fraction * (last - first):
+            result = np.flatnonzero(select(slice(first, last)))
+            if first:
+                result += first
+        else:
+            position = np.arange(run_length.sum()) + np.repeat(
+                run_start - np.cumsum(run_length) + run_length, run_length)
+            result = self.order[position]
+            result = result[(result >= first) & (result < last)]
+            result = np.sort(result[select(result)])
+        return self._in_months(result, months)
+
+    def _in_months(self, layers, months):
+        """The layers of launches in the calendar months (1-12), all if None."""
+        if months is None:
+            return layers
+        month = self.dates[layers].astype('datetime64[M]').astype(int) % 12 + 1
+        return layers[np.isin(month, months)]
+
+    def stab(self, height, start=None, end=None, months=None):
+        """Layers with base <= height < top, optionally only those of the
+        launches with start <= date <= end and in the calendar months (1-12)
+        in months."""
+        return self._query(height, height, 'right',
+                           lambda layers: (self.base[layers] <= height) & (self.top[layers] > height),
+                           start, end, months)
+
+    def overlap(self, low, high, start=None, end=None, months=None):
+        """Layers that overlap the height range low <= z < high, with base <
+        high and top > low, with the date filters of stab."""
+        return self._query(low, high, 'left',
+                           lambda layers: (self.base[layers] < high) & (self.top[layers] > low),
+                           start, end, months)
+
+    def base_between(self, low, high, start=None, end=None, months=None):
+        """Layers with low <= base <= high, with the date filters of stab."""
+        first, last = self._layers(start, end)
+        lower = np.searchsorted(self.sorted_base, low, side='left')
+        upper = np.searchsorted(self.sorted_base, high, side='right')
+        if upper - lower >= scan_fraction * (last - first):
+            result = np.flatnonzero((self.base[first:last] >= low) & (self.base[first:last] <= high))
+            if first:
+                result += first
+        else:
+            result = self.base_order[lower:upper]
+            result = np.sort(result[(result >= first) & (result < last)])
+        return self._in_months(result, months)
+
+    def count(self, heights):
+        """Number of layers covering each height (base <= z < top) of the
+        array heights, over the whole index."""
+        heights = np.asarray(heights)
+        return (np.searchsorted(self.sorted_base, heights, side='right') -
+                np.searchsorted(self.sorted_top, heights, side='right'))
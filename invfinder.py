@@ -1,72 +1,171 @@
 """Tool for identifying inversions in a dataframe containing one atmospheric sounding."""
 # To do: implement units check for thresholds. I'm not sure how to access the units of a dataarray.
-# To do: what happens if index_list is empty?
-from .core import build_layer_df, merge_layers
-from metpy.units import units
-import metpy.calc as mcalc
+from .core import (merge_embedded_layers, select_layers, select_layers_batch, setup_batch,
+                   sign_change_index, sounding_columns)
+from .instrument import count, timed
+from .layers import LayerRecords
 import numpy as np
-import pandas as pd
-
-def invfinder(data, params={'max_embed_depth': 100, 
-                            'min_dz': 0, #* units('m'),
-                            'min_dp': 20,# * units('hPa'),
-                            'min_dt': 2.5,# * units('K'),
-                            'min_drh': 20,# * units('percent'),
-                            'rh_or_dt': True}):
+
+default_params = {'max_embed_depth': 100,
+                  'min_dz': 0, #* units('m'),
+                  'min_dp': 20,# * units('hPa'),
+                  'min_dt': 2.5,# * units('K'),
+                  'min_drh': 20,# * units('percent'),
+                  'rh_or_dt': True}
+
+@timed(soundings=1)
+def invfinder(data, params=default_params):
     """Implementation of inversion finder that returns multiple inversion layers.
     At the moment the data on units doesn't fully come through, so that needs to get fixed.
+    The work is done on numpy arrays by find_inversion_levels; the DataFrame is
+    only built once, for the final layers. data can be a Dataset from
+    core.setup_dataset or a Sounding from core.setup_sounding, which is faster.
     """
-    def init_index_list(data):
-        """Uses the first difference to find regions of 
-        nonnegative slope. """
-
-        dt = data.temperature.shift({'index':-1}) - data.temperature
-        dt = list(dt.values >= 0)
-        index_list, = np.nonzero(np.diff(dt))
-        
-        index_list = [x + 1 for x in index_list]
-        if len(index_list) > 0:
-            if index_list[0] == 0:
-                index_list = list(index_list) + [len(dt)-1]
-            else:
-                index_list = [0] + list(index_list) + [len(dt)-1]
-        else:
-            index_list = [0, len(dt)-1]
-            
-        return index_list
-
-
-    index_list = init_index_list(data)
-
-    
-    while True:
-        init_length = len(index_list)
-        layer_df = build_layer_df(index_list, data)
-        negative_lapse = layer_df['temperature_top'] - layer_df['temperature_base'] < 0
-        # could do layer_df.loc[negative_lapse,:] instead
-        merge_layers(index_list, layer_df.loc[negative_lapse,:], 'height', params['max_embed_depth'], upper=True)
-        if len(index_list) == init_length:
-            break
-            
-    layer_df = layer_df.loc[
-        layer_df['temperature_top'] - layer_df['temperature_base'] > 0,:] #.reset_index(drop=True)
-    zdepth = (layer_df['height_top'] - layer_df['height_base'])# * data.height.units
-    pdepth = (layer_df['pressure_base'] - layer_df['pressure_top']) #* data.pressure.units
-    tstren = (layer_df['temperature_top'] - layer_df['temperature_base'])# * data.temperature.units # make delta temperature
-    hstren = np.abs(layer_df['relative_humidity_top'] - layer_df['relative_humidity_base'])# * data.relative_humidity.units
-    
-    zdepth_check = zdepth > params['min_dz']
-    pdepth_check = pdepth > params['min_dp']
-    tstren_check = tstren > params['min_dt']
-    hstren_check = hstren > params['min_drh']
+    columns, date = sounding_columns(data)
+    idxb, idxt = find_inversion_levels(columns['temperature'], columns['height'],
+                                       columns['pressure'], columns['relative_humidity'], params)
+    return select_layers(idxb, idxt, columns, date)
+
+
+def find_inversion_levels(temperature, height, pressure, relative_humidity, params):
+    """Array engine behind invfinder. Finds the layers of constant temperature
+    difference sign, merges embedded negative lapse rate layers, and applies the
+    depth and strength thresholds in params. Inputs are numpy arrays ordered
+    from the surface up. Returns arrays with the base and top level index of
+    each inversion layer."""
+
+    sounding, idxb, idxt = find_inversion_levels_ragged(
+        [0, len(temperature)], temperature, height, pressure, relative_humidity, params)
+    return idxb, idxt
+
+
+def find_inversion_levels_ragged(offsets, temperature, height, pressure, relative_humidity, params):
+    """Same as find_inversion_levels, but for many soundings stored end to end
+    in flat arrays, with sounding i in offsets[i]:offsets[i+1]. All soundings are
+    processed together. Returns the sounding number of each inversion layer
+    and the flat base and top level indices."""
+
+    index, sounding = sign_change_index(temperature, offsets)
+    layers = candidate_layers(index, sounding, temperature, height, pressure, relative_humidity,
+                              params['max_embed_depth'])
+    idx_sel = threshold_mask(layers, params)
+    return layers['sounding'][idx_sel], layers['idxb'][idx_sel], layers['idxt'][idx_sel]
+
+
+def candidate_layers(index, sounding, temperature, height, pressure, relative_humidity,
+                     max_embed_depth):
+    """The part of find_inversion_levels_ragged that doesn't depend on the
+    thresholds: merges the embedded layers in the output of
+    core.sign_change_index and keeps the positive lapse rate layers. Returns
+    a dictionary with the sounding, base and top level index, depth and
+    strength of each layer, for threshold_mask."""
+
+    index, sounding = merge_embedded_layers(index, sounding, temperature, height, max_embed_depth)
+    idxb = index[:-1]
+    idxt = index[1:]
+    positive = (sounding[:-1] == sounding[1:]) & (temperature[idxt] - temperature[idxb] > 0)
+    idxb = idxb[positive]
+    idxt = idxt[positive]
+    return {'sounding': sounding[:-1][positive], 'idxb': idxb, 'idxt': idxt,
+            'zdepth': height[idxt] - height[idxb],
+            'pdepth': pressure[idxb] - pressure[idxt],
+            'tstren': temperature[idxt] - temperature[idxb],
+            'hstren': np.abs(relative_humidity[idxt] - relative_humidity[idxb])}
+
+
+def threshold_mask(layers, params):
+    """Boolean mask of the candidate_layers that pass the depth and strength
+    thresholds in params."""
+
+    zdepth_check = layers['zdepth'] > params['min_dz']
+    pdepth_check = layers['pdepth'] > params['min_dp']
+    tstren_check = layers['tstren'] > params['min_dt']
+    hstren_check = layers['hstren'] > params['min_drh']
     if params['rh_or_dt']:
-        idx_sel = (zdepth_check & pdepth_check) & (tstren_check | hstren_check)
-    else:
-        idx_sel = (zdepth_check & pdepth_check) & (tstren_check & hstren_check)
-    
-    layer_df = layer_df.loc[idx_sel, :].reset_index(drop=True)
-    layer_df.index = pd.Index(layer_df.index.values + 1, name='inv_number') # change to arange
-    if len(layer_df) == 0:
-        layer_df.loc[0,:] = np.nan
-        layer_df.loc[0,'date'] = data.sel(index=0)['date'].values
-    return layer_df
\ No newline at end of file
+        return (zdepth_check & pdepth_check) & (tstren_check | hstren_check)
+    return (zdepth_check & pdepth_check) & (tstren_check & hstren_check)
+
+
+def find_inversions_batch(df, params=default_params,
+                          variables=['pressure', 'height', 'temperature', 'relative_humidity']):
+    """Runs invfinder on every sounding in a long-format dataframe with a 'date'
+    column and one row per level, without a groupby. Levels of each launch are
+    expected to be ordered from the surface up. Returns one flat dataframe with
+    a row per (date, inv_number) and the same _base/_top columns as invfinder,
+    including the row of NaN with inv_number 0 for launches without inversions."""
+
+    offsets, columns, dates = setup_batch(df, variables)
+    return find_inversions_ragged(offsets, columns, dates, params)
+
+
+@timed()
+def find_inversions_ragged(offsets, columns, dates, params=default_params):
+    """Same as find_inversions_batch, for soundings already stored end to end
+    in flat arrays: the launch offsets, a dictionary of flat arrays with the
+    level 'index' and at least pressure, height, temperature and
+    relative_humidity, and the date of each launch. This is what
+    core.setup_batch and archive.SoundingArchive.select return."""
+    count('invfinder.find_inversions_ragged', soundings=len(dates))
+    sounding, idxb, idxt = find_inversion_levels_ragged(
+        offsets, columns['temperature'], columns['height'], columns['pressure'],
+        columns['relative_humidity'], params)
+    return select_layers_batch(sounding, idxb, idxt, columns, dates)
+
+
+@timed()
+def find_inversion_records(offsets, columns, dates, params=default_params):
+    """find_inversions_ragged returning layers.LayerRecords rather than a
+    DataFrame, for keeping many stations or years in memory."""
+    count('invfinder.find_inversion_records', soundings=len(dates))
+    sounding, idxb, idxt = find_inversion_levels_ragged(
+        offsets, columns['temperature'], columns['height'], columns['pressure'],
+        columns['relative_humidity'], params)
+    return LayerRecords.from_levels(sounding, idxb, idxt, columns, dates)
+
+
+def find_inversions_sweep(df, param_grid,
+                          variables=['pressure', 'height', 'temperature', 'relative_humidity']):
+    """find_inversions_batch for each parameter set in the list param_grid.
+    See find_inversions_sweep_ragged."""
+
+    offsets, columns, dates = setup_batch(df, variables)
+    return find_inversions_sweep_ragged(offsets, columns, dates, param_grid)
+
+
+@timed()
+def find_inversions_sweep_ragged(offsets, columns, dates, param_grid):
+    """find_inversions_ragged for each parameter set in the list param_grid,
+    sharing the work that doesn't depend on the thresholds. The sign change
+    index is found once, the embedded layers are merged once per distinct
+    max_embed_depth, and each parameter set only applies its threshold mask.
+    Returns one flat DataFrame with a 'param_set' column, the position of the
+    parameter set in param_grid, followed by the columns of
+    find_inversions_ragged for that set."""
+    count('invfinder.find_inversions_sweep_ragged', soundings=len(dates),
+          parameter_sets=len(param_grid))
+
+    temperature = columns['temperature']
+    index, sounding = sign_change_index(temperature, offsets)
+    selected = [None] * len(param_grid)
+    for max_embed_depth in sorted(set(params['max_embed_depth'] for params in param_grid)):
+        layers = candidate_layers(index, sounding, temperature, columns['height'],
+                                  columns['pressure'], columns['relative_humidity'],
+                                  max_embed_depth)
+        for ii, params in enumerate(param_grid):
+            if params['max_embed_depth'] == max_embed_depth:
+                idx_sel = threshold_mask(layers, params)
+                selected[ii] = (layers['sounding'][idx_sel] + ii * len(dates),
+                                layers['idxb'][idx_sel], layers['idxt'][idx_sel])
+
+    # The layers of parameter set i are those of launches i * n_launches + j, so
+    # that the table for all sets is built at once
+    if len(selected) == 0:
+        import pandas as pd
+
+        return pd.DataFrame(columns=['param_set', 'date', 'inv_number'])
+    sounding, idxb, idxt = (np.concatenate(arrays) for arrays in zip(*selected))
+    result = select_layers_batch(sounding, idxb, idxt, columns, np.tile(dates, len(param_grid)))
+    n_rows = np.maximum(np.bincount(sounding, minlength=len(param_grid) * len(dates)), 1)
+    result.insert(0, 'param_set', np.repeat(np.arange(len(param_grid)),
+                                            n_rows.reshape(len(param_grid), -1).sum(axis=1)))
+    return result
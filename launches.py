@@ -0,0 +1,102 @@
+"""Launch index: one record per launch of a station.
+
+The index is built from the long-format sounding table when a station is
+written to the archive (see archive.write_archive) and saved with it as
+
+    root/<station_id>/launches.npy
+
+a structured array with the fields
+
+    date            launch time, datetime64[s], sorted
+    offset          first row of the launch in the archive arrays, and in the
+                    table read back from the sounding store
+    n_levels        number of levels
+    surface_height  height of the lowest level, m (NaN without a height column)
+    synoptic        0 or 12 for launches within an hour of 00Z or 12Z, else -1
+    flags           sum of the quality flags below that apply
+
+Per-launch facts such as level counts, synoptic hour or month are read from
+the index rather than by grouping the sounding table by date, and launches
+are selected with boolean masks on it (see select and level_mask).
+"""
+import os
+import numpy as np
+from .core import launch_offsets
+
+# Quality flags
+few_levels = 1  # 5 levels or fewer
+missing_humidity = 2  # a level without relative humidity
+height_not_increasing = 4  # height doesn't increase from one level to the next
+off_synoptic = 8  # not within an hour of 00Z or 12Z
+
+launch_dtype = np.dtype([('date', 'datetime64[s]'), ('offset', np.int64), ('n_levels', np.int32),
+                         ('surface_height', np.float32), ('synoptic', np.int8),
+                         ('flags', np.uint8)])
+
+
+def synoptic_hour(dates):
+    """0 or 12 for dates within an hour of 00Z or 12Z, -1 otherwise."""
+    hour = (np.asarray(dates).astype('datetime64[h]').astype(int) + 1) % 24
+    return np.where(hour < 3, 0, np.where((hour >= 12) & (hour < 15), 12, -1)).astype(np.int8)
+
+
+def launch_index(table):
+    """Launch index of a long-format sounding table (DataFrame or dictionary
+    of arrays) with a 'date' column and the levels of each launch contiguous,
+    from the surface up."""
+    dates = np.asarray(table['date'])
+    offsets = launch_offsets(dates)
+    index = np.zeros(len(offsets) - 1, dtype=launch_dtype)
+    if len(index) == 0:
+        return index
+    first = offsets[:-1]
+    index['date'] = dates[first]
+    index['offset'] = first
+    index['n_levels'] = np.diff(offsets)
+    index['synoptic'] = synoptic_hour(index['date'])
+
+    flags = np.where(index['n_levels'] <= 5, few_levels, 0)
+    flags += np.where(index['synoptic'] < 0, off_synoptic, 0)
+    if 'relative_humidity' in table:
+        missing = np.isnan(np.asarray(table['relative_humidity'], dtype=float))
+        flags += np.where(np.add.reduceat(missing, first) > 0, missing_humidity, 0)
+    if 'height' in table:
+        height = np.asarray(table['height'], dtype=float)
+        index['surface_height'] = height[first]
+        # A decrease between the last level of a launch and the next launch doesn't count
+        decrease = np.append(np.diff(height) <= 0, False)
+        decrease[offsets[1:] - 1] = False
+        flags += np.where(np.add.reduceat(decrease, first) > 0, height_not_increasing, 0)
+    else:
+        index['surface_height'] = np.nan
+    index['flags'] = flags
+    return index
+
+
+def read_launch_index(root, station):
+    """The launch index of station in the archive under root, memory-mapped.
+    Raises FileNotFoundError for stations archived without one."""
+    return np.load(os.path.join(root, station, 'launches.npy'), mmap_mode='r')
+
+
+def select(index, start=None, end=None, synoptic=None, months=None, exclude=0):
+    """Boolean mask of the launches in index with start <= date <= end, at
+    the synoptic hour (0 or 12) if given, in the calendar months (1-12) if
+    given, and with none of the quality flags in exclude."""
+    dates = index['date']
+    mask = (index['flags'] & exclude) == 0
+    if start is not None:
+        mask &= dates >= np.datetime64(start, 's')
+    if end is not None:
+        mask &= dates <= np.datetime64(end, 's')
+    if synoptic is not None:
+        mask &= index['synoptic'] == synoptic
+    if months is not None:
+        mask &= np.isin(dates.astype('datetime64[M]').astype(int) % 12 + 1, months)
+    return mask
+
+
+def level_mask(index, launches):
+    """Boolean mask of the rows of the sounding table that belong to the
+    launches selected by the boolean mask launches."""
+    return np.repeat(launches, index['n_levels'])
@@ -0,0 +1,190 @@
+"""Compact layer tables.
+
+LayerRecords holds the layers found in many launches as a struct of
+arrays: the launch dates (datetime64[s]) and offsets, with the layers of
+launch i in offsets[i]:offsets[i+1], the int32 level index of the base and
+top of each layer (-1 when read from a table without them), and a float32
+array per variable for the base and for the top. A launch without layers
+is an empty range of offsets, not a row of NaN, and there are no object
+columns. The flat DataFrame of core.select_layers_batch, or an Arrow
+table, is only built at the edges of the pipeline, e.g. to write the store.
+"""
+import numpy as np
+from .core import interstitial_merges, launch_offsets
+from .frequency import indicator_matrix
+
+
+class LayerRecords:
+    """Layers of many launches, sorted by launch, with launches in date order.
+
+    records = find_inversion_records(*archive.select('2010-01-01', '2010-12-31'))
+    records.n_layers        # layers in each launch, 0 where none were found
+    records.base['height']  # base height of every layer
+    records.index_base      # level of each base, -1 if from_frame had no index_base
+    records.to_frame()      # the table of find_inversions_ragged
+    """
+    __slots__ = ('dates', 'offsets', 'index_base', 'index_top', 'base', 'top', 'index_name')
+
+    def __init__(self, dates, offsets, index_base, index_top, base, top, index_name='inv_number'):
+        self.dates = dates
+        self.offsets = offsets
+        self.index_base = index_base
+        self.index_top = index_top
+        self.base = base
+        self.top = top
+        self.index_name = index_name
+
+    @classmethod
+    def from_levels(cls, sounding, idxb, idxt, columns, dates, index_name='inv_number',
+                    dtype='float32'):
+        """Records from the output of the ragged engines (the sounding number,
+        sorted, and the flat base and top level of each layer), the columns of
+        core.setup_batch and the date of each launch."""
+        n_layers = np.bincount(sounding, minlength=len(dates))
+        offsets = np.concatenate([[0], np.cumsum(n_layers)])
+        variables = [cc for cc in columns if cc != 'index']
+        return cls(np.asarray(dates).astype('datetime64[s]'), offsets,
+                   columns['index'][idxb].astype(np.int32), columns['index'][idxt].astype(np.int32),
+                   {cc: columns[cc][idxb].astype(dtype) for cc in variables},
+                   {cc: columns[cc][idxt].astype(dtype) for cc in variables}, index_name)
+
+    @classmethod
+    def from_frame(cls, layer_df, index_name='inv_number', dtype='float32'):
+        """Records from a layer table laid out as by invfinder (one launch,
+        indexed by index_name) or find_inversions_batch. Rows with
+        index_name 0 are the placeholders of launches without layers. Without
+        index_base and index_top columns, as in the inversion store, the level
+        indexes are -1."""
+        if layer_df.index.name == index_name:
+            layer_df = layer_df.reset_index()
+        rows = launch_offsets(layer_df['date'].values)
+        layer = layer_df[index_name].values != 0
+        n_layers = np.add.reduceat(layer.astype(int), rows[:-1]) if len(layer_df) else rows[:0]
+        variables = [cc[:-5] for cc in layer_df.columns
+                     if cc.endswith('_base') and cc[:-5] + '_top' in layer_df.columns and
+                     cc != 'index_base']
+        layers = layer_df.loc[layer]
+        index_base, index_top = [
+            layers[cc].to_numpy(dtype=np.int32) if cc in layers.columns
+            else np.full(len(layers), -1, dtype=np.int32) for cc in ['index_base', 'index_top']]
+        return cls(layer_df['date'].values[rows[:-1]].astype('datetime64[s]'),
+                   np.concatenate([[0], np.cumsum(n_layers)]), index_base, index_top,
+                   {cc: layers[cc + '_base'].to_numpy(dtype=dtype) for cc in variables},
+                   {cc: layers[cc + '_top'].to_numpy(dtype=dtype) for cc in variables}, index_name)
+
+    @staticmethod
+    def concatenate(records):
+        """Records of the launches of each item of the list records in turn."""
+        first = records[0]
+        n_layers = np.concatenate([r.n_layers for r in records])
+        return LayerRecords(np.concatenate([r.dates for r in records]),
+                            np.concatenate([[0], np.cumsum(n_layers)]),
+                            np.concatenate([r.index_base for r in records]),
+                            np.concatenate([r.index_top for r in records]),
+                            {cc: np.concatenate([r.base[cc] for r in records]) for cc in first.base},
+                            {cc: np.concatenate([r.top[cc] for r in records]) for cc in first.top},
+                            first.index_name)
+
+    def __len__(self):
+        return len(self.index_base)
+
+    @property
+    def n_layers(self):
+        """Number of layers of each launch."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays, in bytes."""
+        arrays = [self.dates, self.offsets, self.index_base, self.index_top]
+        arrays += list(self.base.values()) + list(self.top.values())
+        return sum(array.nbytes for array in arrays)
+
+    def launch_numbers(self):
+        """Number of the launch of each layer."""
+        return np.repeat(np.arange(len(self.dates)), self.n_layers)
+
+    def layer_numbers(self):
+        """Number of each layer within its launch, from 1 at the lowest."""
+        return np.arange(len(self)) - np.repeat(self.offsets[:-1], self.n_layers) + 1
+
+    def select(self, start=None, end=None):
+        """Records of the launches with start <= date <= end. The arrays are
+        views into these records."""
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 's'))
+        last = len(self.dates) if end is None else np.searchsorted(
+            self.dates, np.datetime64(end, 's'), side='right')
+        rows = slice(self.offsets[first], self.offsets[last])
+        return LayerRecords(self.dates[first:last], self.offsets[first:last + 1] - self.offsets[first],
+                            self.index_base[rows], self.index_top[rows],
+                            {cc: self.base[cc][rows] for cc in self.base},
+                            {cc: self.top[cc][rows] for cc in self.top}, self.index_name)
+
+    def merge_interstitial(self, max_embed_depth):
+        """Array version of core.merge_interstitial_layers: merges the
+        neighboring layers of a launch separated by less than max_embed_depth,
+        or by exactly max_embed_depth below a thinner gap, with the same rule
+        (core.interstitial_merges). The merged layer keeps the base of the
+        lowest layer and the top of the highest. Returns new records."""
+        launch = self.launch_numbers()
+        same_launch = np.zeros(len(self), dtype=bool)
+        same_launch[1:] = launch[1:] == launch[:-1]
+        merge = interstitial_merges(same_launch, self.base['height'], self.top['height'],
+                                    max_embed_depth)
+        if not np.any(merge):
+            return self
+        first, = np.nonzero(~merge)
+        last = np.append(first[1:], len(self)) - 1
+        n_layers = np.bincount(launch[first], minlength=len(self.dates))
+        return LayerRecords(self.dates, np.concatenate([[0], np.cumsum(n_layers)]),
+                            self.index_base[first], self.index_top[last],
+                            {cc: self.base[cc][first] for cc in self.base},
+                            {cc: self.top[cc][last] for cc in self.top}, self.index_name)
+
+    def indicator(self, zgrid, packed=False):
+        """The dates and indicator matrix of frequency.inversion_indicator,
+        with a row for every launch."""
+        return self.dates, indicator_matrix(self.launch_numbers(), len(self.dates),
+                                            self.base['height'], self.top['height'], zgrid, packed)
+
+    def columns(self):
+        """Dictionary of the layer columns, date, index_name, then the
+        _base and _top of the level index and of each variable. The
+        variable arrays are the records' own arrays, not copies."""
+        columns = {'date': np.repeat(self.dates, self.n_layers),
+                   self.index_name: self.layer_numbers(),
+                   'index_base': self.index_base, 'index_top': self.index_top}
+        for cc in self.base:
+            columns[cc + '_base'] = self.base[cc]
+            columns[cc + '_top'] = self.top[cc]
+        return columns
+
+    def to_frame(self, empty_rows=True):
+        """DataFrame with a row per layer. With empty_rows, launches without
+        layers get the row of NaN with index_name 0, as from
+        core.select_layers_batch, which needs a copy; without, the variable
+        columns share memory with the records where pandas allows."""
+        import pandas as pd
+
+        columns = self.columns()
+        if not empty_rows or np.all(self.n_layers > 0):
+            return pd.DataFrame(columns, copy=False)
+
+        n_rows = np.maximum(self.n_layers, 1)
+        row = np.repeat(np.cumsum(n_rows) - n_rows, self.n_layers) + columns[self.index_name] - 1
+        layer_number = np.zeros(n_rows.sum(), dtype=int)
+        layer_number[row] = columns[self.index_name]
+        frame = {'date': np.repeat(self.dates, n_rows), self.index_name: layer_number}
+        for cc in list(columns)[2:]:
+            frame[cc] = np.full(len(layer_number), np.nan,
+                                dtype=np.result_type(columns[cc].dtype, np.float32))
+            frame[cc][row] = columns[cc]
+        return pd.DataFrame(frame, copy=False)
+
+    def to_arrow(self):
+        """pyarrow Table with a row per layer. The numeric columns are not
+        copied. Launches without layers have no rows; their dates are in
+        the dates attribute."""
+        import pyarrow as pa
+
+        return pa.table({cc: pa.array(values) for cc, values in self.columns().items()})
@@ -0,0 +1,48 @@
+"""The detection loop invfinder used before the numpy engine, kept as the
+reference that tests.py checks invfinder against and that
+benchmarks/run.py times the current engines against.
+"""
+import numpy as np
+import pandas as pd
+from .core import build_layer_df, merge_layers
+
+
+def merge_loop(data, max_embed_depth):
+    """Layers of the Dataset data from the build_layer_df/merge_layers loop,
+    repeated until no more layers are merged: the table of build_layer_df
+    with every layer, before the inversions are selected."""
+    dt = data.temperature.shift({'index': -1}) - data.temperature
+    dt = list(dt.values >= 0)
+    index_list, = np.nonzero(np.diff(dt))
+    index_list = [0] + [x + 1 for x in index_list] + [len(dt) - 1]
+
+    while True:
+        init_length = len(index_list)
+        layer_df = build_layer_df(index_list, data)
+        negative_lapse = layer_df['temperature_top'] - layer_df['temperature_base'] < 0
+        merge_layers(index_list, layer_df.loc[negative_lapse, :], 'height', max_embed_depth,
+                     upper=True)
+        if len(index_list) == init_length:
+            return layer_df
+
+
+def invfinder(data, params):
+    """The inversions of the Dataset data as found by invfinder before the
+    numpy engine: merge_loop followed by the checks in params."""
+    layer_df = merge_loop(data, params['max_embed_depth'])
+    layer_df = layer_df.loc[layer_df['temperature_top'] - layer_df['temperature_base'] > 0, :]
+    zdepth = layer_df['height_top'] - layer_df['height_base']
+    pdepth = layer_df['pressure_base'] - layer_df['pressure_top']
+    tstren = layer_df['temperature_top'] - layer_df['temperature_base']
+    hstren = np.abs(layer_df['relative_humidity_top'] - layer_df['relative_humidity_base'])
+    checks = (zdepth > params['min_dz']) & (pdepth > params['min_dp'])
+    if params['rh_or_dt']:
+        idx_sel = checks & ((tstren > params['min_dt']) | (hstren > params['min_drh']))
+    else:
+        idx_sel = checks & ((tstren > params['min_dt']) & (hstren > params['min_drh']))
+    layer_df = layer_df.loc[idx_sel, :].reset_index(drop=True)
+    layer_df.index = pd.Index(layer_df.index.values + 1, name='inv_number')
+    if len(layer_df) == 0:
+        layer_df.loc[0, :] = np.nan
+        layer_df.loc[0, 'date'] = data.sel(index=0)['date'].values
+    return layer_df
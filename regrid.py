@@ -0,0 +1,123 @@
+"""Soundings interpolated onto a common grid of heights above ground.
+
+regrid_ragged interpolates every launch of a batch in the ragged layout of
+core.setup_batch (or archive.SoundingArchive.select) linearly in height onto
+heights above the first (surface) level of the launch, with one searchsorted over
+all launches at once: the heights of launch i are shifted by i times a
+constant larger than any launch's range of heights plus the grid, so every
+launch has its own stretch of one sorted array. Grid heights below the
+lowest or above the highest level of a launch are NaN.
+
+regrid_archive does this for the launches of an archived station a block at
+a time and writes the result as a folder of .npy files,
+
+    path/date.npy         launch times
+    path/height.npy       heights above ground, m
+    path/<variable>.npy   launch x height float32
+
+which read_grid opens memory-mapped. Gridded statistics are then reductions
+over the arrays, e.g. lapse_rate(grid['temperature'], heights) < 0 marks
+the grid intervals in an inversion.
+"""
+import os
+import shutil
+import numpy as np
+
+grid_variables = ['temperature', 'relative_humidity', 'potential_temperature',
+                  'equivalent_potential_temperature']
+
+
+def regrid_ragged(offsets, columns, heights, variables=grid_variables, dtype='float32'):
+    """Dictionary of (launch x height) arrays of the variables interpolated
+    onto heights above the first level of each launch, from the launch
+    offsets and the columns (with 'height') of core.setup_batch. Levels
+    without a height are skipped; the others needn't be sorted."""
+    heights = np.asarray(heights, dtype=float)
+    n_launches = len(offsets) - 1
+    launch = np.repeat(np.arange(n_launches), np.diff(offsets))
+    z = np.asarray(columns['height'], dtype=float)
+    surface = np.full(n_launches, np.nan)
+    has_levels = np.diff(offsets) > 0
+    surface[has_levels] = z[offsets[:-1][has_levels]]
+
+    level = np.flatnonzero(~np.isnan(z))
+    if len(level) == 0 or len(heights) == 0:
+        return {cc: np.full((n_launches, len(heights)), np.nan, dtype=dtype) for cc in variables}
+
+    # Sort the levels by launch, then height, as one array of shifted heights.
+    # The sorted levels of launch i are first[i]:first[i + 1].
+    low = z[level].min()
+    shift = z[level].max() - low + max(heights.max(), 0) - min(heights.min(), 0) + 1
+    key = launch[level] * shift + (z[level] - low)
+    if np.any(key[1:] < key[:-1]):
+        order = np.argsort(key, kind='stable')
+        level = level[order]
+        key = key[order]
+    first = np.concatenate([[0], np.cumsum(np.bincount(launch[level], minlength=n_launches))])
+
+    target = np.arange(n_launches)[:, np.newaxis] * shift + (surface[:, np.newaxis] + heights - low)
+    lower = np.searchsorted(key, target, side='right') - 1
+    upper = np.minimum(lower + 1, first[1:, np.newaxis] - 1)
+    lower = np.maximum(lower, 0)
+    # A grid height at the top level has upper == lower and weight 0
+    valid = ((lower >= first[:-1, np.newaxis]) &
+             ((upper > lower) | (key[lower] == target)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(upper > lower, (target - key[lower]) / (key[upper] - key[lower]), 0.)
+
+    result = {}
+    for cc in variables:
+        values = np.asarray(columns[cc], dtype=float)[level]
+        interpolated = values[lower] + weight * (values[upper] - values[lower])
+        result[cc] = np.where(valid, interpolated, np.nan).astype(dtype)
+    return result
+
+
+def regrid_archive(archive, path, heights, variables=grid_variables, start=None, end=None,
+                   block_size=4096):
+    """Regrids the launches of the SoundingArchive archive with start <= date
+    <= end onto heights above ground (see regrid_ragged), block_size launches
+    at a time, and writes them to the folder path, replacing it. Returns the
+    result of read_grid(path)."""
+    heights = np.asarray(heights, dtype=float)
+    first, last = archive.date_range(start, end)
+    tmp = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'date.npy'), np.asarray(archive.dates[first:last]))
+    np.save(os.path.join(tmp, 'height.npy'), heights)
+    grid = {cc: np.lib.format.open_memmap(os.path.join(tmp, cc + '.npy'), mode='w+',
+                                          dtype=np.float32, shape=(int(last - first), len(heights)))
+            for cc in variables}
+
+    for block in range(first, last, block_size):
+        stop = min(block + block_size, last)
+        offsets = np.asarray(archive.offsets[block:stop + 1])
+        rows = slice(offsets[0], offsets[-1])
+        columns = {cc: archive.variables[cc][rows] for cc in ['height'] + list(variables)}
+        for cc, values in regrid_ragged(offsets - offsets[0], columns, heights, variables).items():
+            grid[cc][block - first:stop - first] = values
+    for values in grid.values():
+        values.flush()
+    del grid
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return read_grid(path)
+
+
+def read_grid(path):
+    """Returns the launch dates, the heights above ground and a dictionary of
+    the memory-mapped (launch x height) arrays written by regrid_archive."""
+    dates = np.load(os.path.join(path, 'date.npy'))
+    heights = np.load(os.path.join(path, 'height.npy'))
+    grid = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in sorted(os.listdir(path))
+            if name.endswith('.npy') and name not in ['date.npy', 'height.npy']}
+    return dates, heights, grid
+
+
+def lapse_rate(temperature, heights):
+    """Lapse rate -dT/dz in K/km between neighboring heights of a (launch x
+    height) temperature grid. Negative in inversions."""
+    return -np.diff(temperature, axis=-1) / np.diff(heights) * 1000
@@ -1,7 +1,16 @@
-"""Calculate inversion frequency by height and plot the result."""
+"""Calculate inversion frequency by height and plot the result.
+
+The indicator, monthly frequency and error cubes of all stations are built lazily
+(invclim.cubes) and written station by station to Data/Climatology/, so only a few
+stations are in memory at a time; the plots read them back from there."""
 import numpy as np
 import pandas as pd
 import proplot as pplt
+import xarray as xr
+import sys
+sys.path.append('/Users/danielwatkins/Box/Thesis/02 Climatology of multilayered temperature inversions/')
+import invclim.cubes as icx
+import invclim.frequency as icf
 pplt.rc.update({'suptitle.size': 12, 'title.size': 8})
 
 arctic_stations = pd.read_csv('../Data/arctic_stations_long.csv')
@@ -12,89 +21,16 @@ arctic_stations.set_index('station_id', inplace=True)
 #start_date = pd.to_datetime('2000-01-01 00:00')
 #end_date = pd.to_datetime('2019-12-31 23:00')
 
-inversions = {}
-for site in arctic_stations.index:
-    start_date = arctic_stations.loc[site, 'begin_date']
-    end_date = arctic_stations.loc[site, 'end_date']
-    inversions[site] = pd.read_csv('../Data/Inversions/' + site + '_inversions.csv')
-    inversions[site]['date'] = pd.to_datetime(inversions[site].date.values)
-    inversions[site] = inversions[site].loc[(inversions[site].date >= start_date) &
-                                            (inversions[site].date <= end_date)]
-def inv_indicator(inv_df, zgrid):
-    """Returns a dataframe dimensions (n_obvs x n_heights) with 
-    entries 1 if inversion is present at that height and 0 otherwise."""
-    ind_list = []
-    names = []
-    for name, group in inv_df.groupby('date'):
-
-        ind = zgrid*0
-        for height_base, height_top in zip(group.height_base, group.height_top):
-            ind += np.array((height_base <= zgrid) & (height_top > zgrid))
-        ind_list.append(ind)
-        names.append(name)
-    return pd.DataFrame(np.vstack(ind_list), index=names, columns=zgrid)        
-
-def get_phi(indicator_df):
-    """From the indicator df output by inv_indicator, compute lag 1 autocorrelation
-    via the Pearson method for each month and each height."""
-    corr_coef = np.zeros((12, len(zgrid)))
-    for ii, month in enumerate(np.arange(1, 13)):
-        for jj, col in enumerate(indicator_df.columns):
-            corr_coef[ii, jj] = indicator_df.loc[
-                indicator_df.index.month == month, col].shift(1).corr(
-                indicator_df.loc[
-                    indicator_df.index.month == month, col], method='pearson')   
-    return pd.DataFrame(
-        data=corr_coef, index=np.arange(1, 13), 
-        columns=indicator_df.columns)
-
-def standard_error_adj(f, phi):
-    """Computes the error in the proportion adjusted for autocorrelation phi.
-    f should be a dataframe or array with nrows = nobservations, ncols=nheights,
-    and phi is an array with len nheights."""
-    n = len(f)
-    v =  (1+phi)/(1-phi)
-    v[v < 1] = 1
-    se = np.sqrt(f.mean(axis=0)*(1-f.mean(axis=0))/n *v)
-    return se
-
-
-def season(m):
-    if m in [12, 1, 2]:
-        return 'DJF'
-    elif m in [3,4,5]:
-        return 'MAM'
-    elif m in [6,7,8]:
-        return 'JJA'
-    else:
-        return 'SON'
-    
-    
-freqs = {}
-phis = {}
-errs = {}
-n = {}
+cube_path = '../Data/Climatology/inversion_frequency.zarr'
+# Heights above ground, from 5 m so that changes in elevation aren't as important.
+# indicator: 1 if an inversion overlaps that height; frequency: monthly mean of the indicator;
+# err: standard error adjusted for the lag-1 autocorrelation phi
+cube = icx.climatology('../Data/Inversions/', arctic_stations.index, arctic_stations.elevation,
+                       5 + np.arange(25, 3000, 50), pd.to_datetime(arctic_stations.begin_date),
+                       pd.to_datetime(arctic_stations.end_date))
+icx.write_cube(cube, cube_path)
+cube = xr.open_zarr(cube_path)
 
-for site in arctic_stations.index:
-    # setting first point at 5m AGL so changes in elevation aren't as important.
-    # could adjust actual time series tho.
-    zgrid = arctic_stations.loc[site, 'elevation'] + 5 + np.arange(25, 3000, 50)
-    
-    # flags 1 if an inversion overlaps that height and 0 if not
-    indicator_df = inv_indicator(inversions[site], zgrid)
-    
-    # monthly average of indicators is the frequency
-    freqs[site] = indicator_df.resample('1MS').mean()
-    
-    # estimate the correlation at each height with pearson correlation coefficient
-    phis[site] = get_phi(indicator_df)
-    
-    # adjusted standard error for proportion if phi is positive, otherwise use standard error
-    errs[site] = standard_error_adj(freqs[site], phis[site])
-    
-    # number of observations in each month
-    n[site] = indicator_df.resample('1MS').count().iloc[:,1]
-    
 # plot the seasonal inversion frequency plots with shading
 colors = {letter: color['color'] for letter, color in zip(['DJF', 'MAM', 'JJA', 'SON'],
                                                 pplt.Cycle('538', 4))}
@@ -140,15 +76,15 @@ fig, axs = pplt.subplots(nrows=6, ncols=8, journal='ams4', wspace=0.1, hspace=0.
 arctic_stations['idx'] = np.arange(1, len(arctic_stations)+1)
 season_plot = ['DJF', 'MAM', 'JJA', 'SON']
 for site, ax in zip(arctic_stations.index, np.ravel(axs)[0:len(arctic_stations.index)]):
-    seas = np.array([season(m) for m in freqs[site].index.month])
-    z = freqs[site].columns - arctic_stations.loc[site, 'elevation']
+    station = cube.sel(station=site).load()
+    seas = np.array(icf.seasons)[icf.season_number(station.month.values.astype('datetime64[M]'))]
+    z = station.height.values
     
     for seasons in season_plot:
-        f = freqs[site].loc[seas==seasons].mean(axis=0)
-        nn = n[site]
-        err = errs[site].loc[[12,1,2],:].mean(axis=0)
-        ax.plot(f.values, z, color=colors[seasons], linewidth=1)
-        ax.fill_betweenx(z, f.values - err.values, f.values + err.values, color=colors[seasons], 
+        f = station.frequency.isel(month=seas==seasons).mean('month').values
+        err = station.err.sel(calendar_month=[12,1,2]).mean('calendar_month').values
+        ax.plot(f, z, color=colors[seasons], linewidth=1)
+        ax.fill_betweenx(z, f - err, f + err, color=colors[seasons], 
                          alpha=0.5)
     
     handles = []
@@ -179,9 +115,3 @@ for idx in np.arange(4, 8):
 fig.legend(handles, labels=season_plot, ncols=1, loc='r')
 fig.save('../Images/Paper/freq_by_height_seasons.pdf')
 
-freqs_df = pd.concat(freqs)
-freqs_df.to_csv('../Data/freq_by_height.csv')
-phis_df = pd.concat(phis)
-phis_df.to_csv('../Data/phis_by_height.csv')
-pd.concat(n).to_csv('../Data/n_freqs.csv')
-err.to_csv('../Data/err.csv')
@@ -4,28 +4,30 @@ for each month and plots the result."""
 import pandas as pd
 import proplot as pplt
 import numpy as np
+import sys
+sys.path.append('/Users/danielwatkins/Box/Thesis/02 Climatology of multilayered temperature inversions/')
+import invclim.launches as icl
 
 arctic_stations = pd.read_csv('../Data/arctic_stations_long.csv')
 arctic_stations.set_index('station_id', inplace=True)
 
-soundings = {}
+launches = {}
 for site in arctic_stations.index:
     try:
-        soundings[site] = pd.read_csv('../Data/Soundings/' + site + '-cleaned-soundings.csv')
-        soundings[site]['date'] = pd.to_datetime(soundings[site].date.values)        
-    except:
+        launches[site] = icl.read_launch_index('../Data/Archive/', site)
+    except FileNotFoundError:
         print('Missing sounding data for ' + site)
 
 pressure_resolution = {}
 sounding_count = {}
 sounding_count12 = {}
 sounding_count00 = {}
-for site in soundings:
-    daily = soundings[site].groupby('date').count().pressure
+for site in launches:
+    daily = pd.Series(launches[site]['n_levels'], index=pd.DatetimeIndex(launches[site]['date']))
     pressure_resolution[site] = daily.resample('1MS').mean()
     sounding_count[site] = daily.resample('1MS').count()
-    sounding_count00[site] = daily.loc[(daily.index.hour > 22) | (daily.index.hour < 2)].resample('1MS').count()
-    sounding_count12[site] = daily.loc[(daily.index.hour > 10) & (daily.index.hour < 14)].resample('1MS').count()
+    sounding_count00[site] = daily.loc[launches[site]['synoptic'] == 0].resample('1MS').count()
+    sounding_count12[site] = daily.loc[launches[site]['synoptic'] == 12].resample('1MS').count()
     
     
     
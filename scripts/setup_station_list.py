@@ -2,16 +2,28 @@
 From the IGRA2 station list, stations with data extending from before 2000 to past 2019 
 are selected. Name style is cleaned up and fixed. Time zones are added.
 
-Next, soundings matching the names in the station list are read in from
-the files in the folder Data/IGRA2_Derived. It is expected that the soundings
-have already been downloaded using siphon.simplewebservice.igra2 and placed 
-into Data/Soundings/
-
-Soundings are next read in, data below 500 hPa is selected, and the average number of levels
-is computed and added to the stations dataframe.
+Next, the launch indexes of the stations in the station list are read from
+the archive in Data/Archive/. It is expected that the soundings
+have already been downloaded and processed by download_igra_data.py
+
+The average number of levels (data below 500 hPa), the number of launches near 00Z and 12Z
+and the number of months without launches are taken from the station catalog (invclim.catalog),
+which only reads the launch indexes and is cached in Data/Cache/, so only new or updated stations
+are read again.
 """
 import pandas as pd
 import numpy as np
+import sys
+sys.path.append('/Users/danielwatkins/Box/Thesis/02 Climatology of multilayered temperature inversions/')
+import invclim.catalog as icc
+
+
+def add_missing(station_list, sites):
+    """Adds an empty row for each site not in station_list, as assigning
+    to station_list.loc[site, column] does."""
+    missing = [site for site in sites if site not in station_list.index]
+    return station_list.reindex(station_list.index.append(pd.Index(missing, name=station_list.index.name)))
+
 
 station_list = pd.read_fwf('../Data/igra2-station-list.txt',
                           header=None)
@@ -27,11 +39,7 @@ station_list.set_index('station_id', inplace=True)
 station_list = station_list.loc[:, ['name', 'lat', 'lon', 'elevation']]
 
 # Remove 'UA' from Canada/US names
-for name in station_list.name:
-    if name.split(' ')[-1] == 'UA':
-        station_list.loc[station_list.name == name, 'name'] = ' '.join(name.split(' ')[:-1])
-
-station_list['name'] = [name.title() for name in station_list.name]
+station_list['name'] = station_list.name.str.replace(' UA$', '', regex=True).str.title()
 
 # Adjust spelling of names and add special characters
 name_adjust = {
@@ -47,8 +55,8 @@ name_adjust = {
     'GLM00004220': 'Aasiaat',
     'USM00070261': 'Fairbanks'
 }
-for name in name_adjust:
-    station_list.loc[name, 'name'] = name_adjust[name]
+station_list = add_missing(station_list, name_adjust)
+station_list['name'] = station_list.index.to_series().map(name_adjust).fillna(station_list.name)
 
 
 # actual time zones
@@ -88,29 +96,24 @@ actual_time_zones = {
      'USM00070133': -9}
 
 station_list['time_zone'] = 0
-for site in actual_time_zones:
-    station_list.loc[site, 'time_zone'] = actual_time_zones[site]
+station_list = add_missing(station_list, actual_time_zones)
+station_list['time_zone'] = pd.Series(actual_time_zones).reindex(station_list.index).fillna(
+    station_list.time_zone).astype(station_list.time_zone.dtype)
 
 station_list['local_time_00Z'] = (station_list.time_zone) % 24
 station_list['local_time_12Z'] = (station_list.time_zone + 12) % 24
-station_list['local_time_00Z'] = [str(t) + ':00' for t in station_list.local_time_00Z]
-station_list['local_time_12Z'] = [str(t) + ':00' for t in station_list.local_time_12Z]
+station_list['local_time_00Z'] = station_list.local_time_00Z.astype(str) + ':00'
+station_list['local_time_12Z'] = station_list.local_time_12Z.astype(str) + ':00'
 
 station_list['lat'] = np.round(station_list.lat, 1)
 station_list['lon'] = np.round(station_list.lon, 1)
 station_list['elevation'] = np.round(station_list.elevation).astype(int)
 station_list.sort_values('lon', inplace=True)
 
-station_list.loc[:, 'region'] = np.nan
-for site in station_list.index:
-    if site[0] in ['U', 'C']:
-        station_list.loc[site, 'region'] = 'North America'
-    elif site[0] == 'G':
-        station_list.loc[site, 'region'] = 'Greenland'
-    elif site[0] in ['J']:
-        station_list.loc[site, 'region'] = 'Maritime'
-    elif site[0:2] == 'SV':
-        station_list.loc[site, 'region'] = 'Maritime'
+country = station_list.index.str[0]
+station_list['region'] = np.select([country.isin(['U', 'C']), country == 'G',
+                                    (country == 'J') | station_list.index.str.startswith('SV')],
+                                   ['North America', 'Greenland', 'Maritime'], None)
 
 station_list.loc[station_list.lon < -62, 'region'] = 'Eastern North America'
 station_list.loc[station_list.lon < -126, 'region'] = 'Western North America'
@@ -123,58 +126,21 @@ station_list.loc[station_list.index == 'RSM00020744', 'region'] = 'Maritime'
 # Save preliminary
 station_list.to_csv('../Data/arctic_stations_long.csv')
 
-soundings = {}
-for site in station_list.index:
-    try:
-        soundings[site] = pd.read_csv('../Data/Soundings/' + site + '-cleaned-soundings.csv')
-        soundings[site]['date'] = pd.to_datetime(soundings[site].date.values)
-        soundings[site] = soundings[site].loc[(soundings[site].date >= pd.to_datetime('2000-01-01 00:00')) &
-                                             (soundings[site].date <= pd.to_datetime('2019-12-31 23:00'))]
-    except:
-        print('Missing sounding data for ' + site)
-        
-pressure_resolution = {}
-for site in soundings:
-    daily = soundings[site].groupby('date').count().pressure
-    pressure_resolution[site] = daily.resample('1MS').mean()
-
-nlevels = pd.DataFrame(pressure_resolution).mean(axis=0).round(0).astype(int)
-station_list.loc[:,'n_levels'] = np.nan
-
-for site in station_list.index:
-    if site in nlevels:
-        station_list.loc[site, 'n_levels'] = nlevels[site]
-station_list['n_levels'].fillna(0, inplace=True)
-station_list['n_levels'] = station_list['n_levels'].astype(int)
-
-# select only levels below 500
-# select only times with hour 23, 0, 1 or 11, 12, 13
-station_list.loc[:,'n00Z'] = np.nan
-station_list.loc[:,'n12Z'] = np.nan
-sounding_counts = {}
-for site in station_list.index:
-    if site in soundings:
-        sounding_counts[site] = soundings[site].groupby('date').count().pressure.resample('1MS').count()
-        hours = np.array([name.hour for name, group in soundings[site].groupby('date')])
-        sel_idx_00 = (hours == 23) | (hours < 2) 
-        sel_idx_12 = (hours > 10) & (hours < 14)
-        station_list.loc[site,'n12Z'] = np.sum(sel_idx_12)
-        station_list.loc[site,'n00Z'] = np.sum(sel_idx_00)
-
-sounding_counts = (pd.DataFrame(sounding_counts).fillna(0) == 0)
-station_list.fillna(0, inplace=True)
-station_list['n00Z'] = station_list['n00Z'].astype(int)
-station_list['n12Z'] = station_list['n12Z'].astype(int)
-station_list['n_missing_months'] = sounding_counts.sum(axis=0)
-station_list['n_missing_months_post_2005'] = sounding_counts.loc[sounding_counts.index >= pd.to_datetime('2005-01-01')].sum(axis=0)
+catalog = icc.build_catalog('../Data/Archive/', station_list.index,
+                            start='2000-01-01 00:00', end='2019-12-31 23:00', post='2005-01-01',
+                            cache_path='../Data/Cache/station_catalog.json')
+for site in station_list.index.difference(catalog.index):
+    print('Missing sounding data for ' + site)
+
+station_list = station_list.join(catalog)
+station_list = station_list.fillna({cc: 0 for cc in station_list.columns if not cc.startswith('n_missing')})
+for cc in ['n_levels', 'n00Z', 'n12Z']:
+    station_list[cc] = station_list[cc].astype(int)
 
 station_list['begin_date'] = pd.to_datetime('2000-01-01 00:00')
 station_list['end_date'] = pd.to_datetime('2019-12-31 23:00')
-for site in station_list.index:
-    if site[0] == 'R':
-        station_list.loc[site, 'begin_date'] = pd.to_datetime('2005-01-01 00:00')
-    if site == 'GLM00004417':
-        station_list.loc[site, 'begin_date'] = pd.to_datetime('2012-01-01 00:00')
+station_list.loc[station_list.index.str[0] == 'R', 'begin_date'] = pd.to_datetime('2005-01-01 00:00')
+station_list.loc[station_list.index == 'GLM00004417', 'begin_date'] = pd.to_datetime('2012-01-01 00:00')
 begin_dates = {        
 'RSM00022217': '2000-06-01',
 'RSM00022522': '2009-04-01',
@@ -197,8 +163,9 @@ begin_dates = {
 'RSM00021946': '2005-04-01',
 'RSM00025428': '2007-06-01',
 'RSM00025123': '2005-04-01'}
-for site in begin_dates:
-    station_list.loc[site, 'begin_date'] = pd.to_datetime(begin_dates[site])
+station_list = add_missing(station_list, begin_dates)
+station_list['begin_date'] = pd.to_datetime(station_list.index.to_series().map(begin_dates)).fillna(
+    station_list.begin_date)
         
 
 # The number 7305 is the number of days from Jan 1, 2000 to Dec 31, 2019
@@ -0,0 +1,104 @@
+"""Columnar storage for sounding and layer tables.
+
+Each table is a Parquet dataset partitioned by station and year,
+
+    root/station=<station_id>/year=<yyyy>/part-0.parquet
+
+with floating point columns stored as float32 and dates as datetime64, so
+reading a station back needs no parsing. The readers only read the columns
+asked for, and skip the years and row groups outside the date range.
+"""
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+station_partitioning = ds.partitioning(
+    pa.schema([('station', pa.string()), ('year', pa.int32())]), flavor='hive')
+year_partitioning = ds.partitioning(pa.schema([('year', pa.int32())]), flavor='hive')
+
+
+def write_station(df, root, station, float_dtype='float32'):
+    """Writes the table df for one station under root, replacing anything
+    already stored for that station. df needs a datetime 'date' column; its
+    index is not stored. The new files are written to a hidden folder first
+    and moved into place, so readers never see a partly written station."""
+    df = df.reset_index(drop=True)
+    for cc in df.columns:
+        if df[cc].dtype.kind == 'f':
+            df[cc] = df[cc].astype(float_dtype)
+    years = df['date'].dt.year.values
+
+    final = os.path.join(root, 'station=' + station)
+    tmp = os.path.join(root, '.station=' + station + '.tmp')
+    old = os.path.join(root, '.station=' + station + '.old')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for year in np.unique(years):
+        path = os.path.join(tmp, 'year=' + str(year))
+        os.makedirs(path)
+        table = pa.Table.from_pandas(df.loc[years == year], preserve_index=False)
+        pq.write_table(table, os.path.join(path, 'part-0.parquet'))
+
+    if os.path.exists(final):
+        os.replace(final, old)
+    os.replace(tmp, final)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def list_stations(root):
+    """Returns the sorted station ids stored under root."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(root)
+                  if name.startswith('station='))
+
+
+def date_filter(start=None, end=None):
+    """Filter expression for start <= date <= end, including the year
+    partition so that whole files outside the range are skipped."""
+    expr = None
+    if start is not None:
+        start = pd.Timestamp(start)
+        expr = (ds.field('year') >= start.year) & (ds.field('date') >= pa.scalar(start))
+    if end is not None:
+        end = pd.Timestamp(end)
+        end_expr = (ds.field('year') <= end.year) & (ds.field('date') <= pa.scalar(end))
+        expr = end_expr if expr is None else expr & end_expr
+    return expr
+
+
+def read_station(root, station, columns=None, start=None, end=None):
+    """Reads the table for one station, with only the given columns (all if
+    None) and only the rows with start <= date <= end. Rows come back in the
+    order they were written. Returns an empty DataFrame if the station isn't
+    stored."""
+    path = os.path.join(root, 'station=' + station)
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(path, format='parquet', partitioning=year_partitioning)
+    df = dataset.to_table(columns=columns, filter=date_filter(start, end)).to_pandas()
+    if 'date' in df.columns:
+        df = df.sort_values('date', kind='stable').reset_index(drop=True)
+    return df.drop('year', axis=1, errors='ignore')
+
+
+def read_stations(root, stations=None, columns=None, start=None, end=None):
+    """Reads the tables of several stations (all stations if None) into one
+    DataFrame with a 'station' column, sorted by station and date. columns,
+    start and end are as in read_station."""
+    dataset = ds.dataset(root, format='parquet', partitioning=station_partitioning)
+    expr = date_filter(start, end)
+    if stations is not None:
+        station_expr = ds.field('station').isin(list(stations))
+        expr = station_expr if expr is None else expr & station_expr
+    if columns is not None:
+        columns = ['station'] + [cc for cc in columns if cc != 'station']
+    df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    df['station'] = df['station'].astype(str)
+    sort_by = ['station', 'date'] if 'date' in df.columns else ['station']
+    df = df.sort_values(sort_by, kind='stable').reset_index(drop=True)
+    return df.drop('year', axis=1, errors='ignore')
@@ -1 +1,1117 @@
-"""Tests of the main functions."""
\ No newline at end of file
+"""Tests of the main functions."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from . import legacy
+from .archive import SoundingArchive, write_archive
+from .cache import plan, run_cached
+from .calculate_inversions import find_inversions, run_stations
+from .cloudfinder import cloud_finder, find_clouds_batch
+from .core import merge_interstitial_layers, setup_dataset, setup_sounding
+from .invfinder import find_inversions_batch, find_inversions_ragged, invfinder
+
+params_default = {'max_embed_depth': 100, 'min_dz': 0, 'min_dp': 20,
+                  'min_dt': 2.5, 'min_drh': 20, 'rh_or_dt': True}
+params_none = {'max_embed_depth': 100, 'min_dz': 0, 'min_dp': 0,
+               'min_dt': 0, 'min_drh': 0, 'rh_or_dt': False}
+
+
+def make_sounding(seed, n_levels=30, date='2000-01-01 00:00'):
+    """Synthetic significant-level sounding with several inversions."""
+    rng = np.random.default_rng(seed)
+    height = np.sort(rng.uniform(0, 5000, n_levels))
+    height[0] = rng.uniform(0, 300)
+    height = np.round(height, 1)
+    temperature = np.round(255 + np.cumsum(rng.normal(0, 2, n_levels)), 1)
+    pressure = np.round(1013 * np.exp(-height / 8000), 1)
+    relative_humidity = np.round(rng.uniform(30, 100, n_levels), 1)
+    return pd.DataFrame({'date': pd.Timestamp(date), 'pressure': pressure, 'height': height,
+                         'temperature': temperature, 'relative_humidity': relative_humidity})
+
+
+def make_soundings(n_soundings, seed=0):
+    """Long-format table of synthetic soundings, 12 hours apart."""
+    dates = pd.date_range('2000-01-01', periods=n_soundings, freq='12h')
+    rng = np.random.default_rng(seed)
+    return pd.concat([make_sounding(seed + ii, n_levels=int(rng.integers(3, 40)), date=date)
+                      for ii, date in enumerate(dates)], ignore_index=True)
+
+
+@pytest.mark.parametrize('params', [params_default, params_none])
+@pytest.mark.parametrize('seed', range(20))
+def test_invfinder_matches_legacy(seed, params):
+    ds = setup_dataset(make_sounding(seed, n_levels=5 + 3 * seed))
+    pd.testing.assert_frame_equal(invfinder(ds, params), legacy.invfinder(ds, params))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_invfinder_sounding_matches_dataset(seed):
+    df = make_sounding(seed)
+    pd.testing.assert_frame_equal(invfinder(setup_sounding(df), params_default),
+                                  invfinder(setup_dataset(df), params_default))
+
+
+def test_sounding_to_dataset():
+    df = make_sounding(0)
+    sounding = setup_sounding(df)
+    assert sounding.temperature is sounding['temperature']
+    assert sounding.units['pressure'] == 'hPa'
+    ds = sounding.to_dataset()
+    assert str(ds['height'].data.units) == 'meter'
+    np.testing.assert_array_equal(ds['temperature'].data.magnitude, df['temperature'])
+
+
+def test_invfinder_no_inversion():
+    df = make_sounding(0)
+    df['temperature'] = 280 - df['height'] / 100
+    result = invfinder(setup_dataset(df), params_default)
+    assert list(result.index) == [0]
+    assert result['height_base'].isnull().all()
+    assert result.loc[0, 'date'] == pd.Timestamp('2000-01-01')
+
+
+@pytest.mark.parametrize('params', [params_default, params_none])
+def test_find_inversions_batch_matches_invfinder(params):
+    df = make_soundings(40)
+    df.loc[df.date == df.date.iloc[0], 'temperature'] = 300 - np.arange(
+        np.sum(df.date == df.date.iloc[0]))
+    expected = pd.concat([invfinder(setup_dataset(group.reset_index(drop=True)), params)
+                          for date, group in df.groupby('date')])
+    expected = expected.reset_index()
+    result = find_inversions_batch(df, params).loc[:, expected.columns]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    # launches out of order, levels within each launch still surface up
+    reversed_df = pd.concat([group for date, group in df.groupby('date')][::-1])
+    result = find_inversions_batch(reversed_df, params).loc[:, expected.columns]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def make_cloudy_sounding(date='2000-01-01 00:00'):
+    """Sounding every 100 m with one merged cloud layer (1000-1700 m, with a
+    moist gap at 1550 m), a thin cloud at 2500 m, a cloud at 3000-3300 m,
+    and a moist layer too dry to be cloud at 4000-4200 m."""
+    height = np.sort(np.append(np.arange(0, 5001, 100.), 1550))
+    rh = np.full(len(height), 50.)
+    rh[(height >= 1000) & (height <= 1500)] = 97
+    rh[height == 1550] = 85
+    rh[(height >= 1600) & (height <= 1700)] = 96
+    rh[height == 2500] = 99
+    rh[(height >= 3000) & (height <= 3300)] = 96
+    rh[(height >= 4000) & (height <= 4200)] = 91
+    return pd.DataFrame({'date': pd.Timestamp(date), 'pressure': 1013 * np.exp(-height / 8000),
+                         'height': height, 'temperature': 270 - height / 200,
+                         'relative_humidity': rh, 'adjusted_relative_humidity': rh})
+
+
+def test_cloud_finder():
+    df = make_cloudy_sounding()
+    clouds = cloud_finder(setup_sounding(df))
+    assert clouds.index.name == 'cloud_number'
+    np.testing.assert_array_equal(clouds.height_base, [1000, 3000])
+    np.testing.assert_array_equal(clouds.height_top, [1700, 3300])
+
+    # with a smaller max_gap, only the moist interstitial level keeps them merged
+    params = {'height_thresh': 75, 'max_gap': 50, 'min_thickness': 30.5}
+    clouds = cloud_finder(setup_sounding(df), params)
+    np.testing.assert_array_equal(clouds.height_base, [1000, 3000])
+    df.loc[df.height == 1550, 'adjusted_relative_humidity'] = 60
+    clouds = cloud_finder(setup_sounding(df), params)
+    np.testing.assert_array_equal(clouds.height_base, [1000, 1600, 3000])
+
+
+def test_find_clouds_batch_matches_cloud_finder():
+    df = make_soundings(20)
+    df['adjusted_relative_humidity'] = df['relative_humidity']
+    df = pd.concat([df, make_cloudy_sounding('1999-12-31 12:00')], ignore_index=True)
+    expected = pd.concat([cloud_finder(setup_sounding(group)) for date, group in df.groupby('date')])
+    result = find_clouds_batch(df).loc[:, expected.reset_index().columns]
+    pd.testing.assert_frame_equal(result, expected.reset_index(), check_dtype=False)
+
+
+def test_run_stations_output_independent_of_workers(tmp_path):
+    pytest.importorskip('pyarrow')
+    from .store import write_station
+
+    sites = ['XXM00000001', 'XXM00000002', 'XXM00000003']
+    for ii, site in enumerate(sites):
+        write_station(make_soundings(30, seed=ii), str(tmp_path / 'soundings'), site)
+    for workers in [1, 3]:
+        failed = run_stations(sites + ['missing'], str(tmp_path / 'soundings'),
+                              str(tmp_path / str(workers)), workers=workers)
+        assert list(failed) == ['missing']
+    files = sorted(path.relative_to(tmp_path / '1') for path in (tmp_path / '1').rglob('*.parquet'))
+    assert len(files) == len(sites)
+    for path in files:
+        assert (tmp_path / '1' / path).read_bytes() == (tmp_path / '3' / path).read_bytes()
+
+
+def test_run_stations_profile(tmp_path):
+    pytest.importorskip('pyarrow')
+    import json
+    import pstats
+    from . import instrument
+    from .store import write_station
+
+    instrument.reset()
+    find_inversions(make_soundings(10))
+    assert instrument.stats == {}  # nothing is recorded unless enabled
+
+    sites = ['XXM00000001', 'XXM00000002']
+    for ii, site in enumerate(sites):
+        write_station(make_soundings(30, seed=ii), str(tmp_path / 'soundings'), site)
+    profile_dir = tmp_path / 'profile'
+    run_stations(sites, str(tmp_path / 'soundings'), str(tmp_path / 'inversions'), workers=2,
+                 profile_dir=str(profile_dir), cprofile=True)
+    summary = json.loads((profile_dir / 'summary.json').read_text())
+    assert sorted(summary) == sites + ['all']
+    stage = summary['XXM00000001']['invfinder.find_inversions_ragged']
+    assert stage['calls'] == 1 and stage['soundings'] == 30
+    assert summary['all']['core.merge_embedded_layers']['iterations'] >= 2
+    assert summary['all']['calculate_inversions.write']['calls'] == 2
+    header = (profile_dir / 'summary.csv').read_text().splitlines()[0].split(',')
+    assert header[:4] == ['station', 'stage', 'calls', 'seconds'] and 'soundings' in header
+    assert pstats.Stats(str(profile_dir / 'XXM00000001.prof')).total_calls > 0
+    assert not instrument.enabled
+
+    # The serial path leaves the caller's recording state and registry alone
+    instrument.enable()
+    instrument.record('caller', 1., 1)
+    try:
+        run_stations(sites[:1], str(tmp_path / 'soundings'), str(tmp_path / 'inversions'),
+                     workers=1, profile_dir=str(profile_dir))
+        assert instrument.enabled and instrument.stats == {'caller': {'calls': 1, 'seconds': 1.}}
+    finally:
+        instrument.enable(False)
+        instrument.reset()
+    summary = json.loads((profile_dir / 'summary.json').read_text())
+    assert summary['XXM00000001']['calculate_inversions.write']['calls'] == 1
+
+
+def test_main_dry_run_recalculate(tmp_path, capsys):
+    pytest.importorskip('pyarrow')
+    from .calculate_inversions import main
+    from .store import write_station
+
+    write_station(make_soundings(150), str(tmp_path / 'soundings'), 'XXM00000001')
+    pd.DataFrame({'station_id': ['XXM00000001']}).to_csv(tmp_path / 'stations.csv', index=False)
+    args = ['--stations', str(tmp_path / 'stations.csv'), '--dataloc', str(tmp_path / 'soundings'),
+            '--saveloc', str(tmp_path / 'inversions'), '--cache', str(tmp_path / 'cache'),
+            '--workers', '1']
+    assert main(args) == 0
+    capsys.readouterr()
+    main(args + ['--dry-run'])
+    assert 'XXM00000001 0 of 3 months' in capsys.readouterr().out
+    # The cache is kept, but the report is that of a run that clears it
+    main(args + ['--dry-run', '--recalculate'])
+    assert 'XXM00000001 3 of 3 months' in capsys.readouterr().out
+    assert len(list((tmp_path / 'cache' / 'XXM00000001').iterdir())) > 0
+
+
+def legacy_check_interstitial_thickness(inv_df, max_embed_depth=100):
+    """The per-launch merge step calculate_inversions.py used before
+    merge_interstitial_layers, kept as a reference. It has two known bugs:
+    relative_humidity_top is not copied to the merged layer, and the highest
+    interstitial layer is not checked again after the first merge."""
+    if len(inv_df) > 1:
+        interstitial = []
+        for idx in inv_df.index[1:]:
+            interstitial.append(inv_df.loc[idx, 'height_base'] - inv_df.loc[idx-1, 'height_top'])
+        interstitial = np.array(interstitial)
+        while np.any(interstitial < max_embed_depth):
+            idx = 0
+            for idx in range(len(interstitial)):
+                if interstitial[idx] > max_embed_depth:
+                    idx += 1
+                else:
+                    break
+            for col in inv_df.columns:
+                if len(col.split('_')) > 1:
+                    if col.split('_')[1] == 'top':
+                        inv_df.loc[inv_df.index[idx], col] = inv_df.loc[inv_df.index[idx+1], col]
+            inv_df.drop(inv_df.index[idx+1], inplace=True)
+            inv_df['inv_number'] = np.arange(1, len(inv_df) + 1)
+            if len(inv_df) > 1:
+                interstitial = []
+                for idx in range(1, len(inv_df)-1):
+                    interstitial.append(inv_df.loc[
+                        inv_df.index[idx], 'height_base'] - inv_df.loc[inv_df.index[idx-1], 'height_top'])
+                interstitial = np.array(interstitial)
+            else:
+                break
+    return inv_df
+
+
+def legacy_merge_to_convergence(inv_df, max_embed_depth):
+    """Repeats the legacy merge until nothing changes, which works around the
+    second bug, since every call starts by checking all interstitial layers."""
+    while True:
+        n_layers = len(inv_df)
+        inv_df = legacy_check_interstitial_thickness(inv_df.reset_index(drop=True), max_embed_depth)
+        if len(inv_df) == n_layers:
+            return inv_df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('max_embed_depth', [50, 100, 300])
+def test_merge_interstitial_layers_matches_legacy(max_embed_depth):
+    inv = find_inversions_batch(make_soundings(60), params_none)
+    assert inv.groupby('date').size().max() > 3
+    result = merge_interstitial_layers(inv, max_embed_depth)
+    assert len(result) < len(inv)
+    expected = pd.concat([legacy_merge_to_convergence(group, max_embed_depth)
+                          for date, group in inv.groupby('date')], ignore_index=True)
+    columns = [cc for cc in inv.columns if cc != 'relative_humidity_top']
+    pd.testing.assert_frame_equal(result.loc[:, columns], expected.loc[:, columns])
+
+    # the merged layer takes all of its top values from the highest layer
+    merged = result.merge(inv, on=['date', 'index_top'], suffixes=('', '_original'))
+    np.testing.assert_array_equal(merged.relative_humidity_top,
+                                  merged.relative_humidity_top_original)
+
+
+def test_merge_interstitial_layers_equal_gap():
+    # Gaps of exactly max_embed_depth are merged only below a thinner gap
+    gaps = {'2000-01-01': [100, 50], '2000-01-02': [50, 100], '2000-01-03': [100],
+            '2000-01-04': [100, 100, 20, 100]}
+    rows = []
+    for date, launch_gaps in gaps.items():
+        base = 0.
+        for number, gap in enumerate([0] + launch_gaps):
+            base += gap
+            rows.append({'date': pd.Timestamp(date), 'inv_number': number + 1,
+                         'height_base': base, 'height_top': base + 200})
+            base += 200
+    inv = pd.DataFrame(rows)
+    result = merge_interstitial_layers(inv, 100)
+    assert list(result.groupby('date').size()) == [1, 2, 2, 2]
+    expected = pd.concat([legacy_merge_to_convergence(group, 100)
+                          for date, group in inv.groupby('date')], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_merge_interstitial_layers_single_sounding():
+    inv = invfinder(setup_sounding(make_sounding(3, n_levels=40)), params_none)
+    result = merge_interstitial_layers(inv, 300)
+    expected = merge_interstitial_layers(inv.reset_index(), 300).set_index('inv_number')
+    pd.testing.assert_frame_equal(result, expected)
+    assert list(result.index) == list(range(1, len(result) + 1))
+    assert np.all(result.height_base.values[1:] - result.height_top.values[:-1] >= 300)
+
+
+def test_store_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    from .store import list_stations, read_station, read_stations, write_station
+
+    df = make_soundings(1500)
+    write_station(df, str(tmp_path), 'AAA')
+    write_station(df.iloc[:100], str(tmp_path), 'BBB')
+    write_station(df, str(tmp_path), 'BBB')
+    assert list_stations(str(tmp_path)) == ['AAA', 'BBB']
+
+    result = read_station(str(tmp_path), 'AAA', columns=['date', 'height'],
+                          start='2001-01-01', end='2001-12-31 23:00')
+    expected = df.loc[(df.date >= '2001-01-01') & (df.date <= '2001-12-31 23:00'), ['date', 'height']]
+    assert result.height.dtype == np.float32
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True), check_dtype=False)
+
+    result = read_stations(str(tmp_path), columns=['date', 'temperature'], start='2001-06-01')
+    assert list(result.columns) == ['station', 'date', 'temperature']
+    assert (result.station.value_counts() == np.sum(df.date >= '2001-06-01')).all()
+
+
+def test_archive(tmp_path):
+    df = make_soundings(200)
+    variables = ['pressure', 'height', 'temperature', 'relative_humidity']
+    df[variables] = df[variables].astype(np.float32)
+    write_archive(df, str(tmp_path), 'AAA')
+    archive = SoundingArchive(str(tmp_path), 'AAA')
+    assert len(archive) == 200
+
+    date = df.date.unique()[17]
+    sounding = archive.sounding(date)
+    assert isinstance(sounding.temperature.base, np.memmap)
+    np.testing.assert_array_equal(sounding.temperature, df.loc[df.date == date, 'temperature'])
+    with pytest.raises(KeyError):
+        archive.sounding('1999-01-01')
+
+    start, end = '2000-02-01', '2000-02-20 12:00'
+    selected = df.loc[(df.date >= start) & (df.date <= end)]
+    result = find_inversions_ragged(*archive.select(start, end), params_none)
+    expected = find_inversions_batch(selected, params_none)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_run_cached_recomputes_changed_months(tmp_path):
+    pytest.importorskip('pyarrow')
+    df = make_soundings(240)
+    calls = []
+
+    def func(chunk, params):
+        calls.append(chunk.date.iloc[0].strftime('%Y-%m'))
+        return find_inversions(chunk, params)
+
+    expected = find_inversions(df, params_none)
+    pd.testing.assert_frame_equal(run_cached(df, func, params_none, 1, str(tmp_path)), expected)
+    assert calls == ['2000-01', '2000-02', '2000-03', '2000-04']
+
+    calls.clear()
+    pd.testing.assert_frame_equal(run_cached(df, func, params_none, 1, str(tmp_path)), expected)
+    assert calls == []
+
+    changed = df.copy()
+    changed.loc[changed.date == '2000-02-10 12:00', 'temperature'] += 5
+    pd.testing.assert_frame_equal(run_cached(changed, func, params_none, 1, str(tmp_path)),
+                                  find_inversions(changed, params_none))
+    assert calls == ['2000-02']
+
+    chunks, removed = plan(df.loc[df.date < '2000-04-01'], params_default, 1, str(tmp_path))
+    assert not any(chunks[label][3] for label in chunks)
+    assert removed == ['2000-04']
+
+
+def test_read_derived(tmp_path):
+    from .igra import (header_fields, import_soundings, iter_batches, iter_soundings, read_derived,
+                       write_derived)
+    from .thermo import saturation_vapor_pressure_liquid
+    df = make_soundings(30)
+    path = str(tmp_path / 'USM00070026-drvd.txt.zip')
+    write_derived(path, df)
+
+    data, header = read_derived(path, begin='2000-01-03', end='2000-01-10 00:00')
+    selected = df.loc[(df.date >= '2000-01-03') & (df.date <= '2000-01-10')].reset_index(drop=True)
+    assert list(header.date) == list(selected.date.unique())
+    assert (header.site_id == 'USM00070026').all()
+    assert np.isnan(header.cape).all()
+    pd.testing.assert_series_equal(data.date, selected.date, check_dtype=False)
+    np.testing.assert_allclose(data.pressure, selected.pressure, atol=0.006)
+    np.testing.assert_allclose(data.calculated_height, np.round(selected.height))
+    np.testing.assert_allclose(data.temperature, selected.temperature)
+    np.testing.assert_allclose(data.calculated_relative_humidity, selected.relative_humidity)
+    assert data.reported_height.isnull().all()
+
+    # Filters applied while reading, in batches smaller than the file
+    filters = {'min_pressure': 900, 'hours': (0,), 'variables': ['pressure', 'temperature']}
+    data = read_derived(path, **filters)[0]
+    selected = df.loc[(np.round(df.pressure, 2) >= 900) & (df.date.dt.hour == 0)]
+    assert list(data.columns) == ['date', 'pressure', 'temperature']
+    np.testing.assert_allclose(data.temperature, selected.temperature)
+    batches = list(iter_batches(path, batch_size=4, **filters))
+    assert [len(dates) for offsets, columns, dates, header in batches] == [4, 4, 4, 3]
+    offsets, columns, dates, header = batches[1]
+    assert columns['temperature'].dtype == np.float32
+    np.testing.assert_array_equal(columns['index'][offsets[1]:offsets[2]],
+                                  np.arange(offsets[2] - offsets[1]))
+    soundings = list(iter_soundings(path, **filters))
+    assert len(soundings) == 15 and soundings[0].units['pressure'] == 'hPa'
+    np.testing.assert_allclose(np.concatenate([sounding.temperature for sounding in soundings]),
+                               selected.temperature, rtol=1e-6)
+
+    # The steps of scripts/download_igra_data.py
+    df['vapor_pressure'] = df.relative_humidity / 100 * saturation_vapor_pressure_liquid(
+        df.temperature.values)
+    write_derived(path, df.loc[~((df.date == '2000-01-05 12:00') & (df.pressure < 980))])
+    soundings = import_soundings(path, end='2000-01-10 00:00')
+    assert '2000-01-05 12:00' not in set(soundings.date.astype(str))  # 5 levels or fewer
+    assert soundings.groupby('date').size().min() > 5 and (soundings.pressure >= 500).all()
+    assert soundings.equivalent_potential_temperature.notnull().all()
+    assert (soundings.dewpoint_temperature <= soundings.temperature + 0.1).all()
+
+    # Every missing value sentinel reads as NaN
+    path = str(tmp_path / 'sentinels-drvd.txt')
+    rows = [[100000, -99999, 110, 2731, -8888, 2731, -88888, 2740, 2741, 6112, 6112, 1000, 1000,
+             -9999, 15, 0, -8888, 0, 300],
+            [90000, 1000, 1000, -8888, 65, -9999, 33, -88888, 2900, 3000, 4000, -99999, 750, 12,
+             -99999, 1, 20, -88888, 290]]
+    with open(path, 'w') as f:
+        f.write('#%-11s %4d %02d %02d %02d %04d%5d ' % ('USM00070026', 2000, 1, 1, 0, 0, 2) +
+                '%6d' * 20 % ((-8888, -88888, -9999, -99999) * 5) + '\n')
+        f.writelines(' '.join('%7d' % value for value in row) + '\n' for row in rows)
+    data, header = read_derived(path)
+    values = np.array(rows, dtype=float)
+    values[np.isin(values, [-99999, -88888, -9999, -8888])] = np.nan
+    np.testing.assert_array_equal(np.isnan(data.iloc[:, 1:].to_numpy(dtype=float)), np.isnan(values))
+    assert header[[name for name, first, last, factor in header_fields[7:]]].isnull().all().all()
+
+
+def test_download_resumes_from_directory(tmp_path):
+    from .download import (DirectorySource, PermanentError, download_station, download_stations,
+                           read_checkpoint, write_checkpoint)
+    from .igra import write_derived
+    source_dir, dest = tmp_path / 'source', str(tmp_path / 'dest')
+    source_dir.mkdir()
+    for station in ['AAA', 'BBB']:
+        write_derived(str(source_dir / (station + '-drvd.txt.zip')), make_soundings(20))
+    opened = []
+
+    class Source(DirectorySource):
+        def open(self, station, offset=0, validator=None):
+            stream, start, validator, size = super().open(station, offset, validator)
+            opened.append((station, start))
+            return stream, start, validator, size
+
+    source = Source(str(source_dir))
+    content = (source_dir / 'AAA-drvd.txt.zip').read_bytes()
+
+    # A transfer interrupted half way through is continued, not restarted
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'dest' / '.AAA-drvd.txt.zip.part').write_bytes(content[:100])
+    stat = (source_dir / 'AAA-drvd.txt.zip').stat()
+    write_checkpoint(dest, 'AAA', {'validator': '{}-{}'.format(stat.st_size, stat.st_mtime_ns),
+                                   'size': stat.st_size})
+    # but not if the file the part came from changed
+    (tmp_path / 'dest' / '.BBB-drvd.txt.zip.part').write_bytes(b'x' * 100)
+    write_checkpoint(dest, 'BBB', {'validator': 'old', 'size': 1000})
+
+    failed = download_stations(source, ['AAA', 'BBB', 'CCC'], dest, workers=2)
+    assert sorted(failed) == ['CCC'] and 'No such file' in failed['CCC']
+    assert sorted(opened) == [('AAA', 100), ('BBB', 0)]
+    assert (tmp_path / 'dest' / 'AAA-drvd.txt.zip').read_bytes() == content
+    assert ((tmp_path / 'dest' / 'BBB-drvd.txt.zip').read_bytes() ==
+            (source_dir / 'BBB-drvd.txt.zip').read_bytes())
+    assert read_checkpoint(dest, 'AAA')['complete']
+    assert not read_checkpoint(dest, 'CCC')['complete']
+    assert not (tmp_path / 'dest' / '.AAA-drvd.txt.zip.part').exists()
+
+    opened.clear()
+    assert download_stations(source, ['AAA', 'BBB'], dest) == {}
+    assert opened == []
+    with pytest.raises(PermanentError):
+        download_station(source, 'CCC', dest)
+
+
+def test_download_retries_http_errors(tmp_path):
+    import http.server
+    import threading
+    from .download import HTTPSource, download_station, download_stations, read_checkpoint
+    content = b'0123456789' * 1000
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path != '/AAA-drvd.txt.zip':
+                self.send_error(404)
+            elif len(requests) < 3:
+                self.send_error(503)
+            else:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        source = HTTPSource('http://127.0.0.1:%d' % server.server_address[1], timeout=5)
+        path = download_station(source, 'AAA', str(tmp_path), retries=3, backoff=0.01)
+        assert open(path, 'rb').read() == content
+        assert read_checkpoint(str(tmp_path), 'AAA')['attempts'] == 3
+
+        requests.clear()
+        failed = download_stations(source, ['BBB'], str(tmp_path), retries=3, backoff=0.01)
+        assert '404' in failed['BBB'] and len(requests) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_resumes_http_with_if_range(tmp_path):
+    import http.server
+    import threading
+    from .download import HTTPSource, download_station, read_checkpoint, write_checkpoint
+    files = {'v1': b'0123456789' * 1000, 'v2': b'abcdefghij' * 1200}
+    state = {'version': 'v1', 'cut': True}
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests.append((self.headers.get('Range'), self.headers.get('If-Range')))
+            content = files[state['version']]
+            etag = '"' + state['version'] + '"'
+            start = 0
+            if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+                start = int(self.headers['Range'][len('bytes='):-1])
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, len(content) - 1, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(content) - start))
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            if state['cut']:
+                # Drop the connection half way through
+                state['cut'] = False
+                self.wfile.write(content[start:start + 4000])
+            else:
+                self.wfile.write(content[start:])
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        source = HTTPSource('http://127.0.0.1:%d' % server.server_address[1], timeout=5)
+        path = download_station(source, 'AAA', str(tmp_path), retries=3, backoff=0.01)
+        assert open(path, 'rb').read() == files['v1']
+        assert requests == [(None, None), ('bytes=4000-', '"v1"')]
+        checkpoint = read_checkpoint(str(tmp_path), 'AAA')
+        assert checkpoint['validator'] == '"v1"' and checkpoint['size'] == 10000
+
+        # The file changed since the part was downloaded: the server answers
+        # 200 and the transfer starts over instead of appending to the part
+        part = tmp_path / '.AAA-drvd.txt.zip.part'
+        for version, size, expected in [('v2', 10000, [('bytes=4000-', '"v1"')]),
+                                        ('v1', 9999, [('bytes=4000-', '"v1"'), (None, None)])]:
+            requests.clear()
+            state['version'] = version
+            part.write_bytes(files['v1'][:4000])
+            write_checkpoint(str(tmp_path), 'AAA', {'validator': '"v1"', 'size': size})
+            path = download_station(source, 'AAA', str(tmp_path), retries=3, backoff=0.01)
+            assert open(path, 'rb').read() == files[version]
+            # A Content-Range total other than the size of the part's file also starts over
+            assert requests == expected
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def legacy_convert_rh(temperature, vapor_pressure):
+    """convert_rh from import_soundings, which interpolated the ice table with scipy."""
+    from scipy.interpolate import interp1d
+    tref = np.array([203.15, 213.15, 223.15, 233.15, 238.15,
+                     243.15, 248.15, 253.15, 258.15, 263.15, 268.15, 273.15])
+    eiref = np.array([0.26, 1.08, 3.9, 12.85, 22.36, 38.02, 63.3, 103.28, 165.32, 259.92,
+                      401.78, 611.15]) / 100
+    satvap_ice = interp1d(x=tref, y=eiref, kind='quadratic', fill_value=np.nan)
+    tc = temperature - 273.15
+    rh = vapor_pressure / (6.112 * np.exp(17.67 * tc / (tc + 243.5)))
+    adj_idx = (temperature < 273.15) & (temperature > 203.15)
+    rh[adj_idx] = vapor_pressure[adj_idx] / satvap_ice(temperature[adj_idx])
+    rh[temperature < 203.15] = np.nan
+    return rh * 100
+
+
+def test_adjusted_relative_humidity():
+    pytest.importorskip('scipy')
+    from .thermo import adjusted_relative_humidity, saturation_vapor_pressure_liquid
+    rng = np.random.default_rng(0)
+    temperature = np.concatenate([rng.uniform(195, 300, 10000), [203.15, 273.15, np.nan]])
+    vapor_pressure = saturation_vapor_pressure_liquid(temperature) * rng.uniform(0.1, 1, len(temperature))
+    expected = legacy_convert_rh(temperature, vapor_pressure)
+    np.testing.assert_allclose(adjusted_relative_humidity(temperature, vapor_pressure), expected,
+                               rtol=1e-12)
+
+    # float32 stays float32, and out may be one of the inputs
+    t32 = temperature.astype(np.float32)
+    e32 = vapor_pressure.astype(np.float32)
+    result = adjusted_relative_humidity(t32, e32, out=e32)
+    assert result is e32 and result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-4)
+
+
+def test_thermo_matches_metpy():
+    mpcalc = pytest.importorskip('metpy.calc')
+    from metpy.units import units
+    from .thermo import dewpoint, equivalent_potential_temperature, saturation_vapor_pressure_ambaum
+    rng = np.random.default_rng(0)
+    pressure = rng.uniform(500, 1050, 5000)
+    temperature = rng.uniform(210, 305, 5000)
+    vapor_pressure = rng.uniform(0.01, 1, 5000) * 6.112 * np.exp(
+        17.67 * (temperature - 273.15) / (temperature - 29.65))
+
+    expected = mpcalc.dewpoint(vapor_pressure * units.hPa).to('K').magnitude
+    td = dewpoint(vapor_pressure)
+    np.testing.assert_allclose(td, expected, rtol=1e-10)
+
+    expected = mpcalc.equivalent_potential_temperature(
+        pressure * units.hPa, temperature * units.K, td * units.K).to('K').magnitude
+    np.testing.assert_allclose(equivalent_potential_temperature(pressure, temperature, td),
+                               expected, rtol=1e-10)
+    result = equivalent_potential_temperature(pressure.astype(np.float32), temperature.astype(np.float32),
+                                              td.astype(np.float32))
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-5)
+
+    expected = mpcalc.saturation_vapor_pressure(temperature * units.K).to('hPa').magnitude
+    np.testing.assert_allclose(saturation_vapor_pressure_ambaum(temperature), expected, rtol=1e-12)
+
+
+def legacy_inv_indicator(inv_df, zgrid):
+    """inv_indicator from inversion_frequency_by_height.py."""
+    ind_list = []
+    names = []
+    for name, group in inv_df.groupby('date'):
+        ind = zgrid * 0
+        for height_base, height_top in zip(group.height_base, group.height_top):
+            ind += np.array((height_base <= zgrid) & (height_top > zgrid))
+        ind_list.append(ind)
+        names.append(name)
+    return pd.DataFrame(np.vstack(ind_list), index=names, columns=zgrid)
+
+
+def test_inversion_indicator_and_frequency():
+    from .frequency import (inversion_indicator, monthly_frequency, season_number,
+                            seasonal_frequency, seasons, unpack_indicator)
+    df = make_soundings(400)
+    df = df.loc[(df.date < '2000-03-05') | (df.date > '2000-04-20')]  # a month without launches
+    inv = find_inversions(df, params_none)
+    zgrid = 12.5 + np.arange(25, 3000, 50)
+
+    expected = legacy_inv_indicator(inv, zgrid)
+    dates, indicator = inversion_indicator(inv, zgrid)
+    np.testing.assert_array_equal(dates, expected.index.values)
+    np.testing.assert_array_equal(indicator, expected.values)
+    packed = inversion_indicator(inv, zgrid, packed=True)[1]
+    assert packed.shape == (len(dates), 8)
+    np.testing.assert_array_equal(unpack_indicator(packed, len(zgrid)), indicator)
+
+    months, frequency, counts = monthly_frequency(dates, indicator)
+    resampled = expected.resample('1MS')
+    np.testing.assert_array_equal(months, resampled.mean().index.values.astype('datetime64[M]'))
+    np.testing.assert_allclose(frequency, resampled.mean().values)
+    np.testing.assert_array_equal(counts, resampled.count().iloc[:, 1].values)
+
+    monthly = resampled.mean()
+    season = np.array(seasons)[season_number(months)]
+    np.testing.assert_allclose(seasonal_frequency(months, frequency)[0],
+                               monthly.loc[season == 'DJF'].mean(axis=0).values)
+    assert list(season[:4]) == ['DJF', 'DJF', 'MAM', 'MAM']
+
+
+def legacy_get_phi(indicator_df):
+    """get_phi from inversion_frequency_by_height.py."""
+    corr_coef = np.zeros((12, len(indicator_df.columns)))
+    for ii, month in enumerate(np.arange(1, 13)):
+        for jj, col in enumerate(indicator_df.columns):
+            corr_coef[ii, jj] = indicator_df.loc[
+                indicator_df.index.month == month, col].shift(1).corr(
+                indicator_df.loc[indicator_df.index.month == month, col], method='pearson')
+    return pd.DataFrame(data=corr_coef, index=np.arange(1, 13), columns=indicator_df.columns)
+
+
+def test_lag1_autocorrelation_matches_get_phi():
+    from .frequency import (inversion_indicator, lag1_autocorrelation, monthly_frequency,
+                            season_number, standard_error_adj)
+    df = make_soundings(1600)
+    inv = find_inversions(df, params_none)
+    zgrid = 12.5 + np.arange(25, 6000, 100)  # never an inversion above 5 km
+    dates, indicator = inversion_indicator(inv, zgrid)
+    indicator_df = pd.DataFrame(indicator, index=dates, columns=zgrid)
+
+    # Heights that are never or always in an inversion have no correlation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = legacy_get_phi(indicator_df)
+    phi = lag1_autocorrelation(dates, indicator)
+    assert np.isnan(phi).any()
+    np.testing.assert_allclose(phi, expected.values, rtol=1e-10, atol=1e-12)
+
+    months, frequency, counts = monthly_frequency(dates, indicator)
+    f = pd.DataFrame(frequency, columns=zgrid)
+    v = (1 + expected) / (1 - expected)
+    v[v < 1] = 1
+    expected_se = np.sqrt(f.mean(axis=0) * (1 - f.mean(axis=0)) / len(f) * v)
+    np.testing.assert_allclose(standard_error_adj(frequency, phi), expected_se, rtol=1e-10)
+
+    season = np.array(['DJF', 'MAM', 'JJA', 'SON'])[season_number(dates.astype('datetime64[M]'))]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = pd.DataFrame(indicator_df.loc[season == 'JJA'].values).apply(
+            lambda x: x.shift(1).corr(x))
+    np.testing.assert_allclose(lag1_autocorrelation(dates, indicator, by='season')[2],
+                               expected.values, rtol=1e-10)
+
+
+def test_accumulators_merge_chunks():
+    from .accumulators import accumulate_layers
+    from .frequency import calendar_groups, inversion_indicator, lag1_autocorrelation
+    df = make_soundings(1600)
+    inv = find_inversions(df, params_none)
+    zgrid = 12.5 + np.arange(25, 6000, 100)
+    dates, indicator = inversion_indicator(inv, zgrid)
+
+    # Three chunks of one station accumulated separately, as by three workers
+    bounds = [pd.Timestamp('2000-01-01'), pd.Timestamp('2000-07-20'), pd.Timestamp('2001-02-03'),
+              pd.Timestamp('2003-01-01')]
+    parts = [accumulate_layers(inv.loc[(inv.date >= start) & (inv.date < end)], 'AAA', zgrid)
+             for start, end in zip(bounds[:-1], bounds[1:])]
+    other_station = accumulate_layers(inv.loc[inv.date < '2000-03-01'], 'BBB', zgrid)
+    heights = parts[0][0].merge(parts[1][0]).merge(parts[2][0]).merge(other_station[0])
+    regrouped = parts[0][0].merge(parts[1][0].merge(parts[2][0]))
+    histograms = parts[0][1].merge(parts[1][1]).merge(parts[2][1])
+
+    group = calendar_groups(dates, 'month')[0]
+    phi = lag1_autocorrelation(dates, indicator)
+    result = heights.to_frame()
+    for month in [0, 5, 11]:
+        stats = result.loc[('AAA', month)]
+        assert (stats.n == np.sum(group == month)).all()
+        np.testing.assert_allclose(stats['mean'], indicator[group == month].mean(axis=0))
+        np.testing.assert_allclose(stats.phi, phi[month], rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(regrouped.autocorrelation(('AAA', month)), phi[month],
+                                   rtol=1e-9, atol=1e-12)
+    assert result.loc[('BBB', 0)].n.iloc[0] == np.sum(dates < np.datetime64('2000-02-01'))
+
+    counts = histograms.to_frame().groupby('property')['count'].sum()
+    layers = inv.loc[inv.height_base.notnull()]
+    assert counts['height_base'] == len(layers)
+    assert counts['depth'] == np.sum(layers.height_top - layers.height_base <= 3000)
+
+    # An empty chunk adds nothing
+    heights.add(('AAA', 0), np.empty((0, len(zgrid))))
+    assert heights.stats[('AAA', 0)]['n'] == np.sum(group == 0)
+
+
+def test_accumulate_store(tmp_path):
+    pytest.importorskip('pyarrow')
+    from .accumulators import accumulate_layers, accumulate_store
+    from .store import read_station, write_station
+    inv = find_inversions(make_soundings(1600), params_none)
+    write_station(inv, str(tmp_path), 'AAA')
+    heights = 12.5 + np.arange(25, 3000, 100)
+    statistics, histograms = accumulate_store(str(tmp_path), ['AAA', 'missing'], [100, 0], heights,
+                                              end='2001-06-30 23:00')
+    # The store keeps float32, so compare with the table as stored
+    expected = accumulate_layers(read_station(str(tmp_path), 'AAA', end='2001-06-30 23:00'), 'AAA',
+                                 heights + 100)
+    pd.testing.assert_frame_equal(statistics.to_frame(), expected[0].to_frame(),
+                                  check_dtype=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(histograms.to_frame(), expected[1].to_frame())
+
+
+def test_run_stations_accumulates(tmp_path):
+    pytest.importorskip('pyarrow')
+    from .accumulators import accumulate_layers
+    from .calculate_inversions import load_soundings
+    from .store import write_station
+
+    sites = ['XXM00000001', 'XXM00000002']
+    for ii, site in enumerate(sites):
+        write_station(make_soundings(150, seed=ii), str(tmp_path / 'soundings'), site)
+    heights = np.arange(25, 3000, 100.)
+    expected = [None, None]
+    for site in sites:
+        df = load_soundings(str(tmp_path / 'soundings'), site)
+        expected = accumulate_layers(find_inversions(df), site, df.height.min() + heights,
+                                     heights=expected[0], histograms=expected[1])
+
+    # Accumulated a month at a time, in workers, and from the cache when up to date
+    for workers, cache_dir in [(1, None), (2, 'cache'), (1, 'cache')]:
+        failed, statistics, histograms = run_stations(
+            sites, str(tmp_path / 'soundings'), str(tmp_path / 'inversions'), workers=workers,
+            cache_dir=cache_dir and str(tmp_path / cache_dir), heights=heights)
+        assert failed == {}
+        pd.testing.assert_frame_equal(statistics.to_frame(), expected[0].to_frame(), rtol=1e-9)
+        pd.testing.assert_frame_equal(histograms.to_frame(), expected[1].to_frame())
+
+
+def test_sweep_matches_separate_runs():
+    from .calculate_inversions import parameter_grid, sweep_inversions
+    from .invfinder import find_inversions_sweep
+    df = make_soundings(300)
+    grid = parameter_grid(params_default, max_embed_depth=[50, 100, 200], min_dt=[0, 2.5],
+                          rh_or_dt=[True, False])
+    assert len(grid) == 12 and grid[7] == dict(params_default, max_embed_depth=100, min_dt=2.5,
+                                                rh_or_dt=False)
+
+    result = find_inversions_sweep(df, grid)
+    assert list(result.param_set.unique()) == list(range(12))
+    for ii in [0, 5, 11]:
+        expected = find_inversions_batch(df, grid[ii])
+        pd.testing.assert_frame_equal(
+            result.loc[result.param_set == ii].drop(columns='param_set').reset_index(drop=True),
+            expected, check_dtype=False)
+
+    result = sweep_inversions(df, grid)
+    for ii in [3, 8]:
+        pd.testing.assert_frame_equal(
+            result.loc[result.param_set == ii].drop(columns='param_set').reset_index(drop=True),
+            find_inversions(df, grid[ii]), check_dtype=False)
+
+
+def test_layer_records_match_frames():
+    from .core import setup_batch
+    from .frequency import inversion_indicator
+    from .invfinder import find_inversion_records
+    from .layers import LayerRecords
+    df = make_soundings(200)
+    df = df.astype({cc: 'float32' for cc in df.columns if cc != 'date'})  # as read from the store
+    batch = setup_batch(df, ['pressure', 'height', 'temperature', 'relative_humidity'])
+    expected = find_inversions_ragged(*batch)
+    records = find_inversion_records(*batch)
+    assert records.base['height'].dtype == np.float32 and records.index_base.dtype == np.int32
+    assert len(records.dates) == 200 and np.any(records.n_layers == 0)
+    assert records.nbytes < expected.memory_usage(deep=True).sum() / 2
+    pd.testing.assert_frame_equal(records.to_frame(), expected, check_dtype=False)
+    assert np.all(records.to_frame(empty_rows=False)['inv_number'] > 0)
+    assert records.to_arrow().num_rows == len(records)
+
+    again = LayerRecords.from_frame(expected)
+    pd.testing.assert_frame_equal(again.to_frame(), expected, check_dtype=False)
+    merged = records.merge_interstitial(100).to_frame()
+    pd.testing.assert_frame_equal(merged, merge_interstitial_layers(expected, 100),
+                                  check_dtype=False)
+    # A gap of exactly max_embed_depth below a thinner one is merged too
+    tie = pd.DataFrame({'date': pd.Timestamp('2000-01-01'), 'inv_number': [1, 2, 3],
+                        'height_base': [0., 200., 350.], 'height_top': [100., 300., 400.]})
+    merged = merge_interstitial_layers(tie, 100)
+    assert len(merged) == 1
+    pd.testing.assert_frame_equal(LayerRecords.from_frame(tie).merge_interstitial(100).to_frame(),
+                                  merged.assign(index_base=-1, index_top=-1)[
+                                      ['date', 'inv_number', 'index_base', 'index_top',
+                                       'height_base', 'height_top']], check_dtype=False)
+
+    zgrid = np.arange(0, 5000, 50)
+    dates, indicator = records.indicator(zgrid)
+    np.testing.assert_array_equal(indicator, inversion_indicator(expected, zgrid)[1])
+    part = records.select('2000-01-10', '2000-02-10')
+    whole = records.to_frame()
+    pd.testing.assert_frame_equal(
+        part.to_frame(), whole.loc[whole.date.between('2000-01-10', '2000-02-10')].reset_index(
+            drop=True), check_dtype=False)
+    joined = LayerRecords.concatenate([records.select(end='2000-01-31 12:00'),
+                                       records.select('2000-02-01')])
+    pd.testing.assert_frame_equal(joined.to_frame(), whole)
+
+
+def test_layer_index_matches_masks():
+    from .core import setup_batch
+    from .intervals import LayerIndex
+    from .invfinder import find_inversion_records
+    df = make_soundings(300)
+    batch = setup_batch(df, ['pressure', 'height', 'temperature', 'relative_humidity'])
+    records = find_inversion_records(*batch, params=params_none)
+    index = LayerIndex(records)
+    base, top = index.base, index.top
+    month = index.dates.astype('datetime64[M]').astype(int) % 12 + 1
+    in_range = (index.dates >= np.datetime64('2000-02-01')) & (index.dates <= np.datetime64('2000-03-15'))
+
+    for z in [0, 250.3, 1000, 2500, 6000]:
+        np.testing.assert_array_equal(index.stab(z), np.flatnonzero((base <= z) & (top > z)))
+        np.testing.assert_array_equal(index.stab(z, '2000-02-01', '2000-03-15'),
+                                      np.flatnonzero((base <= z) & (top > z) & in_range))
+        np.testing.assert_array_equal(index.stab(z, months=[1, 3]),
+                                      np.flatnonzero((base <= z) & (top > z) & np.isin(month, [1, 3])))
+    np.testing.assert_array_equal(index.overlap(500, 800),
+                                  np.flatnonzero((base < 800) & (top > 500)))
+    np.testing.assert_array_equal(index.base_between(200, 800),
+                                  np.flatnonzero((base >= 200) & (base <= 800)))
+    for low, high in [(200, 800), (3000, 3100)]:
+        np.testing.assert_array_equal(
+            index.base_between(low, high, '2000-02-01', '2000-03-15', months=[2]),
+            np.flatnonzero((base >= low) & (base <= high) & in_range & (month == 2)))
+    zgrid = np.arange(0, 5000, 50.)
+    np.testing.assert_array_equal(index.count(zgrid),
+                                  ((base <= zgrid[:, None]) & (top > zgrid[:, None])).sum(axis=1))
+
+    layer_df = records.to_frame()
+    assert len(LayerIndex.from_frame(layer_df.iloc[:1]).stab(1000)) <= 1
+
+
+def legacy_station_counts(soundings, post):
+    """Level, launch and missing month counts of setup_station_list, by station."""
+    nlevels = pd.DataFrame({site: df.groupby('date').count().pressure.resample('1MS').mean()
+                            for site, df in soundings.items()}).mean(axis=0).round(0).astype(int)
+    counts = pd.DataFrame({site: df.groupby('date').count().pressure.resample('1MS').count()
+                           for site, df in soundings.items()}).fillna(0) == 0
+    hours = {site: df.date.drop_duplicates().dt.hour for site, df in soundings.items()}
+    return pd.DataFrame({'n_levels': nlevels,
+                         'n00Z': {site: np.sum((h == 23) | (h < 2)) for site, h in hours.items()},
+                         'n12Z': {site: np.sum((h > 10) & (h < 14)) for site, h in hours.items()},
+                         'n_missing_months': counts.sum(axis=0),
+                         'n_missing_months_post_2001': counts.loc[counts.index >= post].sum(axis=0)})
+
+
+def test_build_catalog_matches_legacy(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    from . import catalog
+    from .store import write_station
+
+    df = make_soundings(1500)
+    soundings = {'AAA': df, 'BBB': df.loc[(df.date < '2000-03-01') | (df.date >= '2000-06-01') &
+                                          (df.date < '2001-08-15 12:00')]}
+    for site, sounding in soundings.items():
+        write_station(sounding, str(tmp_path / 'store'), site)
+        write_archive(sounding, str(tmp_path / 'archive'), site)
+    expected = legacy_station_counts(soundings, '2001-01-01')
+    expected.index.name = 'station_id'
+
+    read = []
+    read_launches = catalog.read_launches
+    monkeypatch.setattr(catalog, 'read_launches', lambda root, station, *args:
+                        read.append(station) or read_launches(root, station, *args))
+    cache_path = str(tmp_path / 'catalog.json')
+    for root in ['store', 'archive']:
+        result = catalog.build_catalog(str(tmp_path / root), ['AAA', 'BBB', 'CCC'], '2000-01-01',
+                                       '2002-12-31 23:00', '2001-01-01')
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    result = catalog.build_catalog(str(tmp_path / 'store'), ['AAA', 'BBB'], '2000-01-01',
+                                   '2002-12-31 23:00', '2001-01-01', cache_path)
+    write_station(df, str(tmp_path / 'store'), 'BBB')
+    read.clear()
+    result = catalog.build_catalog(str(tmp_path / 'store'), ['AAA', 'BBB'], '2000-01-01',
+                                   '2002-12-31 23:00', '2001-01-01', cache_path)
+    assert read == ['BBB']
+    assert result.loc['BBB'].equals(result.loc['AAA'])
+
+
+def test_launch_index(tmp_path):
+    from .launches import (few_levels, height_not_increasing, level_mask, missing_humidity,
+                           off_synoptic, read_launch_index, select)
+
+    df = make_soundings(300)
+    df.loc[df.date == df.date.unique()[3], 'date'] = pd.Timestamp('2000-01-02 06:00')
+    df.loc[7, 'relative_humidity'] = np.nan
+    df = df.sort_values('date', kind='stable').reset_index(drop=True)
+    write_archive(df, str(tmp_path), 'AAA')
+    index = read_launch_index(str(tmp_path), 'AAA')
+    assert SoundingArchive(str(tmp_path), 'AAA').launches is not None
+
+    launches = df.groupby('date')
+    np.testing.assert_array_equal(index['date'], launches.size().index.values)
+    np.testing.assert_array_equal(index['n_levels'], launches.size())
+    np.testing.assert_array_equal(index['offset'], np.cumsum(launches.size()) - launches.size())
+    np.testing.assert_allclose(index['surface_height'], launches.height.first(), rtol=1e-6)
+    hours = launches.size().index.hour
+    np.testing.assert_array_equal(index['synoptic'] == 0, (hours > 22) | (hours < 2))
+    np.testing.assert_array_equal(index['synoptic'] == 12, (hours > 10) & (hours < 14))
+    np.testing.assert_array_equal((index['flags'] & off_synoptic) > 0, index['synoptic'] < 0)
+    np.testing.assert_array_equal((index['flags'] & missing_humidity) > 0,
+                                  launches.relative_humidity.apply(lambda x: x.isna().any()))
+    np.testing.assert_array_equal((index['flags'] & height_not_increasing) > 0,
+                                  launches.height.apply(lambda x: (x.diff() <= 0).any()))
+
+    kept = df.loc[level_mask(index, select(index, exclude=few_levels))]
+    pd.testing.assert_frame_equal(kept, df.loc[df.groupby('date').date.transform('size') > 5])
+    mask = select(index, '2000-02-01', '2000-03-31 23:00', synoptic=12, months=[3])
+    np.testing.assert_array_equal(index['date'][mask], launches.size().index[
+        (launches.size().index.month == 3) & (hours == 12)].values)
+
+
+def test_climatology_cube(tmp_path):
+    pytest.importorskip('pyarrow')
+    pytest.importorskip('scipy')
+    import xarray as xr
+    from .cubes import climatology, write_cube
+    from .frequency import inversion_indicator, lag1_autocorrelation, monthly_frequency
+    from .store import write_station
+
+    inversions = find_inversions_batch(make_soundings(600), params_default)
+    inversions = inversions.loc[inversions.date != inversions.date.unique()[5]]
+    write_station(inversions, str(tmp_path), 'AAA')
+    write_station(inversions.loc[inversions.date >= '2000-03-01'], str(tmp_path), 'BBB')
+    heights = 5 + np.arange(25, 3000, 50)
+    cube = climatology(str(tmp_path), ['AAA', 'BBB'], [100., 0.], heights, '2000-01-01',
+                       ['2000-09-30 23:00', '2000-08-31 23:00'], lazy=False)
+
+    dates, indicator = inversion_indicator(inversions.loc[inversions.date <= '2000-08-31 23:00'],
+                                           heights)
+    bbb = cube.sel(station='BBB')
+    np.testing.assert_array_equal(bbb.indicator.sel(time=dates[dates >= np.datetime64('2000-03-01')]),
+                                  np.minimum(indicator[dates >= np.datetime64('2000-03-01')], 1))
+    assert (bbb.indicator.sel(time=slice(None, '2000-02-29 12:00')) == -1).all()
+    assert (bbb.indicator.sel(time=inversions.date.unique()[5]) == -1).all()
+    months, frequency, counts = monthly_frequency(*inversion_indicator(
+        inversions.loc[inversions.date <= '2000-09-30 23:00'], heights + 100))
+    np.testing.assert_allclose(cube.frequency.sel(station='AAA', month=months), frequency,
+                               rtol=1e-6)
+    np.testing.assert_array_equal(cube.n.sel(station='AAA', month=months), counts)
+    assert np.isnan(cube.frequency.sel(station='BBB', month='2000-09-01')).all()
+    np.testing.assert_allclose(bbb.phi, lag1_autocorrelation(
+        dates[dates >= np.datetime64('2000-03-01')], indicator[dates >= np.datetime64('2000-03-01')]),
+                               rtol=1e-5)
+
+    write_cube(cube, str(tmp_path / 'cube.nc'))
+    xr.testing.assert_identical(xr.load_dataset(str(tmp_path / 'cube.nc')), cube)
+
+
+def test_climatology_cube_lazy(tmp_path):
+    pytest.importorskip('pyarrow')
+    pytest.importorskip('dask')
+    import xarray as xr
+    from .cubes import climatology, write_cube
+    from .store import write_station
+
+    write_station(find_inversions_batch(make_soundings(200), params_default), str(tmp_path), 'AAA')
+    args = (str(tmp_path), ['AAA'], [10.], np.arange(0, 3000, 100.), '2000-01-01', '2000-04-30')
+    lazy = climatology(*args)
+    assert lazy.chunks['station'] == (1,)
+    xr.testing.assert_identical(lazy.compute(), climatology(*args, lazy=False))
+
+    write_cube(lazy, str(tmp_path / 'cube.nc'))
+    xr.testing.assert_identical(xr.load_dataset(str(tmp_path / 'cube.nc')),
+                                climatology(*args, lazy=False))
+
+
+def test_climatology_cube_shared_slot(tmp_path):
+    pytest.importorskip('pyarrow')
+    from .cubes import climatology
+    from .store import write_station
+
+    # 23Z and 00Z the next day share the 00Z slot, 11Z and 13Z the 12Z slot
+    layers = pd.DataFrame({'date': pd.to_datetime(['2000-01-01 23:00', '2000-01-02 00:00',
+                                                   '2000-01-02 11:00', '2000-01-02 13:00']),
+                           'height_base': [0., 0., 0., 0.],
+                           'height_top': [400., 100., 300., 200.]})
+    write_station(layers, str(tmp_path), 'AAA')
+    cube = climatology(str(tmp_path), ['AAA'], [0.], np.arange(50, 500, 100.), '2000-01-01',
+                       '2000-01-02 23:00', lazy=False)
+    np.testing.assert_array_equal(cube.indicator.sel(station='AAA').values,
+                                  [[-1] * 5, [-1] * 5, [1, 0, 0, 0, 0], [1, 1, 1, 0, 0]])
+
+
+def test_regrid_matches_interp(tmp_path):
+    from .core import setup_batch
+    from .regrid import lapse_rate, regrid_archive, regrid_ragged
+
+    df = make_soundings(300)
+    df['potential_temperature'] = df.temperature * (1000 / df.pressure) ** 0.286
+    df.loc[5, 'height'] = np.nan
+    heights = np.arange(0, 4000, 50.)
+    variables = ['temperature', 'potential_temperature']
+    offsets, columns, dates = setup_batch(df, ['height'] + variables)
+    grid = regrid_ragged(offsets, columns, heights, variables)
+
+    for ii in [0, 1, 17, 299]:
+        launch = df.loc[df.date == dates[ii]].dropna(subset=['height']).sort_values('height')
+        target = df.loc[df.date == dates[ii], 'height'].values[0] + heights
+        for cc in variables:
+            expected = np.interp(target, launch.height, launch[cc], left=np.nan, right=np.nan)
+            np.testing.assert_allclose(grid[cc][ii], expected, rtol=1e-6)
+    assert np.isnan(grid['temperature'][0]).all() == np.isnan(df.height[0])
+
+    variables = ['pressure', 'height', 'temperature', 'relative_humidity']
+    df[variables] = df[variables].astype(np.float32)
+    write_archive(df, str(tmp_path), 'AAA')
+    offsets, columns, dates = setup_batch(df.loc[df.date >= '2000-02-01'], variables)
+    expected = regrid_ragged(offsets, columns, heights, ['temperature'])['temperature']
+    grid_dates, grid_heights, grid = regrid_archive(
+        SoundingArchive(str(tmp_path), 'AAA'), str(tmp_path / 'grid'), heights, ['temperature'],
+        start='2000-02-01', block_size=64)
+    assert isinstance(grid['temperature'], np.memmap)
+    np.testing.assert_array_equal(grid_dates, dates)
+    np.testing.assert_array_equal(grid['temperature'], expected)
+    assert lapse_rate(grid['temperature'], grid_heights).shape == (len(dates), len(heights) - 1)
+
+
+def test_detection_imports_only_numpy():
+    import os
+    import subprocess
+    import sys
+
+    package = __name__.rsplit('.', 1)[0]
+    code = ('import sys, {0}.invfinder, {0}.cloudfinder, {0}.layers; '
+            'print(" ".join(sys.modules))').format(package)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=root).stdout.split()
+    assert {'pandas', 'xarray', 'metpy', 'scipy'}.isdisjoint(loaded)
@@ -0,0 +1,145 @@
+"""Unit-free thermodynamic functions for whole sounding arrays.
+
+Temperatures are in K and pressures in hPa. Every function takes an
+optional out array, which may be one of the inputs, and otherwise returns
+a new array of the input's float type, so float32 arrays stay float32.
+
+The liquid water formulas for relative humidity and dewpoint are those of
+Bolton (1980), which MetPy 1.0 used for saturation_vapor_pressure and
+dewpoint. equivalent_potential_temperature is MetPy's (Bolton 1980), with the
+vapor pressure at the dewpoint from Ambaum (2020) as in MetPy 1.7, so it
+agrees with mpcalc.equivalent_potential_temperature to rounding.
+Saturation over ice is the quadratic spline through the Rogers and Yau
+(1989) table, based on Wexler (1977), that import_soundings interpolated
+with scipy; the spline's coefficients are tabulated below.
+"""
+import numpy as np
+
+kappa = 0.28571428571428564  # Rd / Cp_d
+epsilon = 0.6219569100577033  # Mw / Md
+
+# MetPy's constants for Ambaum (2020), J/kg/K, J/kg and K
+water_heat_power = (4219.400000000001 - 1860.078011865639) / 461.52311572606084  # (Cp_l - Cp_v) / Rv
+water_heat_latent = 2500840.0 / 461.52311572606084  # Lv / Rv
+water_triple_point = 273.16
+
+# The ice spline is ice_coefficients[i] = (a, b, c), value a dx**2 + b dx + c with
+# dx = T - ice_breaks[i], on ice_breaks[i] <= T <= ice_breaks[i + 1]
+ice_breaks = np.array([203.15, 218.15, 228.15, 235.65, 240.65, 245.65, 250.65, 255.65,
+                       260.65, 265.65, 273.15])
+ice_coefficients = np.array([
+    [7.430490966239042e-05, 7.695090337609588e-05, 0.0026],
+    [0.00027986563236326713, 0.0023060981932478083, 0.020472868224679284],
+    [0.0006985012961580059, 0.007903410840513152, 0.07152041339348408],
+    [0.0012097570698514082, 0.01838093028288324, 0.17008669260622056],
+    [0.001882956284733549, 0.030478500981397337, 0.292235270766922],
+    [0.002884505221747262, 0.049308063828732845, 0.49170168279224746],
+    [0.004330012384782901, 0.07815311604620545, 0.8103546324795932],
+    [0.0064314204695559984, 0.12145323989403423, 1.3093705223301895],
+    [0.009177464797880654, 0.1857674445895942, 2.0774222335392607],
+    [0.014119790743159888, 0.2775420925684009, 3.235696076434248]])
+
+
+def output(x, out):
+    """Returns out, or a new array shaped like x of x's float type."""
+    if out is None:
+        out = np.empty(np.shape(x), dtype=np.result_type(np.asarray(x).dtype, np.float32))
+    return out
+
+
+def saturation_vapor_pressure_liquid(temperature, out=None):
+    """Saturation vapor pressure over liquid water in hPa, Bolton (1980)."""
+    out = np.subtract(temperature, 273.15, out=output(temperature, out))
+    denominator = out + 243.5
+    np.multiply(out, 17.67, out=out)
+    np.divide(out, denominator, out=out)
+    np.exp(out, out=out)
+    return np.multiply(out, 6.112, out=out)
+
+
+def saturation_vapor_pressure_ambaum(temperature, out=None):
+    """Saturation vapor pressure over liquid water in hPa, Ambaum (2020)
+    equation 13 with the latent heat of equation 15, as in MetPy 1.7."""
+    temperature = np.asarray(temperature)
+    # Lv / (Rv T0) - L(T) / (Rv T) with L(T) = Lv - (Cp_l - Cp_v) (T - T0)
+    out = np.divide(water_triple_point, temperature, out=output(temperature, out))
+    exponent = (water_heat_latent / water_triple_point + water_heat_power) * (1 - out)
+    np.power(out, water_heat_power, out=out)
+    out *= np.exp(exponent)
+    return np.multiply(out, 6.112, out=out)
+
+
+def saturation_vapor_pressure_ice(temperature, out=None):
+    """Saturation vapor pressure over ice in hPa, for temperatures between
+    203.15 and 273.15 K (-70 to 0 C). NaN outside that range."""
+    temperature = np.asarray(temperature)
+    interval = np.searchsorted(ice_breaks, temperature, side='right') - 1
+    np.clip(interval, 0, len(ice_coefficients) - 1, out=interval)
+    outside = ~((temperature >= ice_breaks[0]) & (temperature <= ice_breaks[-1]))
+    coefficients = ice_coefficients[interval]
+
+    out = np.subtract(temperature, ice_breaks[interval], out=output(temperature, out))
+    dx = out.copy()
+    np.multiply(out, coefficients[..., 0], out=out)
+    np.add(out, coefficients[..., 1], out=out)
+    np.multiply(out, dx, out=out)
+    np.add(out, coefficients[..., 2], out=out)
+    np.copyto(out, np.nan, where=outside)
+    return out
+
+
+def adjusted_relative_humidity(temperature, vapor_pressure, out=None):
+    """Relative humidity in percent with respect to ice between 203.15 and
+    273.15 K and to liquid water otherwise. NaN below 203.15 K, where the
+    ice table ends."""
+    temperature = np.asarray(temperature)
+    ice = (temperature < 273.15) & (temperature > 203.15)
+    too_cold = temperature < 203.15
+    saturation = saturation_vapor_pressure_liquid(temperature)
+    np.copyto(saturation, saturation_vapor_pressure_ice(temperature), where=ice)
+    out = np.divide(vapor_pressure, saturation, out=output(temperature, out))
+    np.multiply(out, 100, out=out)
+    np.copyto(out, np.nan, where=too_cold)
+    return out
+
+
+def dewpoint(vapor_pressure, out=None):
+    """Dewpoint in K for a vapor pressure in hPa, inverting Bolton (1980)."""
+    out = np.divide(vapor_pressure, 6.112, out=output(vapor_pressure, out))
+    np.log(out, out=out)
+    denominator = 17.67 - out
+    np.multiply(out, 243.5, out=out)
+    np.divide(out, denominator, out=out)
+    return np.add(out, 273.15, out=out)
+
+
+def equivalent_potential_temperature(pressure, temperature, dewpoint, out=None):
+    """Equivalent potential temperature in K, Bolton (1980) equations 24,
+    39 and 43 with the vapor pressure of saturation_vapor_pressure_ambaum,
+    computed as in MetPy."""
+    temperature = np.asarray(temperature)
+    dewpoint = np.asarray(dewpoint)
+    vapor_pressure = saturation_vapor_pressure_ambaum(dewpoint)
+    dry_pressure = np.subtract(pressure, vapor_pressure)
+    mixing_ratio = np.divide(vapor_pressure, dry_pressure, out=vapor_pressure)
+    mixing_ratio *= epsilon
+
+    # Temperature at the lifting condensation level
+    t_l = np.divide(temperature, dewpoint)
+    np.log(t_l, out=t_l)
+    t_l /= 800
+    t_l += 1 / (dewpoint - 56)
+    np.reciprocal(t_l, out=t_l)
+    t_l += 56
+
+    # Potential temperature of the dry air at the LCL
+    theta = np.divide(1000, dry_pressure, out=dry_pressure)
+    np.power(theta, kappa, out=theta)
+    theta *= temperature
+    theta *= (temperature / t_l) ** (0.28 * mixing_ratio)
+
+    exponent = np.divide(3036., t_l, out=t_l)
+    exponent -= 1.78
+    exponent *= mixing_ratio * (1 + 0.448 * mixing_ratio)
+    np.exp(exponent, out=exponent)
+    return np.multiply(theta, exponent, out=output(temperature, out))